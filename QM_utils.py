@@ -10,32 +10,50 @@ import numpy as np
 import time
 
 import clustering as clust
+import hamiltonian as Ham
+import validation
+import workspace as wSpace
 #from scipy.interpolate import lagrange
 #import scipy.integrate as integrate
 #import random as rd
 
 
-def calc_ad_frc(pos, ctmqc_env):
+def calc_ad_frc(pos, ctmqc_env, U=False, dH=False):
     """
     Will calculate the forces from each adiabatic state (the grad E term)
+    along each nuclear dimension, with shape (nrep, ndim, nstate).
+
+    This uses the Hellmann-Feynman theorem with the analytic gradient of the
+    Hamiltonian:
+        F_l = -<phi_l | dH/dx | phi_l>
+    so no finite differences are needed. If the eigenvectors and Hamiltonian
+    gradient have already been calculated at pos they can be passed in.
+
+    The Hamiltonian functions are vectorised so pos can be a single position
+    or the array of all replica positions.
     """
-    dx = ctmqc_env['dx']
-    H_x = ctmqc_env['Hfunc'](pos)
-    H_xp = ctmqc_env['Hfunc'](pos + dx)
-    E_xp = np.linalg.eigh(H_xp)[0]
-    E_x = np.linalg.eigh(H_x)[0]
-    gradE = -np.array(E_xp - E_x) / dx
+    if U is False:
+        H_x = ctmqc_env['Hfunc'](pos)
+        U = Ham.getEigProps(H_x, ctmqc_env)[1]
+    if dH is False:
+        dH = ctmqc_env['dHfunc'](pos)
+
+    gradH_ad = Ham.calc_gradH_adiab(U, dH)
+    gradE = -np.diagonal(gradH_ad, axis1=-2, axis2=-1).real
 
-    return gradE
+    return np.array(gradE)
 
 
 def calc_ad_mom(ctmqc_env, irep, ad_frc=False):
     """
-    Will calculate the adiabatic momenta (time-integrated adiab force)
+    Will calculate the adiabatic momenta (time-integrated adiab force).
+
+    irep can be a single replica index or an array of them. If the adiabatic
+    forces aren't given the ones already calculated for this step (in
+    ctmqc_env['adFrc']) are used.
     """
     if ad_frc is False:
-        pos = ctmqc_env['pos'][irep]
-        ad_frc = calc_ad_frc(pos, ctmqc_env)
+        ad_frc = ctmqc_env['adFrc'][irep]
 
     ad_mom = ctmqc_env['adMom'][irep]
     dt = ctmqc_env['dt']
@@ -114,14 +132,17 @@ def Rlk_is_spiking(Rlk, runData):
     ctmqc_env = runData.ctmqc_env
     if ctmqc_env['iter'] == 0 and not ctmqc_env['Rlk_smooth']: return False
 
-    # Check whether the gradient of the Rlk is too high
-    Rlk = Rlk[0, 1]
-    Rlk_tm = ctmqc_env['Rlk_tm'][0, 1]
-    gradRlk = abs((Rlk - Rlk_tm) / ctmqc_env['dt'])
-    denom = abs(ctmqc_env['RlkDenom'][0, 1])
-    if (gradRlk > ctmqc_env['gradTol'] and denom < 0.1) or gradRlk > 100:
-       return True
-    return False
+    # Check whether the gradient of the Rlk is too high (for any state pair
+    #  and dimension). Rlk_tm is from the last time Qlk was calculated.
+    l, k = np.triu_indices(ctmqc_env['nstate'], 1)
+    gradRlk = np.abs(Rlk[..., l, k] - ctmqc_env['Rlk_tm'][..., l, k]) \
+              / abs(ctmqc_env.get('QM_dt', ctmqc_env['dt']))
+    denom = np.abs(ctmqc_env['RlkDenom'][..., l, k])
+    isSpiking = ((gradRlk > ctmqc_env['gradTol']) & (denom < 0.1)) \
+                | (gradRlk > 100)
+    # The largest smooth gradient (for the adaptive dt, spikes are smoothed)
+    ctmqc_env['gradRlk'] = float(np.max(gradRlk[~isSpiking], initial=0.0))
+    return bool(np.any(isSpiking))
 
 
 def get_goodR_RIO(ctmqc_env, reps_to_do):
@@ -133,14 +154,15 @@ def get_goodR_RIO(ctmqc_env, reps_to_do):
     if ctmqc_env['do_sigma_calc'].lower() == 'no':
          ctmqc_env['WIJ'] = calc_WIJ(ctmqc_env, reps_to_do)
 
-    ctmqc_env['RI0'] = np.sum(ctmqc_env['WIJ'] * ctmqc_env['pos'], axis=1)
+    ctmqc_env['RI0'] = calc_RI0(ctmqc_env)
 
     # If it is spiking interpolate between the Rlk and RI0
-    goodR = np.zeros((ctmqc_env['nstate'], ctmqc_env['nstate']))
+    goodR = np.zeros((ctmqc_env['ndim'], ctmqc_env['nstate'],
+                      ctmqc_env['nstate']))
     for l in range(ctmqc_env['nstate']):
         for k in range(l):
-            goodR[l, k] = np.mean(ctmqc_env['altR'])
-            goodR[k, l] = goodR[l, k]
+            goodR[:, l, k] = np.mean(ctmqc_env['altR'])
+            goodR[:, k, l] = goodR[:, l, k]
 
     return goodR
 
@@ -208,7 +230,7 @@ def get_effective_R(runData, Rlk, reps_to_do):
             # Get alternative R
             if ctmqc_env['do_sigma_calc'].lower() == 'no':
                 ctmqc_env['WIJ'] = calc_WIJ(ctmqc_env, reps_to_do)
-            ctmqc_env['RI0'] = np.sum(ctmqc_env['WIJ'] * ctmqc_env['pos'], axis=1)
+            ctmqc_env['RI0'] = calc_RI0(ctmqc_env)
 
             ctmqc_env['intercept_type'] = 'RI0'
 
@@ -307,58 +329,92 @@ def calc_all_prod_gauss(ctmqc_env, reps_to_do):
     """
     Will calculate the product of the gaussians in a more efficient way than
     simply brute forcing it.
+
+    The gaussian on each replica is a product of 1D gaussians (with the same
+    width) in each nuclear dimension. The (nrep, nrep) result is written into
+    a persistent work array (see workspace.get_buffer). All the rows are
+    calculated at once, only those in reps_to_do are needed.
     """
     nRep = ctmqc_env['nrep']
-
-    # We don't need the prefactor of (1/(2 pi))^{3/2} as it always cancels out
-    prefact = ctmqc_env['sigma']**(-1)  # -1 as it is 1D (will be -3 for 3D)
-
-    # Calculate the exponent
-    exponent = np.zeros((nRep, nRep))
-    sig = ctmqc_env['sigma'] ** 2
     pos = ctmqc_env['pos']
-    for I, RIv in enumerate(pos[reps_to_do]):
-        exponent[I, :] = -(RIv - pos)**2 / sig
+    ndim = np.shape(pos)[1]
+
+    # We don't need the prefactor of (1/(2 pi))^{ndim/2} as it always cancels
+    prefact = ctmqc_env['sigma']**(-ndim)
+
+    # Calculate the exponent (the squared distances summed over dimensions)
+    gauss = wSpace.get_buffer(ctmqc_env, 'prod gauss', (nRep, nRep))
+    for idim in range(ndim):
+        out = gauss
+        if idim > 0:
+            out = wSpace.get_buffer(ctmqc_env, 'prod gauss dist', (nRep, nRep))
+        np.subtract.outer(pos[:, idim], pos[:, idim], out=out)
+        np.square(out, out=out)
+        if idim > 0:
+            gauss += out
+    sig = ctmqc_env['sigma'] ** 2
+    np.negative(gauss, out=gauss)
+    gauss /= sig
 
-    return np.exp(exponent * 0.5) * prefact
+    gauss *= 0.5
+    np.exp(gauss, out=gauss)
+    gauss *= prefact
+    return gauss
 
 
 def calc_WIJ(ctmqc_env, reps_to_complete):
     """
-    Will calculate alpha for all replicas and atoms
+    Will calculate alpha for all replicas and atoms. The rows of the replicas
+    not in reps_to_complete are 0.
     """
-    #t0 = time.time()
+    if ctmqc_env.get('backend', 'numpy') == 'numba':
+        import numba_kernels as nbK
+        return nbK.calc_WIJ(ctmqc_env['pos'], ctmqc_env['sigma'],
+                            np.asarray(reps_to_complete))
+
     nRep = ctmqc_env['nrep']
-    WIJ = np.zeros((nRep, nRep))
-    #t1 = time.time()
     allProdGauss_IJ = calc_all_prod_gauss(ctmqc_env, reps_to_complete)
-    #t2 = time.time()
     sigma2 = 2 * ctmqc_env['sigma']**2
-    for I in reps_to_complete:
-        # Calc WIJ
-        WIJ[I, :] = allProdGauss_IJ[I, :] \
-                        / (sigma2 * np.sum(allProdGauss_IJ[I, :]))
-    #t3 = time.time()
-    #totTime = t3-t0
-    #print("\t* allocate: %.2g%% %.2g" % (100.*(t1-t0)/totTime, t1-t0))
-    #print("\t* calc gauss prod: %.2g%% %.2g" % (100.*(t2-t1)/totTime, t2-t1))
-    #print("\t* calc WIJ: %.2g%% %.2g" % (100.*(t3-t2)/totTime, t3-t2))
+
+    # WIJ = gauss_IJ / (2 sigma_J^2 sum_J gauss_IJ)
+    denom = wSpace.get_buffer(ctmqc_env, 'WIJ denom', (nRep, nRep))
+    np.multiply(sigma2, np.sum(allProdGauss_IJ, axis=1)[:, np.newaxis],
+                out=denom)
+    WIJ = wSpace.get_buffer(ctmqc_env, 'WIJ', (nRep, nRep))
+    np.divide(allProdGauss_IJ, denom, out=WIJ)
+
+    if len(reps_to_complete) != nRep:
+        notDone = np.ones(nRep, dtype=bool)
+        notDone[reps_to_complete] = False
+        WIJ[notDone] = 0.0
 
     return WIJ
 
 
-def calc_Ylk(ctmqc_env):
+def calc_RI0(ctmqc_env):
     """
-    Will calculate the Ylk value that appears in the Rlk quantity
+    Will calculate the RI0 intercept, sum_J WIJ R_J, for each replica and
+    nuclear dimension.
     """
-    Ylk = np.zeros((ctmqc_env['nrep'],
-                    ctmqc_env['nstate'],
-                    ctmqc_env['nstate']))
+    return np.einsum('IJ,Jd->Id', ctmqc_env['WIJ'], ctmqc_env['pos'])
 
-    Clk = ctmqc_env['adPops'][:, 1] * ctmqc_env['adPops'][:, 0]
-    fl_fk =  ctmqc_env['adMom'][:, 0] - ctmqc_env['adMom'][:, 1]
-    Ylk[:, 0, 1] = Clk * fl_fk
-    Ylk[:, 1, 0] = -Ylk[:, 0, 1]
+
+def calc_Ylk(ctmqc_env):
+    """
+    Will calculate the Ylk value that appears in the Rlk quantity for all
+    state pairs and nuclear dimensions, with shape (nrep, ndim, nstate, nstate):
+        Ylk = |C_l|^2 |C_k|^2 (f_l - f_k)
+    The result is written into a persistent work array.
+    """
+    pops = ctmqc_env['adPops']
+    f = ctmqc_env['adMom']
+    shape = np.shape(f) + np.shape(f)[-1:]
+    Ylk = wSpace.get_buffer(ctmqc_env, 'Ylk', shape)
+    fl_fk = wSpace.get_buffer(ctmqc_env, 'Ylk fl-fk', shape)
+    np.multiply(pops[:, np.newaxis, :, np.newaxis],
+                pops[:, np.newaxis, np.newaxis, :], out=Ylk)
+    np.subtract(f[..., :, np.newaxis], f[..., np.newaxis, :], out=fl_fk)
+    Ylk *= fl_fk
     return Ylk
 
 
@@ -367,16 +423,19 @@ def calc_Rlk(ctmqc_env, reps_to_do=False):
     Will calculate the pair-wise state dependence intercept used in the
     calculation of Qlk
     """
+    if reps_to_do is False:
+        reps_to_do = np.arange(ctmqc_env['nrep'])
+
     Ylk = calc_Ylk(ctmqc_env)
     ctmqc_env['RlkDenom'] = np.sum(Ylk, axis=0)
 
-    Rlk = np.zeros((ctmqc_env['nstate'], ctmqc_env['nstate']))
-    if ctmqc_env['RlkDenom'][0, 1] != 0:
-        Rlk[0, 1] = np.sum(ctmqc_env['pos'][reps_to_do]
-                            * ctmqc_env['alpha'][reps_to_do]
-                            * Ylk[reps_to_do, 0, 1],
-                           axis=0) / ctmqc_env['RlkDenom'][0, 1]
-        Rlk[1, 0] = Rlk[0,1]
+    # Both Ylk and its sum are antisymmetric so Rlk is symmetric
+    Ralpha = ctmqc_env['pos'][reps_to_do] \
+             * ctmqc_env['alpha'][reps_to_do, np.newaxis]
+    numer = np.einsum('Id,Idlk->dlk', Ralpha, Ylk[reps_to_do])
+    Rlk = np.zeros(np.shape(numer))
+    np.divide(numer, ctmqc_env['RlkDenom'], out=Rlk,
+              where=ctmqc_env['RlkDenom'] != 0)
     return Rlk
 
 
@@ -387,9 +446,10 @@ def calc_Gossel_sigma(ctmqc_env):
     minSig = 0.1  # np.min(ctmqc_env['sigma'])
 
     for I in range(ctmqc_env['nrep']):
-        distances = np.abs(ctmqc_env['pos'][I] - ctmqc_env['pos'])
+        distances = np.linalg.norm(ctmqc_env['pos'][I] - ctmqc_env['pos'],
+                                   axis=1)
         multiplier = float(ctmqc_env['const']) / float(len(distances))
-        cutoffR = 2 * np.std(ctmqc_env['pos'])
+        cutoffR = 2 * np.sqrt(np.sum(np.var(ctmqc_env['pos'], axis=0)))
         distances = distances[distances < cutoffR]
 
         avgD = np.mean(distances)
@@ -408,13 +468,16 @@ def calc_Gossel_sigma_with_clusters(ctmqc_env):
     Will calculate the sigma parameter as laid out in Gossell, 18.
     """
     minSig = 0.1  # np.min(ctmqc_env['sigma'])
+    if ctmqc_env['ndim'] != 1:
+        raise SystemExit("The clustering only works in 1D")
 
-    clusterPos, clusterInds = clust.getClusters(ctmqc_env['pos'], 0.7, 4)
+    clusterPos, clusterInds = clust.getClusters(ctmqc_env['pos'][:, 0],
+                                                0.7, 4)
     ctmqc_env['clusters'] = clusterInds
 
     for I in range(ctmqc_env['nrep']):
         clustID = clust.getClustID(clusterInds, I)
-        distances = np.abs(ctmqc_env['pos'][I] - clusterPos[clustID])
+        distances = np.abs(ctmqc_env['pos'][I, 0] - clusterPos[clustID])
         multiplier = float(ctmqc_env['const']) / float(len(distances))
 
 #        avgD = np.mean(distances)
@@ -432,17 +495,20 @@ def calc_deBroglie_sigma(ctmqc_env):
     """
     Will calculate sigma from 50 * the De-Broglie wavelength.
     """
-    ctmqc_env['sigma'] = 60 / (2 * np.pi * ctmqc_env['mass'] * abs(ctmqc_env['vel']))
+    speed = np.linalg.norm(ctmqc_env['vel'], axis=1)
+    ctmqc_env['sigma'] = 60 / (2 * np.pi * ctmqc_env['mass'] * speed)
 
 
 def calc_Qlk_Min17_opt(runData):
     """
     Will calculate the quantum momentum as written in Min, 17.
+
+    The result is written into the array given by workspace.next_buffer (so
+    it doesn't overwrite Qlk_tm).
     """
     ctmqc_env = runData.ctmqc_env
-    Qlk = np.zeros((ctmqc_env['nrep'],
-                    ctmqc_env['nstate'],
-                    ctmqc_env['nstate']))
+    Qlk = wSpace.next_buffer(ctmqc_env, 'Qlk')
+    Qlk.fill(0.0)
 
 
     # Get which reps to calculate alpha for
@@ -480,29 +546,31 @@ def calc_Qlk_Min17_opt(runData):
     # Smooth out the intercept
     effR = get_effective_R(runData, Rlk, reps_to_do)
 
+    Ralpha = ctmqc_env['alpha'][:, np.newaxis] * ctmqc_env['pos']
     if ctmqc_env['intercept_type'] == 'Rlk':
-        for l in range(ctmqc_env['nstate']):
-            for k in range(ctmqc_env['nstate']):
-                ctmqc_env['effR'][l, k, :] = effR[l, k]
+        # effR is stored as (nstate, nstate, nrep, ndim)
+        if effR is not False:
+            effR = np.reshape(effR, np.shape(Rlk))
+            ctmqc_env['effR'][:] = np.moveaxis(effR, 0, -1)[:, :, np.newaxis]
 
-        for I in reps_to_do:
-            Qlk[I, :, :] = (ctmqc_env['alpha'][I] * ctmqc_env['pos'][I]) - Rlk
+        if len(reps_to_do) == ctmqc_env['nrep']:
+            np.subtract(Ralpha[:, :, None, None], Rlk, out=Qlk)
+        else:
+            Qlk[reps_to_do] = Ralpha[reps_to_do, :, None, None] - Rlk
 
     elif ctmqc_env['intercept_type'] == 'RI0':
         for I in reps_to_do:
             ctmqc_env['effR'][:, :, I] = ctmqc_env['RI0'][I]
 
-            Qlk[I, :, :] = (ctmqc_env['alpha'][I] * ctmqc_env['pos'][I]) - ctmqc_env['RI0'][I]
+            Qlk[I] = (Ralpha[I] - ctmqc_env['RI0'][I])[:, None, None]
     
     elif ctmqc_env['intercept_type'] == 'ehrenfest':
-       Qlk = np.zeros((ctmqc_env['nrep'],
-                       ctmqc_env['nstate'],
-                       ctmqc_env['nstate']))
-    
-    # Only for 2 states
-    if np.any(Qlk[:, 0, 1] != Qlk[:, 1, 0]):
-        print(Qlk)
-        raise SystemExit("Qlk not symmetric!")
+       Qlk.fill(0.0)
+
+    if validation.do_checks(ctmqc_env):
+        asym = np.max(np.abs(Qlk - np.swapaxes(Qlk, -1, -2)), initial=0)
+        validation.record_check(ctmqc_env, "Qlk symmetric", asym == 0,
+                                "max |Q_lk - Q_kl| = %.2g" % asym)
 
 
     Qlk /= ctmqc_env['mass']
@@ -8,42 +8,48 @@ Created on Thu May  9 14:41:10 2019
 """
 import numpy as np
 
+import validation
+import workspace as wSpace
+
 
 def trans_diab_to_adiab(ctmqc_env):
     """
-    Will transform the diabatic coefficients to adiabatic ones
+    Will transform the diabatic coefficients to adiabatic ones (for all
+    replicas at once)
     """
-    nrep = ctmqc_env['nrep']
+    if ctmqc_env.get('backend', 'numpy') == 'numba':
+        import numba_kernels as nbK
+        nbK.trans_coeffs(ctmqc_env['U'], ctmqc_env['u'], ctmqc_env['C'], True)
+        return
 
-    for irep in range(nrep):
-        u = ctmqc_env['u'][irep]
-        U = ctmqc_env['U'][irep]
-        ctmqc_env['C'][irep] = np.matmul(np.array(U.T),
-                                         np.array(u))
+    ctmqc_env['C'][:] = np.einsum('...ji,...j->...i', ctmqc_env['U'],
+                                  ctmqc_env['u'])
 
 
 def trans_adiab_to_diab(ctmqc_env):
     """
-    Will transform the adiabatic coefficients to diabatic ones
+    Will transform the adiabatic coefficients to diabatic ones (for all
+    replicas at once)
     """
-    nrep = ctmqc_env['nrep']
+    if ctmqc_env.get('backend', 'numpy') == 'numba':
+        import numba_kernels as nbK
+        nbK.trans_coeffs(ctmqc_env['U'], ctmqc_env['C'], ctmqc_env['u'], False)
+        return
 
-    for irep in range(nrep):
-        C = ctmqc_env['C'][irep]
-        U = ctmqc_env['U'][irep]
+    ctmqc_env['u'][:] = np.einsum('...ij,...j->...i', ctmqc_env['U'],
+                                  ctmqc_env['C'])
 
-        ctmqc_env['u'][irep] = np.matmul(np.array(U),
-                                         np.array(C))
 
-
-def renormalise_all_coeffs(coeff):
+def renormalise_all_coeffs(coeff, ctmqc_env=False):
     """
     Will renormalise all the coefficients for replica I, atom v.
     """
-    nrep, _ = np.shape(coeff)
-    norms = np.linalg.norm(coeff, axis=1)
-    for I in range(nrep):
-        coeff[I, :] = coeff[I, :] / norms[I]
+    if ctmqc_env is not False and ctmqc_env.get('backend') == 'numba':
+        import numba_kernels as nbK
+        nbK.renormalise(coeff)
+        return coeff
+
+    coeff /= np.linalg.norm(coeff, axis=1)[:, np.newaxis]
 
     return coeff
 
@@ -65,14 +71,142 @@ def calc_ad_pops(C, ctmqc_env=False):
     return pops**2
 
 
-def get_diffVal(var, var_tm, ctmqc_env):
+def get_diffVal(var, var_tm, ctmqc_env, elec_steps=False):
     """
     Will get the necessary variables to do the linear interpolation.
     """
-    dvar_E = (var - var_tm) / float(ctmqc_env['elec_steps'])
+    if elec_steps is False:
+        elec_steps = ctmqc_env['elec_steps']
+    dvar_E = (var - var_tm) / float(elec_steps)
     return dvar_E
 
 
+def get_elec_steps(ctmqc_env, basis='adiab'):
+    """
+    Will get the number of electronic substeps each replica should take over
+    this nuclear step (an int array with shape (nrep)).
+
+    If the 'elec_step_tol' setting is False every replica takes 'elec_steps'
+    substeps. Otherwise the number is picked from the fastest timescale in X
+    (see calc_X_freq) so the estimated local error of the integrator over
+    the nuclear step is below elec_step_tol. The number is capped at
+    'max_elec_steps'.
+    """
+    nrep = ctmqc_env['nrep']
+    tol = ctmqc_env.get('elec_step_tol', False)
+    if tol is False:
+        return np.full(nrep, ctmqc_env['elec_steps'], dtype=np.int64)
+
+    # The global order of the integrator
+    order = {'rk4': 4, 'magnus': 2, 'magnus4': 4}[get_integrator(ctmqc_env)]
+
+    # An order p integrator makes an error of ~(w dTe)^(p+1) per substep, so
+    #  over n substeps it's (w dt)^(p+1) / n^p.
+    # (the substeps of the higher order nuclear integrators can go backwards)
+    wdt = calc_X_freq(ctmqc_env, basis) * abs(ctmqc_env['dt'])
+    nsteps = np.ceil(wdt * (wdt / tol)**(1./order))
+    nsteps = np.clip(nsteps, 1, ctmqc_env.get('max_elec_steps', 1000))
+    return nsteps.astype(np.int64)
+
+
+def calc_X_freq(ctmqc_env, basis='adiab'):
+    """
+    Will estimate the fastest timescale of the electronic equation of motion
+    for each replica over the nuclear step (the larger of its value at the
+    start and end of the step). This is the sum of:
+        * the spread of the adiabatic energies (the fastest phase rotation)
+        * the largest row sum of |NACV . v| (adiabatic basis only)
+        * the largest quantum momentum term |Xqm| (if do_QM_C)
+    """
+    adPops = (np.conjugate(ctmqc_env['C']) * ctmqc_env['C']).real
+    adiab = basis == 'adiab'
+
+    freq = np.zeros(ctmqc_env['nrep'])
+    for tm in ('_tm', ''):
+        E = ctmqc_env['E' + tm] if adiab else ctmqc_env['E']
+        w = np.max(E, axis=1) - np.min(E, axis=1)
+        if adiab:
+            NACV_v = np.einsum('...d,...dlk->...lk', ctmqc_env['vel' + tm],
+                               ctmqc_env['NACV' + tm])
+            w += np.max(np.sum(np.abs(NACV_v), axis=-1), axis=-1)
+        if ctmqc_env['do_QM_C']:
+            Xqm = calc_Xqm_diag(ctmqc_env['Qlk' + tm],
+                                ctmqc_env['adMom' + tm], adPops)
+            w += np.max(np.abs(Xqm), axis=-1)
+        freq = np.maximum(freq, w)
+    return freq
+
+
+def get_dormant_reps(ctmqc_env, basis='adiab'):
+    """
+    Will find which replicas are dormant over this nuclear step. These are in
+    a single adiabatic state (a population above the 'threshold') and are
+    effectively decoupled at the start and end of the step:
+        max |NACV . v| < dormant_tol  and  max |Xqm| < dormant_tol
+    so their adiabatic coefficients only pick up a phase (see
+    do_dormant_prop).
+
+    Returns a bool mask with shape (nrep) (all False if the 'dormant_tol'
+    setting is False).
+    """
+    nrep = ctmqc_env['nrep']
+    tol = ctmqc_env.get('dormant_tol', False)
+    if tol is False:
+        return np.zeros(nrep, dtype=bool)
+
+    adPops = (np.conjugate(ctmqc_env['C']) * ctmqc_env['C']).real
+    dormant = np.any(adPops > ctmqc_env['threshold'], axis=1)
+
+    # The diabatic propagation doesn't keep the NACV and velocity of the
+    #  previous step so only the current ones are used there.
+    tms = ('_tm', '') if basis == 'adiab' else ('',)
+    for tm in tms:
+        NACV_v = np.einsum('...d,...dlk->...lk', ctmqc_env['vel' + tm],
+                           ctmqc_env['NACV' + tm])
+        dormant &= np.max(np.abs(NACV_v), axis=(1, 2)) < tol
+    if ctmqc_env['do_QM_C']:
+        for tm in ('_tm', ''):
+            Xqm = calc_Xqm_diag(ctmqc_env['Qlk' + tm],
+                                ctmqc_env['adMom' + tm], adPops)
+            dormant &= np.max(np.abs(Xqm), axis=1) < tol
+    return dormant
+
+
+def do_dormant_prop(ctmqc_env, dormant, basis='adiab'):
+    """
+    Will propagate the coefficients of the dormant replicas. Without any
+    coupling the adiabatic coefficients just rotate with the (linearly
+    interpolated) energies:
+        C_l(t + dt) = C_l(t) exp(-i dt (E_l(t) + E_l(t + dt)) / 2)
+    In the diabatic basis these are transformed back with the current
+    eigenvectors.
+    """
+    if not np.any(dormant):
+        return
+    Eavg = 0.5 * (ctmqc_env['E_tm'][dormant] + ctmqc_env['E'][dormant])
+    C = ctmqc_env['C'][dormant] * np.exp(-1j * ctmqc_env['dt'] * Eavg)
+    if basis == 'adiab':
+        ctmqc_env['C'][dormant] = C
+    else:
+        ctmqc_env['u'][dormant] = np.einsum('...ij,...j->...i',
+                                            ctmqc_env['U'][dormant], C)
+
+
+def group_reps(nsteps):
+    """
+    Will group the replicas by their number of electronic substeps so each
+    group can be propagated at once. Yields (nstep, reps) where reps indexes
+    the replicas in the group (a slice of all of them if there is only 1).
+    Replicas with 0 substeps (dormant ones) are left out.
+    """
+    allSteps = np.unique(nsteps)
+    if len(allSteps) == 1 and allSteps[0] > 0:
+        yield int(allSteps[0]), slice(None)
+        return
+    for nstep in allSteps[allSteps > 0]:
+        yield int(nstep), nsteps == nstep
+
+
 def makeX_diab_ehren(H):
     """
     Will make the diabatic X matrix
@@ -84,234 +218,541 @@ def do_diab_prop(ctmqc_env):
     """
     Will propagate the coefficients in the diabatic basis (without the
     diabatic NACE)  
+
+    All replicas with the same number of electronic substeps (see
+    get_elec_steps) are propagated at once, the X matrices have shape
+    (nrep, nstate, nstate). Dormant replicas (see get_dormant_reps) only
+    have their phases evolved.
     
     N.B. Is just Ehrenfest at the moment
     """
-    for irep in range(ctmqc_env['nrep']):
-        H = np.matrix(ctmqc_env['H_tm'][irep])
-        dH_E = get_diffVal(ctmqc_env['H'][irep], H, ctmqc_env)
-        
-        U = np.matrix(ctmqc_env['U_tm'][irep])
-        dU_E = get_diffVal(ctmqc_env['U'][irep], U, ctmqc_env)
-
-        QM = ctmqc_env['Qlk_tm'][irep]
-        dQM_E = get_diffVal(ctmqc_env['Qlk'][irep], QM, ctmqc_env)
-
-        f = ctmqc_env['adMom_tm'][irep]
-        df_E = get_diffVal(ctmqc_env['adMom'][irep], f, ctmqc_env)
-        
-        adPops = np.conjugate(ctmqc_env['C'][irep]) * ctmqc_env['C'][irep]
-        doQM = ctmqc_env['do_QM_C']
-        
-        X1 = makeX_diab_ehren(H)
-        if doQM: X1 -= makeX_diab_QM(QM, f, U, adPops)
-        for Estep in range(ctmqc_env['elec_steps']):
-            H += 0.5 * dH_E
-            U += 0.5 * dU_E
-            QM += 0.5 * dQM_E
-            f += 0.5 * df_E
-            X12 = makeX_diab_ehren(H)
-            if doQM: X12 -= makeX_diab_QM(QM, f, U, adPops)
-
+    nsteps = get_elec_steps(ctmqc_env, 'diab')
+    dormant = get_dormant_reps(ctmqc_env, 'diab')
+    nsteps[dormant] = 0
+    ctmqc_env['elec_steps_used'] = nsteps
+    do_dormant_prop(ctmqc_env, dormant, 'diab')
+    if ctmqc_env.get('backend', 'numpy') == 'numba' and \
+       get_integrator(ctmqc_env) == 'rk4':
+        import numba_kernels as nbK
+        nbK.diab_prop(ctmqc_env['u'], ctmqc_env['C'], ctmqc_env['H_tm'],
+                      ctmqc_env['H'], ctmqc_env['U_tm'], ctmqc_env['U'],
+                      ctmqc_env['Qlk_tm'], ctmqc_env['Qlk'],
+                      ctmqc_env['adMom_tm'], ctmqc_env['adMom'],
+                      ctmqc_env['dt'], nsteps, bool(ctmqc_env['do_QM_C']))
+        return
+
+    for nstep, reps in group_reps(nsteps):
+        ctmqc_env['u'][reps] = __diab_prop_reps(ctmqc_env, reps, nstep)
+
+
+def __diab_prop_reps(ctmqc_env, reps, nstep):
+    """
+    Will propagate the diabatic coefficients of the replicas reps with nstep
+    electronic substeps and return them.
+    """
+    H = np.array(ctmqc_env['H_tm'][reps])
+    dH_E = get_diffVal(ctmqc_env['H'][reps], H, ctmqc_env, nstep)
+
+    U = np.array(ctmqc_env['U_tm'][reps])
+    dU_E = get_diffVal(ctmqc_env['U'][reps], U, ctmqc_env, nstep)
+
+    QM = np.array(ctmqc_env['Qlk_tm'][reps])
+    dQM_E = get_diffVal(ctmqc_env['Qlk'][reps], QM, ctmqc_env, nstep)
+
+    f = np.array(ctmqc_env['adMom_tm'][reps])
+    df_E = get_diffVal(ctmqc_env['adMom'][reps], f, ctmqc_env, nstep)
+
+    u = np.array(ctmqc_env['u'][reps])
+    C = ctmqc_env['C'][reps]
+    adPops = (np.conjugate(C) * C).real
+    doQM = ctmqc_env['do_QM_C']
+    integrator = get_integrator(ctmqc_env)
+    dTe = ctmqc_env['dt'] / float(nstep)
+
+    X1 = makeX_diab_ehren(H)
+    if doQM: X1 -= makeX_diab_QM(QM, f, U, adPops, ctmqc_env)
+    for Estep in range(nstep):
+        H += 0.5 * dH_E
+        U += 0.5 * dU_E
+        QM += 0.5 * dQM_E
+        f += 0.5 * df_E
+        X12 = makeX_diab_ehren(H)
+        if doQM: X12 -= makeX_diab_QM(QM, f, U, adPops, ctmqc_env)
+
+        H += 0.5 * dH_E
+        U += 0.5 * dU_E
+        QM += 0.5 * dQM_E
+        f += 0.5 * df_E
+        if integrator == 'magnus4':
             X2 = makeX_diab_ehren(H)
-            if doQM: X2 -= makeX_diab_QM(QM, f, U, adPops)
+            if doQM: X2 -= makeX_diab_QM(QM, f, U, adPops, ctmqc_env)
+        else:
+            # The RK4 propagator has always used the mid-point X for the end
+            #  of the substep.
+            X2 = X12
 
-            H += 0.5 * dH_E
-            U += 0.5 * dU_E
-            QM += 0.5 * dQM_E
-            f += 0.5 * df_E
-            ctmqc_env['u'][irep] = __RK4(ctmqc_env['u'][irep], X1.A, X12.A,
-                                         X2.A, ctmqc_env)
+        u = __elec_step(u, X1, X12, X2, dTe, ctmqc_env)
 
-            C = np.matmul(np.array(U.T), ctmqc_env['u'][irep])
-            adPops = np.conjugate(C) * C
+        C = np.einsum('...ji,...j->...i', U, u)
+        adPops = (np.conjugate(C) * C).real
 
-            X1 = X2[:]
-        
-        lin_interp_check(ctmqc_env['H'][irep], H, "Hamiltonian")
-        lin_interp_check(ctmqc_env['adMom'][irep], f, "Adiabatic Momentum")
-        lin_interp_check(ctmqc_env['Qlk'][irep], QM, "Quantum Momentum")
-#        lin_interp_check(ctmqc_env['U'][irep], U, "Quantum Momentum")
+        X1 = X2
 
+    lin_interp_check(ctmqc_env['H'][reps], H, "Hamiltonian", ctmqc_env)
+    lin_interp_check(ctmqc_env['adMom'][reps], f, "Adiabatic Momentum",
+                     ctmqc_env)
+    lin_interp_check(ctmqc_env['Qlk'][reps], QM, "Quantum Momentum",
+                     ctmqc_env)
+    return u
 
-def makeX_diab_QM(Qlk, f, U, adPops):
+
+def makeX_diab_QM(Qlk, f, U, adPops, ctmqc_env=False):
     """
     Will make the diabatic X matrix for the full quantum momentum propagation.
+    Qlk has shape (..., ndim, nstate, nstate) and f (..., ndim, nstate) so
+    this can be done for all replicas at once.
     
     N.B. only give Ehrenfest atm
     """
-    nstates = len(adPops)
-    Xqm = np.zeros((nstates, nstates), dtype=complex)
+    Xqm = calc_Xqm_diag(Qlk, f, adPops, ctmqc_env)
+    return np.einsum('...il,...l,...jl->...ij', U, Xqm, U)
 
-    # make X
-    for l in range(nstates):
 
-        for k in range(nstates):
-            Xqm[l, l] += Qlk[l, k] * (f[k] - f[l]) * adPops[k]
-    
+def calc_Xqm_diag(Qlk, f, adPops, ctmqc_env=False):
+    """
+    Will calculate the diagonal of the (adiabatic) quantum momentum part of X:
+        sum_k sum_d Qlk_d (f_k,d - f_l,d) |C_k|^2
+    for the replicas (leading axes) in Qlk, f and adPops.
+
+    If ctmqc_env is given the norm conservation of the term is checked (see
+    validation.py).
+    """
+    fdiff = f[..., np.newaxis, :] - f[..., :, np.newaxis]
+    Qf = np.sum(Qlk * fdiff, axis=-3)
+    Xqm = np.sum(Qf * adPops[..., np.newaxis, :], axis=-1)
+
     # Check the Xqm term (using norm conservation)
-    if np.sum(Xqm * adPops) > 1e-10:
-        print("\n\nQM: ", Qlk, "\n")
-        print("f: ", f, "\n")
-        print("adPops: ", adPops, "\n")
-        print("Xqm: ", Xqm, "\n")
-        print("Xqm * adPops: ", Xqm * adPops, "\n")
-        raise SystemExit("ERROR: MakeX, sum Xqm != 0")
-    
-    Xqm = np.matmul(U, np.matmul(Xqm, U.T))
-    
+    if ctmqc_env is not False and validation.do_checks(ctmqc_env):
+        normChange = np.max(np.sum(Xqm * adPops, axis=-1), initial=0)
+        validation.record_check(ctmqc_env, "sum Xqm |C|^2 = 0",
+                                normChange <= 1e-10,
+                                "sum Xqm |C|^2 = %.2g" % normChange)
+
     return Xqm
 
 
-def lin_interp_check(oldVal, interpVal, name):
+def lin_interp_check(oldVal, interpVal, name, ctmqc_env):
     """
     Will check if the linear interpolation went well for the named variable
     """
-    if np.max(oldVal) > 1e-13:
-        if abs(np.max(oldVal - interpVal)/np.max(oldVal)) > 1e-5:
-            print("\n\nOld Value = ", oldVal)
-            print("\n\nInterpolated Value = ", interpVal)
-            print("\n\nDifference = ", oldVal - interpVal)
-            print("Quantity = %s" % name)
-            raise SystemExit("Something went wrong with the linear " +
-                                 "interpolation of the %s" % name)
-    
+    if not validation.do_checks(ctmqc_env):
+        return
+    if np.max(oldVal, initial=0) > 1e-13:
+        err = abs(np.max(oldVal - interpVal)/np.max(oldVal))
+        validation.record_check(ctmqc_env,
+                                "linear interpolation of the %s" % name,
+                                err <= 1e-5, "relative error = %.2g" % err)
+
+
+def makeX_adiab_ehren(NACV, vel, E, out=None):
+    """
+    Will make the adiabatic X matrix. NACV has shape (..., ndim, nstate,
+    nstate) and vel (..., ndim) (the coupling is the dot product of the 2) so
+    this can be done for all replicas at once.
+
+    If a complex array is given as out X is written into it.
+    """
+    X = np.einsum('...d,...dlk->...lk', vel, NACV, out=out)
+    if out is None and not np.iscomplexobj(X):
+        X = X.astype(complex)
+    np.negative(X, out=X)
+    for l in range(np.shape(E)[-1]):
+        X[..., l, l] -= 1j * E[..., l]
+    return X
 
 
-def makeX_adiab_ehren(NACV, vel, E):
+def subtract_diag(X, diag):
     """
-    Will make the adiabatic X matrix
+    Will subtract the diagonal matrices with diagonals diag (..., nstate)
+    from the X matrices (..., nstate, nstate) in place.
     """
-    X = (-1j * np.identity(2) * E) - (NACV * vel)
+    for l in range(np.shape(diag)[-1]):
+        X[..., l, l] -= diag[..., l]
     return X
 
 
 def do_adiab_prop(ctmqc_env):
     """
     Will actually carry out the propagation of the coefficients
-    """
-    for irep in range(ctmqc_env['nrep']):
-        v = ctmqc_env['vel_tm'][irep]
-        dv_E = get_diffVal(ctmqc_env['vel'][irep], v, ctmqc_env)
 
-        E = ctmqc_env['E_tm'][irep]
-        dE_E = get_diffVal(ctmqc_env['E'][irep], E, ctmqc_env)
+    All replicas with the same number of electronic substeps (see
+    get_elec_steps) are propagated at once, the X matrices have shape
+    (nrep, nstate, nstate). Dormant replicas (see get_dormant_reps) only
+    have their phases evolved.
+    """
+    nsteps = get_elec_steps(ctmqc_env, 'adiab')
+    dormant = get_dormant_reps(ctmqc_env, 'adiab')
+    nsteps[dormant] = 0
+    ctmqc_env['elec_steps_used'] = nsteps
+    do_dormant_prop(ctmqc_env, dormant, 'adiab')
+    coupling = get_coupling(ctmqc_env)
+    if ctmqc_env.get('backend', 'numpy') == 'numba' and \
+       get_integrator(ctmqc_env) == 'rk4' and \
+       not ctmqc_env.get('interaction_picture', False):
+        import numba_kernels as nbK
+        NACV_tm, NACV, v_tm, v = coupling
+        nbK.adiab_prop(ctmqc_env['C'], ctmqc_env['E_tm'], ctmqc_env['E'],
+                       NACV_tm, NACV, v_tm, v,
+                       ctmqc_env['Qlk_tm'], ctmqc_env['Qlk'],
+                       ctmqc_env['adMom_tm'], ctmqc_env['adMom'],
+                       ctmqc_env['dt'], nsteps, bool(ctmqc_env['do_QM_C']))
+        return
+
+    for nstep, reps in group_reps(nsteps):
+        ctmqc_env['C'][reps] = __adiab_prop_reps(ctmqc_env, reps, nstep,
+                                                 coupling)
+
+
+def get_coupling(ctmqc_env):
+    """
+    Will get the arrays the coupling term (NACV . v) of the adiabatic X is
+    interpolated from, as (NACV_tm, NACV, vel_tm, vel).
 
-        NACV = ctmqc_env['NACV_tm'][irep]
-        dNACV_E = get_diffVal(ctmqc_env['NACV'][irep], NACV, ctmqc_env)
+    If the 'tdc_overlap' setting is True the time-derivative coupling from
+    the overlap of the adiabatic states (see calc_tdc_overlap) is used
+    instead. It is returned as a 1D NACV (with a velocity of 1) that is
+    constant over the step, so the same propagators can use it.
+    """
+    if not ctmqc_env.get('tdc_overlap', False):
+        return (ctmqc_env['NACV_tm'], ctmqc_env['NACV'],
+                ctmqc_env['vel_tm'], ctmqc_env['vel'])
 
-        QM = ctmqc_env['Qlk_tm'][irep]
-        dQM_E = get_diffVal(ctmqc_env['Qlk'][irep], QM, ctmqc_env)
+    sigma = calc_tdc_overlap(ctmqc_env)[:, np.newaxis]
+    sigma = sigma.astype(ctmqc_env['NACV'].dtype)
+    ones = np.ones((len(sigma), 1))
+    return sigma, sigma, ones, ones
 
-        f = ctmqc_env['adMom_tm'][irep]
-        df_E = get_diffVal(ctmqc_env['adMom'][irep], f, ctmqc_env)
-        
-        
-        adPops = np.conjugate(ctmqc_env['C'][irep]) * ctmqc_env['C'][irep]
-        doQM = ctmqc_env['do_QM_C']
 
-        X1 = makeX_adiab_ehren(NACV, v, E)
-        if doQM: X1 -= makeX_adiab_Qlk(QM, f, adPops)
-        for Estep in range(ctmqc_env['elec_steps']):
-            E += 0.5 * dE_E
-            NACV += 0.5 * dNACV_E
-            v += 0.5 * dv_E
-            X12 = makeX_adiab_ehren(NACV, v, E)
+def calc_tdc_overlap(ctmqc_env):
+    """
+    Will calculate the time-derivative coupling, sigma_lk = <phi_l | d phi_k
+    / dt>, at the middle of the nuclear step from the overlap of the adiabatic
+    states at its start and end:
+        T = U_tm^dagger U
+        sigma = (T - T^dagger) / (2 dt)
+    This is NACV . v without needing the NACV (or any Hamiltonian
+    evaluations). The result has shape (nrep, nstate, nstate).
+    """
+    T = np.einsum('...ji,...jk->...ik', np.conjugate(ctmqc_env['U_tm']),
+                  ctmqc_env['U'])
+    Tdag = np.conjugate(np.swapaxes(T, -1, -2))
+    return (T - Tdag) / (2 * ctmqc_env['dt'])
 
-            E = E + 0.5 * dE_E
-            NACV = NACV + 0.5 * dNACV_E
-            v = v + 0.5 * dv_E
-            X2 = makeX_adiab_ehren(NACV, v, E)
-            if doQM:
-                QM += 0.5 * dQM_E
-                f += 0.5 * df_E
-                X12 -= makeX_adiab_Qlk(QM, f, adPops)
-                
-                QM += 0.5 * dQM_E
-                f += 0.5 * df_E
-                X2 -= makeX_adiab_Qlk(QM, f, adPops)
 
-            coeff = __RK4(ctmqc_env['C'][irep], X1, X12, X2,
-                          ctmqc_env)
-            ctmqc_env['C'][irep] = coeff
+def __adiab_prop_reps(ctmqc_env, reps, nstep, coupling):
+    """
+    Will propagate the adiabatic coefficients of the replicas reps with nstep
+    electronic substeps and return them. coupling holds the
+    (NACV_tm, NACV, vel_tm, vel) arrays (see get_coupling).
 
-            X1 = X2[:]
-        
-#        lin_interp_check(ctmqc_env['H'][irep], H, "Hamiltonian")
-        lin_interp_check(ctmqc_env['NACV'][irep], NACV, "NACV")
-        lin_interp_check(ctmqc_env['E'][irep], E, "Energy")
-        lin_interp_check(ctmqc_env['vel'][irep], v, "Velocity")
+    If the 'interaction_picture' setting is True the dynamical phases are
+    factored out (see to_interaction_picture) and only the coupling terms
+    are integrated numerically.
+    """
+    NACV_tm, NACV_end, v_tm, v_end = coupling
+    v = np.array(v_tm[reps])
+    dv_E = get_diffVal(v_end[reps], v, ctmqc_env, nstep)
+
+    E = np.array(ctmqc_env['E_tm'][reps])
+    dE_E = get_diffVal(ctmqc_env['E'][reps], E, ctmqc_env, nstep)
+
+    NACV = np.array(NACV_tm[reps])
+    dNACV_E = get_diffVal(NACV_end[reps], NACV, ctmqc_env, nstep)
+
+    QM = np.array(ctmqc_env['Qlk_tm'][reps])
+    dQM_E = get_diffVal(ctmqc_env['Qlk'][reps], QM, ctmqc_env, nstep)
+
+    f = np.array(ctmqc_env['adMom_tm'][reps])
+    df_E = get_diffVal(ctmqc_env['adMom'][reps], f, ctmqc_env, nstep)
+
+    C = np.array(ctmqc_env['C'][reps])
+    adPops = (np.conjugate(C) * C).real
+    doQM = ctmqc_env['do_QM_C']
+    dTe = ctmqc_env['dt'] / float(nstep)
+    interaction = ctmqc_env.get('interaction_picture', False)
+    theta = np.zeros(np.shape(E))
+
+    # The X matrices are written into persistent work arrays, X1 and X2 are
+    #  swapped after each substep.
+    Xshape = np.shape(E) + np.shape(E)[-1:]
+    X1, X12, X2 = [wSpace.get_buffer(ctmqc_env, name, Xshape, complex)
+                   for name in ('adiab X1', 'adiab X12', 'adiab X2')]
+    X1 = makeX_adiab_ehren(NACV, v, E, out=X1)
+    if doQM: subtract_diag(X1, calc_Xqm_diag(QM, f, adPops, ctmqc_env))
+    if interaction: X1 = to_interaction_picture(X1, E, theta)
+    for Estep in range(nstep):
+        E += 0.5 * dE_E
+        NACV += 0.5 * dNACV_E
+        v += 0.5 * dv_E
+        X12 = makeX_adiab_ehren(NACV, v, E, out=X12)
+
+        E += 0.5 * dE_E
+        NACV += 0.5 * dNACV_E
+        v += 0.5 * dv_E
+        X2 = makeX_adiab_ehren(NACV, v, E, out=X2)
         if doQM:
-           lin_interp_check(ctmqc_env['adMom'][irep], f, "Adiabatic Momentum")
-           lin_interp_check(ctmqc_env['Qlk'][irep], QM, "Quantum Momentum")
-#        print("VARS")
-#        print("----")
-#        print("iter = ", ctmqc_env['iter'])
-#        print("----")
-#        print("Vel = ", v)
-#        print("dv = ", dv_E)
-#        print("----")
-#        print("E = ", E)
-#        print("dE = ", dE_E)
-#        print("----")
-#        print("dlk = ", NACV)
-#        print("d_dlk = ", dNACV_E)
-#        print("----")
-#        print("H = ", ctmqc_env['H'][irep])
-#        print("----")
-#        print("|C|^2 = ", np.conjugate(ctmqc_env['C'][irep]) * ctmqc_env['C'][irep])
-#        print("----")
-#        print("Qlk_t = ", QM[0, 1])
-#        print("Qlk_tp = ", ctmqc_env['Qlk'][irep][0, 1])
-#        print("dQlk = ", dQM_E)
-#        print("----")
-#        print("f_t = ", f)
-#        print("f_tp = ", ctmqc_env['adMom'][irep])
-#        print("df = ", df_E)
-#        print("END VARS")
-#        raise SystemExit("BREAK")
-#    raise SystemExit("BREAK")
-
-def makeX_adiab_Qlk(Qlk, f, adPops):
-    """
-    Will make the adiabatic X matrix with Qlk
-    """
-    nstates = len(adPops)
-    Xqm = np.zeros((nstates, nstates), dtype=complex)
-
-    # make X
-    for l in range(nstates):
-
-        for k in range(nstates):
-            Xqm[l, l] += Qlk[l, k] * (f[k] - f[l]) * adPops[k]
-    
-    # Check the Xqm term (using norm conservation)
-    if np.sum(Xqm * adPops) > 1e-10:
-        print("\n\nQM: ", Qlk, "\n")
-        print("f: ", f, "\n")
-        print("adPops: ", adPops, "\n")
-        print("Xqm: ", Xqm, "\n")
-        print("Xqm * adPops: ", Xqm * adPops, "\n")
-        raise SystemExit("ERROR: MakeX, sum Xqm != 0")
-    
-    return Xqm
+            QM += 0.5 * dQM_E
+            f += 0.5 * df_E
+            subtract_diag(X12, calc_Xqm_diag(QM, f, adPops, ctmqc_env))
+
+            QM += 0.5 * dQM_E
+            f += 0.5 * df_E
+            subtract_diag(X2, calc_Xqm_diag(QM, f, adPops, ctmqc_env))
+
+        if interaction:
+            # The phases are exact integrals of the linearly interpolated E
+            thetaMid = theta + (0.5 * dTe * (E - 0.75*dE_E))
+            theta = theta + (dTe * (E - 0.5*dE_E))
+            X12 = to_interaction_picture(X12, E - 0.5*dE_E, thetaMid)
+            X2 = to_interaction_picture(X2, E, theta)
+
+        C = __elec_step(C, X1, X12, X2, dTe, ctmqc_env)
+
+        X1, X2 = X2, X1
+    if interaction:
+        C = C * np.exp(-1j * theta)
+
+    lin_interp_check(NACV_end[reps], NACV, "NACV", ctmqc_env)
+    lin_interp_check(ctmqc_env['E'][reps], E, "Energy", ctmqc_env)
+    lin_interp_check(v_end[reps], v, "Velocity", ctmqc_env)
+    if doQM:
+       lin_interp_check(ctmqc_env['adMom'][reps], f, "Adiabatic Momentum",
+                        ctmqc_env)
+       lin_interp_check(ctmqc_env['Qlk'][reps], QM, "Quantum Momentum",
+                        ctmqc_env)
+    return C
 
 
-def __RK4(coeff, X1, X12, X2, ctmqc_env):
+def do_local_diab_prop(ctmqc_env):
     """
-    Will carry out the RK4 algorithm to propagate the coefficients
+    Will propagate the adiabatic coefficients with local diabatization, using
+    the overlap of the adiabatic states at the start and end of the step:
+        T = U_tm^dagger U    (T_lk = <phi_l(t) | phi_k(t + dt)>)
+    instead of the NACV.
+
+    The adiabatic states at the start of the step are used as a (locally
+    diabatic) basis for the whole step. In it X goes linearly from
+        X(t) = -i E(t) - Xqm(t)
+    to
+        X(t + dt) = T (-i E(t + dt) - Xqm(t + dt)) T^dagger
+    and the coefficients are propagated with exponential (Magnus) substeps.
+    At the end they are transformed to the new adiabatic states:
+        C(t + dt) = T^dagger C_ld(t + dt)
+
+    As there is no NACV or velocity interpolation this is stable across
+    trivial crossings and with large nuclear steps.
     """
-    dTe = ctmqc_env['dt'] / float(ctmqc_env['elec_steps'])
-    coeff = np.array(coeff)
+    nsteps = get_elec_steps(ctmqc_env, 'adiab')
+    dormant = get_dormant_reps(ctmqc_env, 'adiab')
+    nsteps[dormant] = 0
+    ctmqc_env['elec_steps_used'] = nsteps
+    do_dormant_prop(ctmqc_env, dormant, 'adiab')
 
-    K1 = np.array(dTe * np.matmul(X1, coeff))
-    K2 = np.array(dTe * np.matmul(X12, coeff + K1/2.))
-    K3 = np.array(dTe * np.matmul(X12, coeff + K2/2.))
-    K4 = np.array(dTe * np.matmul(X2, coeff + K3))
+    for nstep, reps in group_reps(nsteps):
+        ctmqc_env['C'][reps] = __local_diab_prop_reps(ctmqc_env, reps, nstep)
 
-    Ktot = (1./6.) * (K1 + (2.*K2) + (2.*K3) + K4)
-#    print(Ktot, "\n")
-    coeff = coeff + Ktot
+
+def __local_diab_prop_reps(ctmqc_env, reps, nstep):
+    """
+    Will propagate the adiabatic coefficients of the replicas reps with nstep
+    locally diabatic substeps and return them (see do_local_diab_prop).
+    """
+    T = np.einsum('...ji,...jk->...ik', np.conjugate(ctmqc_env['U_tm'][reps]),
+                  ctmqc_env['U'][reps])
+    if validation.do_checks(ctmqc_env):
+        TdagT = np.einsum('...ji,...jk->...ik', np.conjugate(T), T)
+        err = np.max(np.abs(TdagT - np.identity(np.shape(T)[-1])), initial=0)
+        validation.record_check(ctmqc_env, "overlap matrix unitary",
+                                err <= 1e-8, "max |T^dag T - I| = %.2g" % err)
+
+    C = np.array(ctmqc_env['C'][reps])
+    adPops = (np.conjugate(C) * C).real
+    ident = np.identity(np.shape(C)[-1])
+    X0 = -1j * ident * ctmqc_env['E_tm'][reps][..., np.newaxis, :]
+    X1 = -1j * ident * ctmqc_env['E'][reps][..., np.newaxis, :]
+    if ctmqc_env['do_QM_C']:
+        X0 -= makeX_adiab_Qlk(ctmqc_env['Qlk_tm'][reps],
+                              ctmqc_env['adMom_tm'][reps], adPops, ctmqc_env)
+        X1 -= makeX_adiab_Qlk(ctmqc_env['Qlk'][reps],
+                              ctmqc_env['adMom'][reps], adPops, ctmqc_env)
+    X1 = np.einsum('...ij,...jk,...lk->...il', T, X1, np.conjugate(T))
+
+    dTe = ctmqc_env['dt'] / float(nstep)
+    dX_E = get_diffVal(X1, X0, ctmqc_env, nstep)
+    for Estep in range(nstep):
+        Xa = X0 + (Estep * dX_E)
+        Xm = Xa + (0.5 * dX_E)
+        if get_integrator(ctmqc_env) == 'magnus':
+            C = __magnus(C, Xm, dTe)
+        else:
+            C = __magnus4(C, Xa, Xm, Xa + dX_E, dTe)
+
+    return np.einsum('...ji,...j->...i', np.conjugate(T), C)
+
+
+def to_interaction_picture(X, E, theta):
+    """
+    Will transform an adiabatic X matrix to the interaction picture, where
+    the coefficients are c_l = C_l exp(i theta_l) and theta_l is the phase
+    accumulated since the start of the step (int E_l dt). The -i E part of X
+    is removed and the rest picks up the phase differences:
+        Y_lk = (X_lk + i E_l delta_lk) exp(i (theta_l - theta_k))
+    """
+    Y = X + (1j * np.identity(np.shape(E)[-1]) * E[..., np.newaxis, :])
+    phase = np.exp(1j * theta)
+    return (Y * phase[..., :, np.newaxis]
+            * np.conjugate(phase)[..., np.newaxis, :])
+
+
+def makeX_adiab_Qlk(Qlk, f, adPops, ctmqc_env=False):
+    """
+    Will make the adiabatic X matrix with Qlk. Qlk has shape
+    (..., ndim, nstate, nstate) and f (..., ndim, nstate) so this can be done
+    for all replicas at once.
+    """
+    Xqm = calc_Xqm_diag(Qlk, f, adPops, ctmqc_env)
+    return np.identity(np.shape(Xqm)[-1]) * Xqm[..., np.newaxis, :]
+
+
+def get_integrator(ctmqc_env):
+    """
+    Will return which integrator ('rk4', 'magnus' or 'magnus4') should be used
+    for the electronic substeps.
+    """
+    return ctmqc_env.get('elec_integrator', 'rk4').lower()
+
+
+def __elec_step(coeff, X1, X12, X2, dTe, ctmqc_env):
+    """
+    Will propagate the coefficients over 1 electronic substep (of length dTe)
+    with the chosen integrator. X1, X12 and X2 are the X matrices at the
+    start, middle and end of the substep.
+    """
+    integrator = get_integrator(ctmqc_env)
+    if integrator == 'magnus':
+        return __magnus(coeff, X12, dTe)
+    elif integrator == 'magnus4':
+        return __magnus4(coeff, X1, X12, X2, dTe)
+    return __RK4(coeff, X1, X12, X2, ctmqc_env, dTe)
+
+
+def expm_2x2(A):
+    """
+    Will calculate the matrix exponential of a stack of 2x2 matrices (shape
+    (..., 2, 2)) with the closed form:
+        exp(A) = exp(a) [cosh(s) I + sinh(s)/s (A - a I)]
+    where a = tr(A)/2 and s^2 = -det(A - a I).
+    """
+    A = np.asarray(A, dtype=complex)
+    a = 0.5 * (A[..., 0, 0] + A[..., 1, 1])
+    b = 0.5 * (A[..., 0, 0] - A[..., 1, 1])
+    s = np.sqrt(b**2 + A[..., 0, 1]*A[..., 1, 0])
+
+    # Use the series of sinh(s)/s near s = 0 to avoid 0/0
+    small = np.abs(s) < 1e-4
+    sNZ = np.where(small, 1.0, s)
+    sinhc = np.where(small, 1 + s**2/6. + s**4/120., np.sinh(sNZ)/sNZ)
+    cosh = np.cosh(s)
+
+    expA = np.empty(np.shape(A), dtype=complex)
+    expA[..., 0, 0] = cosh + sinhc*b
+    expA[..., 1, 1] = cosh - sinhc*b
+    expA[..., 0, 1] = sinhc*A[..., 0, 1]
+    expA[..., 1, 0] = sinhc*A[..., 1, 0]
+    return np.exp(a)[..., np.newaxis, np.newaxis] * expA
+
+
+def __magnus(coeff, X12, dTe):
+    """
+    Will carry out a second order Magnus (exponential mid-point) step:
+        C(t + dt) = exp(dt X(t + dt/2)) C(t)
+    Without the quantum momentum term X is anti-Hermitian so this conserves
+    the norm exactly.
+    """
+    return __apply_expm(dTe * X12, coeff)
+
+
+def __magnus4(coeff, X1, X12, X2, dTe):
+    """
+    Will carry out a fourth order Magnus step with the 2 point Gauss-Legendre
+    rule:
+        Omega = dt/2 (A1 + A2) + sqrt(3)/12 dt^2 [A2, A1]
+        C(t + dt) = exp(Omega) C(t)
+    A1 and A2 are X at the Gauss points, found from the quadratic through the
+    X at the start, middle and end of the substep (the Ehrenfest and quantum
+    momentum terms are at most quadratic in the interpolation).
+    """
+    A = []
+    for tau in (0.5 - np.sqrt(3)/6., 0.5 + np.sqrt(3)/6.):
+        A.append((X1 * ((2*tau - 1) * (tau - 1)))
+                 + (X12 * (4 * tau * (1 - tau)))
+                 + (X2 * (tau * (2*tau - 1))))
+    A1, A2 = A
+
+    comm = np.matmul(A2, A1) - np.matmul(A1, A2)
+    Omega = (0.5 * dTe * (A1 + A2)) + ((np.sqrt(3)/12.) * dTe**2 * comm)
+    return __apply_expm(Omega, coeff)
+
+
+def __apply_expm(Omega, coeff):
+    """
+    Will calculate exp(Omega) coeff. 2 state systems use the closed form
+    exponential, others use scipy.
+    """
+    if np.shape(Omega)[-1] == 2:
+        expOmega = expm_2x2(Omega)
+    else:
+        from scipy.linalg import expm
+        expOmega = expm(Omega)
+    return np.einsum('...ij,...j->...i', expOmega, coeff)
+
+
+def __RK4(coeff, X1, X12, X2, ctmqc_env, dTe=False):
+    """
+    Will carry out the RK4 algorithm to propagate the coefficients. coeff can
+    have shape (nrep, nstate) with X matrices of shape (nrep, nstate, nstate)
+    to propagate all replicas at once.
+
+    The coefficients are updated in place (and returned), the Ks are kept in
+    persistent work arrays.
+    """
+    if dTe is False:
+        dTe = ctmqc_env['dt'] / float(ctmqc_env['elec_steps'])
+
+    # Each K is written into the same work array (and added to Ktot)
+    shape, dtype = np.shape(coeff), np.result_type(coeff, X1)
+    if coeff.dtype != dtype:
+        coeff = coeff.astype(dtype)
+    K = wSpace.get_buffer(ctmqc_env, 'RK4 K', shape, dtype)
+    Ktot = wSpace.get_buffer(ctmqc_env, 'RK4 Ktot', shape, dtype)
+    tmp = wSpace.get_buffer(ctmqc_env, 'RK4 tmp', shape, dtype)
+
+    np.einsum('...ij,...j->...i', X1, coeff, out=K)
+    K *= dTe
+    Ktot[...] = K
+    for X, Kfact, Kweight in ((X12, 0.5, 2.), (X12, 0.5, 2.), (X2, 1., 1.)):
+        np.multiply(K, Kfact, out=tmp)
+        tmp += coeff
+        np.einsum('...ij,...j->...i', X, tmp, out=K)
+        K *= dTe
+        if Kweight != 1.:
+            np.multiply(K, Kweight, out=tmp)
+            Ktot += tmp
+        else:
+            Ktot += K
+
+    Ktot *= 1./6.
+    coeff += Ktot
 
     return coeff
 
@@ -351,7 +792,7 @@ def do_adiab_prop_ehren(ctmqc_env):
     Will actually carry out the propagation of the coefficients
     """
     for irep in range(ctmqc_env['nrep']):
-        v = ctmqc_env['vel_tm'][irep]
+        v = np.array(ctmqc_env['vel_tm'][irep])
         dv_E = get_diffVal(ctmqc_env['vel'][irep], v, ctmqc_env)
 
         E = ctmqc_env['E_tm'][irep]
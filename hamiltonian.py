@@ -9,138 +9,490 @@ Created on Thu May  9 14:41:34 2019
 
 import numpy as np
 
+import validation
+import workspace as wSpace
+
+
+def make_2state_H(V11, V12, V22):
+    """
+    Will stack the diabatic matrix elements into an array of Hamiltonians.
+
+    Inputs:
+        * V11, V12, V22 => the diabatic matrix elements, either scalars or
+                           arrays of shape (nrep,)
+    Outputs:
+        * H => the Hamiltonians as an array of shape (nrep, 2, 2) (or (2, 2)
+               if all the elements are scalars)
+    """
+    V11, V12, V22 = np.broadcast_arrays(V11, V12, V22)
+    H = np.empty(np.shape(V11) + (2, 2))
+    H[..., 0, 0] = V11
+    H[..., 0, 1] = V12
+    H[..., 1, 0] = V12
+    H[..., 1, 1] = V22
+    return H
+
 
 def create_H1(x, A=0.03, B=0.4, C=0.005, D=0.3):
     """
-    Will create the Hamiltonian in Tully Model 1
+    Will create the Hamiltonian in Tully Model 1 for all positions in x
     """
+    x = np.asarray(x, dtype=np.float64)
     V11 = A*np.tanh(B*x)
 
     V22 = -V11
 
     V12 = C * np.exp(-D*(x**2))
 
-    return np.matrix([[V11, V12], [V12, V22]])
+    return make_2state_H(V11, V12, V22)
+
+
+def create_dH1(x, A=0.03, B=0.4, C=0.005, D=0.3):
+    """
+    Will create the analytic gradient (dH/dx) of Tully Model 1
+    """
+    x = np.asarray(x, dtype=np.float64)
+    dV11 = A*B*(1 - np.tanh(B*x)**2)
+
+    dV22 = -dV11
+
+    dV12 = -2*D*x * C * np.exp(-D*(x**2))
+
+    return make_2state_H(dV11, dV12, dV22)
 
 
 def create_H2(x, A=0.1, B=0.28, C=0.015, D=0.06, E0=0.05):
     """
-    Will create the Hamiltonian in Tully Model 2
+    Will create the Hamiltonian in Tully Model 2 for all positions in x
     """
+    x = np.asarray(x, dtype=np.float64)
     V11 = 0
     V22 = -A * np.exp(-B*(x**2)) + E0
     V12 = C*np.exp(-D*(x**2))
 
-    return np.matrix([[V11, V12], [V12, V22]])
+    return make_2state_H(V11, V12, V22)
+
+
+def create_dH2(x, A=0.1, B=0.28, C=0.015, D=0.06, E0=0.05):
+    """
+    Will create the analytic gradient (dH/dx) of Tully Model 2
+    """
+    x = np.asarray(x, dtype=np.float64)
+    dV11 = 0
+    dV22 = 2*A*B*x * np.exp(-B*(x**2))
+    dV12 = -2*C*D*x * np.exp(-D*(x**2))
+
+    return make_2state_H(dV11, dV12, dV22)
 
 
 def create_H3(x, A=6e-4, B=0.1, C=0.9):
     """
-    Will create the Hamiltonian in Tully Model 3
+    Will create the Hamiltonian in Tully Model 3 for all positions in x.
+
+    The exponent is always negative so neither branch can overflow.
     """
+    x = np.asarray(x, dtype=np.float64)
     V11 = A
-    if x <= 0:
-        V12 = B*np.exp(C*x)
-    else:
-        V12 = B*(2-np.exp(-C*x))
+    expo = np.exp(-C*np.abs(x))
+    V12 = np.where(x <= 0, B*expo, B*(2-expo))
     V22 = -V11
-#    print(np.matrix([[V11, V12], [V12, V22]]))
-    return np.matrix([[V11, V12], [V12, V22]])
+    return make_2state_H(V11, V12, V22)
+
+
+def create_dH3(x, A=6e-4, B=0.1, C=0.9):
+    """
+    Will create the analytic gradient (dH/dx) of Tully Model 3. Both branches
+    of the coupling have the same gradient, B*C*exp(-C|x|).
+    """
+    x = np.asarray(x, dtype=np.float64)
+    dV12 = B*C*np.exp(-C*np.abs(x))
+    return make_2state_H(0, dV12, 0)
 
 
 def create_H4(x, A=6e-4, B=0.1, C=0.9, D=4):
     """
-    Will create the Hamiltonian in Tully Model 3
+    Will create the Hamiltonian in Tully Model 4 for all positions in x.
+
+    Each branch is evaluated on positions clipped to its own region so the
+    unused branches can't overflow.
     """
+    x = np.asarray(x, dtype=np.float64)
     V11 = A
     V22 = -V11
-    if x <= -D:
-        V12 = B * (-np.exp(C *(x-D)) + np.exp(C *(x+D)))
-    elif x >= D:
-        V12 = B * (np.exp(-C *(x-D)) - np.exp(-C *(x+D)))
-    else:
-        V12 = B * (2 - np.exp(C *(x-D)) - np.exp(-C *(x+D)))
+    xl = np.minimum(x, -D)
+    xr = np.maximum(x, D)
+    xm = np.clip(x, -D, D)
+    V12_l = B * (-np.exp(C *(xl-D)) + np.exp(C *(xl+D)))
+    V12_r = B * (np.exp(-C *(xr-D)) - np.exp(-C *(xr+D)))
+    V12_m = B * (2 - np.exp(C *(xm-D)) - np.exp(-C *(xm+D)))
+    V12 = np.where(x <= -D, V12_l, np.where(x >= D, V12_r, V12_m))
+
+    return make_2state_H(V11, V12, V22)
+
+
+def create_dH4(x, A=6e-4, B=0.1, C=0.9, D=4):
+    """
+    Will create the analytic gradient (dH/dx) of Tully Model 4
+    """
+    x = np.asarray(x, dtype=np.float64)
+    xl = np.minimum(x, -D)
+    xr = np.maximum(x, D)
+    xm = np.clip(x, -D, D)
+    dV12_l = B*C * (-np.exp(C *(xl-D)) + np.exp(C *(xl+D)))
+    dV12_r = B*C * (-np.exp(-C *(xr-D)) + np.exp(-C *(xr+D)))
+    dV12_m = B*C * (-np.exp(C *(xm-D)) + np.exp(-C *(xm+D)))
+    dV12 = np.where(x <= -D, dV12_l, np.where(x >= D, dV12_r, dV12_m))
 
-    return np.matrix([[V11, V12],
-                      [V12, V22]])
+    return make_2state_H(0, dV12, 0)
 
 
 def create_Hlin(x, slope=-0.01, Start=-15, Egap=0.05):
    """
-   Will create a linearly decreasing Hamiltonian with 0 coupling
+   Will create a linearly decreasing Hamiltonian with 0 coupling for all
+   positions in x
    """
+   x = np.asarray(x, dtype=np.float64)
    V11 = slope * (x - Start)
    V22 = Egap + (slope * (x - Start))
-   return np.matrix([[V11, 0],
-                     [0, V22]])
+   return make_2state_H(V11, 0, V22)
+
+
+def create_dHlin(x, slope=-0.01, Start=-15, Egap=0.05):
+   """
+   Will create the analytic gradient (dH/dx) of the linear Hamiltonian
+   """
+   x = np.asarray(x, dtype=np.float64)
+   return make_2state_H(slope + 0*x, 0, slope + 0*x)
+
+
+def eigh_2x2(H):
+    """
+    Will diagonalise a stack of real symmetric 2x2 matrices analytically.
+
+    This avoids calling LAPACK for each replica, which is very slow for such
+    small matrices.
+
+    Inputs:
+        * H => the Hamiltonians with shape (nrep, 2, 2) (or (2, 2))
+    Outputs:
+        * E => the eigenvalues in ascending order with shape (nrep, 2)
+        * U => the eigenvectors (as columns) with shape (nrep, 2, 2)
+
+    The eigenvectors are written in terms of the mixing angle
+    theta = 0.5 * atan2(2 H_12, H_11 - H_22) as:
+        phi_1 = (-sin(theta), cos(theta))
+        phi_2 = (cos(theta), sin(theta))
+    so the sign of each eigenvector changes smoothly with position (unlike
+    np.linalg.eigh which can flip the sign arbitrarily).
+    """
+    H = np.asarray(H)
+    V11, V12, V22 = H[..., 0, 0], H[..., 0, 1], H[..., 1, 1]
+
+    avgV = 0.5 * (V11 + V22)
+    radius = np.hypot(0.5 * (V11 - V22), V12)
+    E = np.stack((avgV - radius, avgV + radius), axis=-1)
+
+    theta = 0.5 * np.arctan2(2 * V12, V11 - V22)
+    cosT, sinT = np.cos(theta), np.sin(theta)
+    U = np.empty(np.shape(H), dtype=np.float64)
+    U[..., 0, 0] = -sinT
+    U[..., 1, 0] = cosT
+    U[..., 0, 1] = cosT
+    U[..., 1, 1] = sinT
+
+    return E, U
 
 
 def getEigProps(H, ctmqc_env):
     """
-    Wrapper function, this really needs taking out it when I have time.
+    Will get the eigenvalues and eigenvectors of all the Hamiltonians in H.
+
+    Real 2 state Hamiltonians are diagonalised analytically, anything else
+    (e.g. the N state models) is passed to the LAPACK solver in one batched
+    call for all replicas. The order and sign of the eigenvectors it returns
+    is arbitrary, they are made consistent by get_state_alignment.
     """
+    if np.shape(H)[-1] == 2 and np.isrealobj(H):
+        return eigh_2x2(H)
     return np.linalg.eigh(H)
 
 
+def get_state_alignment(U, U_ref):
+    """
+    Will find how the eigenvectors in U need to be reordered and have their
+    signs changed to best match the reference eigenvectors U_ref (e.g. those
+    from the previous timestep). The match is judged by the overlap
+    |<phi_l^ref | phi_k>|.
+
+    Inputs:
+        * U     => the eigenvectors (as columns) (nrep, nstate, nstate)
+        * U_ref => the reference eigenvectors (nrep, nstate, nstate)
+    Outputs:
+        * perm  => the new index of each reference state (nrep, nstate)
+        * signs => the sign to multiply each reordered state by (nrep, nstate)
+
+    If the overlaps don't give a unique ordering for a replica its ordering
+    is left as it is.
+    """
+    nstate = np.shape(U)[-1]
+    S = np.einsum('...ji,...jk->...ik', np.conjugate(U_ref), U)
+
+    perm = np.argmax(np.abs(S), axis=-1)
+    isPerm = np.all(np.sort(perm, axis=-1) == np.arange(nstate), axis=-1)
+    perm[~isPerm] = np.arange(nstate)
+
+    overlap = np.take_along_axis(S, perm[..., np.newaxis], axis=-1)[..., 0]
+    signs = np.where(overlap.real < 0, -1.0, 1.0)
+
+    return perm, signs
+
+
+def apply_state_alignment(props, perm, signs):
+    """
+    Will reorder and change the sign of the adiabatic states in the electronic
+    structure properties in props (see get_elec_props and
+    get_state_alignment). The NACV picks up the sign of both states.
+    """
+    props['E'] = _take_states(props['E'], perm, -1)
+    props['adFrc'] = _take_states(props['adFrc'], perm, -1)
+
+    U = _take_states(props['U'], perm, -1)
+    props['U'] = U * _state_axis(signs, U, -1)
+
+    NACV = _take_states(_take_states(props['NACV'], perm, -2), perm, -1)
+    props['NACV'] = NACV * _state_axis(signs, NACV, -2) \
+                         * _state_axis(signs, NACV, -1)
+
+    return props
+
+
+def _state_axis(vals, arr, axis):
+    """
+    Will reshape the per-state values vals (..., nstate) so they broadcast
+    along the state axis (-1 or -2) of arr. Any extra axes in arr (e.g. the
+    nuclear dimensions) between the replica and state axes are broadcast.
+    """
+    nextra = np.ndim(arr) - np.ndim(vals)
+    vals = np.reshape(vals, np.shape(vals)[:-1] + (1,)*nextra
+                            + np.shape(vals)[-1:])
+    if axis == -2:
+        vals = np.swapaxes(vals, -1, -2)
+    return vals
+
+
+def _take_states(arr, perm, axis):
+    """
+    Will reorder the states along the axis (-1 or -2) of arr with perm.
+    """
+    return np.take_along_axis(arr, _state_axis(perm, arr, axis), axis=axis)
+
+
 def calcNACVgradPhi(pos, ctmqc_env):
     """
     Will use a different method to calculate the NACV. This function will
     simply use:
         d = <phil | grad phik>
-        
-    This is slightly more unstable because sometimes the eigen solver sometimes
-    mixes up the order of the eigenvectors/eigenvalues which causes large
-    differences in phi for different pos.
+
+    The eigenvectors at pos + dx are aligned (in order and sign) with those at
+    pos before taking the finite difference, so the eigen solver changing the
+    order or signs of the eigenvectors can't give large spurious differences.
+
+    pos can be a single position or an array of replica positions, in which
+    case an array of NACVs with shape (nrep, nstate, nstate) is returned. The
+    Hamiltonian function should be 1D (e.g. create_H1).
     """
     dx = ctmqc_env['dx']
-#    H_xm = ctmqc_env['Hfunc'](pos - dx)
     H_x = ctmqc_env['Hfunc'](pos)
     H_xp = ctmqc_env['Hfunc'](pos + dx)
-#    nstate = len(H_x)
-
-    allU = [np.linalg.eigh(H)[1]
-            for H in (H_xp, H_x)]
-#            for H in (H_xm, H_x, H_xp)]
-#    gradU = np.gradient(allU, dx, axis=0)
-    gradU = (allU[1] - allU[0]) / dx
-    
-    NACV = np.zeros((2, 2))
-    for l in range(2):
-        for k in range(l):
-#            print((allU[1].A[l], gradU.A[k]))
-            NACV[l, k] = np.dot(allU[1].A[l], gradU.A[k])
-            NACV[k, l] = -NACV[l, k]
-#    print(NACV)
-            
-    # Check the anti-symettry of the NACV
-    badNACV = False
-    for l in range(len(NACV)):
-        for k in range(l+1, len(NACV)):
-            if np.abs(NACV[l, k] + np.conjugate(NACV[k, l])) > 1e-10:
-                badNACV = True
-    
-    if badNACV:
-        print("gradPhi NACV bad switching to gradH")
-        NACV = calcNACVgradH(pos, ctmqc_env)
-        NACV = 0.5*(NACV - NACV.T)
+
+    U_x = getEigProps(H_x, ctmqc_env)[1]
+    U_xp = getEigProps(H_xp, ctmqc_env)[1]
+    perm, signs = get_state_alignment(U_xp, U_x)
+    U_xp = np.take_along_axis(U_xp, perm[..., np.newaxis, :], axis=-1)
+    U_xp = U_xp * signs[..., np.newaxis, :]
+
+    gradU = (U_xp - U_x) / dx
+    NACV = np.einsum('...ji,...jk->...ik', np.conjugate(U_x), gradU)
+
+    # The forward difference isn't exactly anti-symmetric
+    NACV = 0.5*(NACV - np.swapaxes(NACV, -1, -2))
 
     return NACV
 
 
-def calcNACV(irep, ctmqc_env):
+def calc_gradH_adiab(U, dH):
     """
-    If we are using model 2 low momentum then use the gradPhi NACV
+    Will transform the gradient of the Hamiltonian into the adiabatic basis.
+
+    Inputs:
+        * U  => the eigenvectors (as columns) with shape (nrep, nstate, nstate)
+        * dH => the gradient of the Hamiltonian with shape
+                (nrep, ndim, nstate, nstate) (or the same shape as U for a
+                1D gradient without the ndim axis)
+    Outputs:
+        * <phi_l | dH/dx | phi_k> with the same shape as dH
+    """
+    if np.ndim(dH) == np.ndim(U):
+        return np.einsum('...il,...ij,...jk->...lk', np.conjugate(U), dH, U)
+    return np.einsum('...il,...dij,...jk->...dlk', np.conjugate(U), dH, U)
+
+
+def calcNACVanalytic(E, U, dH):
+    """
+    Will calculate the NACV from the analytic gradient of the Hamiltonian via
+    the Hellmann-Feynman theorem:
+        d_lk = <phi_l | dH/dx | phi_k> / (E_k - E_l)
+
+    This only needs the eigenproperties at the current position (no finite
+    differences). Degenerate states are given a NACV of 0.
+    """
+    return calcNACVfromGradH(E, calc_gradH_adiab(U, dH))
+
+
+def calcNACVfromGradH(E, gradH_ad):
+    """
+    Will calculate the NACV from the gradient of the Hamiltonian that has
+    already been transformed to the adiabatic basis (see calc_gradH_adiab).
+    """
+    dE = E[..., np.newaxis, :] - E[..., :, np.newaxis]
+    dE = np.reshape(dE, np.shape(dE)[:-2]
+                        + (1,)*(np.ndim(gradH_ad) - np.ndim(dE))
+                        + np.shape(dE)[-2:])
+    NACV = np.zeros(np.shape(gradH_ad), dtype=gradH_ad.dtype)
+    np.divide(gradH_ad, dE, out=NACV, where=dE != 0)
+    return NACV
+
+
+def calcNACV(irep, ctmqc_env, E=False, U=False, dH=False):
+    """
+    Will calculate the NACV for replica irep (which can be a single replica
+    index or an array of them) from the analytic gradient of the Hamiltonian.
+
+    If the eigenproperties and Hamiltonian gradient have already been
+    calculated at the replica positions they can be passed in to avoid
+    recalculating them.
     """
     pos = ctmqc_env['pos'][irep]
+    if E is False or U is False:
+        E, U = getEigProps(ctmqc_env['Hfunc'](pos), ctmqc_env)
+    if dH is False:
+        dH = ctmqc_env['dHfunc'](pos)
+
+    return calcNACVanalytic(E, U, dH)
+
+
+def count_elec_evals(ctmqc_env, nH=0, ndH=0, nEig=0, nTable=0):
+    """
+    Will add to the running count of electronic structure evaluations (in
+    number of geometries) stored in ctmqc_env['elec_evals']. nTable counts
+    the geometries that were interpolated from a tabulated surface.
+    """
+    if 'elec_evals' not in ctmqc_env:
+        ctmqc_env['elec_evals'] = {'H': 0, 'dH': 0, 'eig': 0, 'table': 0}
+    ctmqc_env['elec_evals']['H'] += nH
+    ctmqc_env['elec_evals']['dH'] += ndH
+    ctmqc_env['elec_evals']['eig'] += nEig
+    ctmqc_env['elec_evals']['table'] += nTable
+
+
+def get_elec_props(pos, ctmqc_env, U_ref=False):
+    """
+    Will calculate the electronic structure properties at the positions pos.
+
+    The Hamiltonian, its gradient and its eigenproperties are evaluated
+    exactly once. The adiabatic forces and the NACV are both derived from the
+    same <phi_l | dH/dx | phi_k> matrix.
+
+    If reference eigenvectors (U_ref) are given the adiabatic states are
+    reordered and have their signs changed to match them (see
+    get_state_alignment).
+
+    Inputs:
+        * pos => the replica positions (nrep, ndim)
+    Outputs:
+        * A dict containing:
+            H     => the diabatic Hamiltonian (nrep, nstate, nstate)
+            dH    => the gradient of the Hamiltonian (nrep, ndim, nstate, nstate)
+            E     => the adiabatic energies (nrep, nstate)
+            U     => the eigenvectors, as columns (nrep, nstate, nstate)
+            adFrc => the adiabatic forces (nrep, ndim, nstate)
+            NACV  => the NACV (nrep, ndim, nstate, nstate)
+    """
+    nrep = len(pos)
+
+    H = ctmqc_env['Hfunc'](pos)
+    dH = ctmqc_env['dHfunc'](pos)
+    count_elec_evals(ctmqc_env, nH=nrep, ndH=nrep, nEig=nrep)
+
+    if ctmqc_env.get('backend', 'numpy') == 'numba' and \
+       np.shape(H)[-1] == 2 and np.isrealobj(H) and np.isrealobj(dH):
+        import numba_kernels as nbK
+        E, U, adFrc, NACV = nbK.elec_struct_2x2(H, dH)
+        props = {'H': H, 'dH': dH, 'E': E, 'U': U, 'adFrc': adFrc,
+                 'NACV': NACV}
+    else:
+        E, U = getEigProps(H, ctmqc_env)
+        gradH_ad = calc_gradH_adiab(U, dH)
+        adFrc = -np.diagonal(gradH_ad, axis1=-2, axis2=-1).real
+        props = {'H': H, 'dH': dH, 'E': E, 'U': U, 'adFrc': np.array(adFrc),
+                 'NACV': calcNACVfromGradH(E, gradH_ad)}
+    if U_ref is not False:
+        apply_state_alignment(props, *get_state_alignment(U, U_ref))
+
+    return props
+
+
+def calc_elec_struct(ctmqc_env):
+    """
+    Will carry out the full electronic structure stage of a step for all
+    replicas at once (see get_elec_props).
+
+    Everything is stored in the ctmqc_env dict so the later stages (adiabatic
+    momentum, forces and electronic propagation) share it without
+    recalculating anything.
+
+    If a tabulated potential energy surface has been loaded (in
+    ctmqc_env['PEStable']) then the properties are interpolated from it for
+    all replicas within the table's range. Only replicas outside the range
+    are calculated explicitly.
+
+    The adiabatic states are tracked through time by aligning them with the
+    eigenvectors from the previous step (ctmqc_env['U_tm']), so the stored U,
+    E, forces and NACV never swap order or flip sign between steps.
+
+    The NACV is written into a persistent array (see workspace.next_buffer),
+    the other properties are new arrays each step so they are just stored.
+    """
+    pos = ctmqc_env['pos']
+    table = ctmqc_env.get('PEStable', False)
+
+    if table is False:
+        props = get_elec_props(pos, ctmqc_env)
+    else:
+        # Tables are only available for 1D models
+        inTable = table.in_range(pos[:, 0])
+        props = table.lookup(pos[:, 0])
+        count_elec_evals(ctmqc_env, nTable=int(np.sum(inTable)))
+        if not np.all(inTable):
+            exactProps = get_elec_props(pos[~inTable], ctmqc_env)
+            for key in exactProps:
+                props[key][~inTable] = exactProps[key]
+
+    if 'U_tm' in ctmqc_env:
+        perm, signs = get_state_alignment(props['U'], ctmqc_env['U_tm'])
+        apply_state_alignment(props, perm, signs)
+
+    for key in ('H', 'dH', 'E', 'U', 'adFrc'):
+        ctmqc_env[key] = props[key]
+    NACV = wSpace.next_buffer(ctmqc_env, 'NACV')
+    NACV[:] = props['NACV']
+    ctmqc_env['NACV'] = NACV
 
-    return calcNACVgradPhi(pos, ctmqc_env)
-#    if ctmqc_env['tullyModel'] == 2 and ctmqc_env['velInit'] < 0.01:
-#    else:
-#        return calcNACVgradH(pos, ctmqc_env)
 
 def calcNACVgradH(pos, ctmqc_env):
     """
-    Will calculate the adiabatic NACV for replica irep
+    Will calculate the adiabatic NACV for the replica at pos (or all replicas
+    if pos is an array) with a 1D Hamiltonian function (e.g. create_H1).
     """
     dx = ctmqc_env['dx']
     nState = ctmqc_env['nstate']
@@ -149,28 +501,27 @@ def calcNACVgradH(pos, ctmqc_env):
     H_x = ctmqc_env['Hfunc'](pos)
     H_xp = ctmqc_env['Hfunc'](pos + dx)
 
-    allH = [H_xm, H_x, H_xp]
-    gradH = np.gradient(allH, dx, axis=0)[1]
+    gradH = (H_xp - H_xm) / (2 * dx)
     E, U = getEigProps(H_x, ctmqc_env)
-    NACV = np.zeros((nState, nState), dtype=complex)
+    # Real Hamiltonians give real NACVs
+    NACV = np.zeros(np.shape(H_x), dtype=np.result_type(U, gradH))
     for l in range(nState):
         for k in range(nState):
             if l != k:
-                phil = np.array(U)[l]
-                phik = np.array(U)[k]
-                NACV[l, k] = np.dot(phil, np.dot(gradH, phik))
-                NACV[l, k] /= E[k] - E[l]
-
-    for l in range(len(NACV)):
-        for k in range(l+1, len(NACV)):
-            if np.abs(NACV[l, k] + np.conjugate(NACV[k, l])) > 1e-10:
-                print("NACV:")
-                print(NACV)
-                print("NACV[%i, %i]: " % (l, k), NACV[l, k])
-                print("NACV[%i, %i]*: " % (l, k), np.conjugate(NACV[k, l]))
-                raise SystemExit("NACV not antisymetric!")
-
-    NACV = 0.5*(NACV - NACV.T)
+                phil = U[..., :, l]
+                phik = U[..., :, k]
+                NACV[..., l, k] = np.einsum('...i,...ij,...j->...',
+                                            phil, gradH, phik)
+                NACV[..., l, k] /= E[..., k] - E[..., l]
+
+    if validation.do_checks(ctmqc_env):
+        NACV_kl = np.conjugate(np.swapaxes(NACV, -1, -2))
+        antiSym = np.max(np.abs(NACV + NACV_kl), initial=0)
+        validation.record_check(ctmqc_env, "NACV antisymmetric",
+                                antiSym <= 1e-10,
+                                "max |d_lk + d_kl*| = %.2g" % antiSym)
+
+    NACV = 0.5*(NACV - np.swapaxes(NACV, -1, -2))
     return NACV
 
 
@@ -186,42 +537,61 @@ def test_Hfunc(Hfunc, minX=-15, maxX=15, stride=0.01):
     return allH, allE
 
 
-def test_NACV(Hfunc):
+def test_dH(Hfunc, dHfunc, minX=-15, maxX=15, stride=0.01, dx=1e-5):
+    """
+    Will compare the analytic gradient of the Hamiltonian with a central
+    finite difference one.
+    """
+    allR = np.arange(minX, maxX, stride)
+    FD_dH = (Hfunc(allR + dx) - Hfunc(allR - dx)) / (2 * dx)
+    diff = np.abs(dHfunc(allR) - FD_dH)
+
+    print("Worst Case: {0}".format(np.max(diff)))
+    print("Mean Case: {0} +/- {1}".format(np.mean(diff), np.std(diff)))
+    # Models 3 and 4 have kinks in d2H/dx2 so the FD error is O(dx) there
+    if np.max(diff) > 1e-6:
+        raise SystemExit("Analytic dH/dx != Finite Difference")
+
+
+def test_NACV(Hfunc, dHfunc):
+    """
+    Will compare the analytic (Hellmann-Feynman) NACV with the finite
+    difference gradH one.
+    """
     nrep = 4000
     randomNums = (np.random.random(nrep) * 30) - 15
-    ctmqc_env = {'dx': 1e-5, 'nstate': 2, 'pos': list(sorted(randomNums)),
-                 'Hfunc': Hfunc}
-    
-    allNACV1 = [calcNACV(irep, ctmqc_env) for irep in range(nrep)]
-    allNACV2 = [calcNACVgradH(irep, ctmqc_env)
-                for irep in range(nrep)]
-    
-    allNACV1 = np.array(allNACV1)
-    allNACV2 = np.array(allNACV2)
+    nstate = np.shape(Hfunc(0.0))[-1]
+    ctmqc_env = {'dx': 1e-5, 'nstate': nstate, 'pos': np.sort(randomNums),
+                 'Hfunc': Hfunc, 'dHfunc': dHfunc}
+
+    allNACV1 = calcNACV(np.arange(nrep), ctmqc_env)
+    allNACV2 = calcNACVgradH(ctmqc_env['pos'], ctmqc_env)
+
     diff = np.abs(allNACV1 - allNACV2)
 
     worstCase = np.max(diff)
     bestCase = np.min(diff)
     avgCase = np.mean(diff)
     std = np.std(diff)
-    
+
     #import matplotlib.pyplot as plt
 
     print("Worst Case: {0}".format(worstCase))
     print("Best Case: {0}".format(bestCase))
     print("Mean Case: {0} +/- {1}".format(avgCase, std))
-    
+
     #plt.plot(ctmqc_env['pos'], allNACV1[:, 0, 1], 'k.',
     #         label="calcNACV")
     #plt.plot(ctmqc_env['pos'], allNACV2[:, 0, 1], 'y.',
-    #         label="calcNACVgradPhi")
+    #         label="calcNACVgradH")
     #plt.legend()
     #plt.show()
 
 
 #test_Hfunc(create_Hlin)
-#test_NACV(create_Hlin)
-#test_NACV(create_H1)
-#test_NACV(create_H2)
-#test_NACV(create_H3)
-#test_NACV(create_H4)
+#test_dH(create_H1, create_dH1)
+#test_NACV(create_Hlin, create_dHlin)
+#test_NACV(create_H1, create_dH1)
+#test_NACV(create_H2, create_dH2)
+#test_NACV(create_H3, create_dH3)
+#test_NACV(create_H4, create_dH4)
@@ -10,7 +10,6 @@ Remember to check propagator by turning off forces and checking dx/dt
 from input_files import *
 
 import numpy as np
-import copy
 import matplotlib.pyplot as plt
 import random as rd
 import datetime as dt
@@ -21,9 +20,13 @@ import re
 import subprocess
 
 import hamiltonian as Ham
+import models
 import nucl_prop
 import elec_prop as e_prop
 import QM_utils as qUt
+import pes_table as pesT
+import validation
+import workspace as wSpace
 import plot
 
 
@@ -88,16 +91,38 @@ def setup(pos, vel, coeff, sigma, maxTime, model, doCTMQC_C, doCTMQC_F,
           dt=0.41341373336565040, elec_steps=5):
     # All units must be atomic units
     ctmqc_env = {
-            'pos': pos,  # Intial Nucl. pos | nrep |in bohr
-            'vel': vel,  # Initial Nucl. veloc | nrep |au_v
+            'pos': pos,  # Intial Nucl. pos | nrep (or nrep, ndim) |in bohr
+            'vel': vel,  # Initial Nucl. veloc | nrep (or nrep, ndim) |au_v
             'C': coeff,  # Intial WF |nrep, 2| -
             'mass': mass,  # nuclear mass |nrep| au_m
-            'tullyModel': model,  # Which model | | -
+            'tullyModel': model,  # Which model (see models.MODELS) | | -
+            'model_params': {},  # Override the model's default parameters
+            'symbolic_models': {},  # Models to compile (see symbolic_models.py)
+            'model_cache_folder': './model_cache',  # Where compiled models go
             'max_time': maxTime,  # Maximum time to simulate to | | au_t
-            'dx': 1e-5,  # The increment for the NACV and grad E calc | | bohr
+            'stop_converged': False,  # Stop once the ensemble has converged
+            'converge_time': 100,  # Time it must be converged for | | au_t
+            'converge_rate_tol': 1e-6,  # Max |NACV.v|, |Xqm|, |a|/|v| | | 1/au_t
+            'converge_pop_tol': 1e-5,  # Max change in pops and |coherences|
+            'ballistic_jump': False,  # Move converged nuclei on to max_time
+            'dx': 1e-5,  # The increment for the finite difference checks | | bohr
             'dt': dt,  # The timestep | |au_t
+            'nucl_integrator': 'verlet',  # See nucl_prop.NUCL_INTEGRATORS
+            'adaptive_dt': False,  # Pick dt each step (see __adaptive_step)
+            'dt_range': (0.1, 10),  # Min and max adaptive dt (multiples of dt)
+            'dt_nacv_tol': 0.01,  # Max |NACV.v| dt per step (adaptive dt)
+            'dt_rlk_tol': 0.25,  # Max change in Rlk per step (adaptive dt)
+            'dt_ener_tol': 2e-7,  # Max tot. energy change per step (adapt. dt)
             'elec_steps': elec_steps,  # Num elec. timesteps per nucl. one | | -
+            'elec_integrator': 'rk4',  # 'rk4', 'magnus' (2nd) or 'magnus4'
+            'elec_step_tol': False,  # Pick elec_steps per rep (error tol.)
+            'max_elec_steps': 1000,  # Max elec. substeps for elec_step_tol
+            'dormant_tol': False,  # Only evolve phases if |NACV.v| < this
+            'local_diab': False,  # Propagate adiab. coeffs with U_tm^T U
+            'tdc_overlap': False,  # NACV.v from U_tm^T U in the adiab. prop.
+            'interaction_picture': False,  # Remove the E phases analytically
             'do_QM_F': doCTMQC_F,  # Do the QM force
+            'qm_force_steps': 1,  # Nucl. steps per QM force/Qlk update (RESPA)
             'do_QM_C': doCTMQC_C,  # Do the QM force
             'do_sigma_calc': 'no',  # Dynamically adapt the value of sigma
             'sigma': sigma,  # The value of sigma (width of gaussian)
@@ -107,6 +132,13 @@ def setup(pos, vel, coeff, sigma, maxTime, model, doCTMQC_C, doCTMQC_F,
             'renorm': True,  # Choose whether renormalise the wf
             'Qlk_type': 'Min17',  # What method to use to calculate the QM
             'Rlk_smooth': 'RI0',  # Apply the smoothing algorithm to Rlk
+            'pes_table': False,  # Interpolate the elec. structure from a table
+            'pes_table_range': (-40, 80),  # Range of the table | | bohr
+            'pes_table_tol': 1e-8,  # Relative error tolerance of the table
+            'backend': 'numpy',  # Use the 'numpy' or compiled 'numba' kernels
+            'validation': 'sampled',  # Run checks 'off'/'sampled'/'full'
+            'validation_every': 100,  # Steps between 'sampled' checks
+            'validation_strict': False,  # Stop at the first failed check
                 }
     return ctmqc_env
 
@@ -136,7 +168,12 @@ def print_timings(timings_dict, ntabs=0, max_len=50, depth=0):
             print_timings(timings_dict[Tkey], ntabs+1, depth=depth+1)
         elif isinstance(timings_dict[Tkey], (list,)):
             line = "%s%s %s:" % (tab*ntabs, bullets[depth], Tkey)
-            str_num = "%.3f s" % np.mean(timings_dict[Tkey])
+            # Lists of ints are counts (e.g. electronic substeps) not times
+            if np.issubdtype(np.asarray(timings_dict[Tkey]).dtype,
+                             np.integer):
+                str_num = "%.1f  " % np.mean(timings_dict[Tkey])
+            else:
+                str_num = "%.3f s" % np.mean(timings_dict[Tkey])
             line = line + " " * (max_len-26 -
                                  (len(line) + len(str_num))
                                  + ntabs*5) + str_num
@@ -157,6 +194,15 @@ class CTMQC(object):
     """
     allR = []
     allt = []
+    # The arrays data is saved in (one entry per saved step)
+    savedArrays = ('allR', 'allt', 'allNACV', 'allF', 'allFeh', 'allFqm',
+                   'allE', 'allC', 'allu', 'allAdPop', 'allH', 'allAdMom',
+                   'allAdFrc', 'allv', 'allQlk', 'allRlk', 'allEffR',
+                   'allSigma', 'allSigmal', 'allRl', 'allAlphal', 'allAlpha')
+    # The ctmqc_env arrays that are changed in place during a step (these are
+    #  copied to undo a rejected step, see __adaptive_step)
+    stepArrays = ('pos', 'vel', 'C', 'u', 'adMom', 'sigma', 'alpha', 'effR',
+                  'frc', 'F_eh', 'F_qm', 'acc', 'NACV', 'Qlk', 'Rlk')
 
     def __init__(self, ctmqc_env, root_folder = False,
                  folder_structure=['ctmqc', 'model', 'mom'], para=False):
@@ -170,6 +216,10 @@ class CTMQC(object):
         self.folder_structure = folder_structure
 
         self.__init_tully_model()  # Set the correct Hamiltonian function
+        self.__init_backend()  # Check the compiled kernels can be used
+        self.__init_integrator()  # Check the electronic integrator
+        self.__init_stop_check()  # Check the early stopping settings
+        validation.init_validation(self.ctmqc_env)  # Check the check settings
         self.__init_nsteps()  # Find how many steps to take
         self.__init_pos_vel_wf()  # set pos vel wf as arrays, get nrep
         self.__init_arrays()  # Create the arrays used
@@ -214,7 +264,7 @@ class CTMQC(object):
         if int(mom) == mom: mom = int(mom)
         mom_str = "Kinit_%s" % (str(mom).replace(".", "x").strip())
 
-        model_str = "Model_%i" % self.ctmqc_env['tullyModel']
+        model_str = "Model_%s" % str(self.ctmqc_env['tullyModel'])
 
         params = {i: str(i) + "=" + str(self.ctmqc_env[i]) for i in self.ctmqc_env}
         params['ctmqc'] = CT_str
@@ -308,14 +358,23 @@ class CTMQC(object):
             msg = "Can't find initial wavefunction\n\t"
             msg += "(specify this as 'u' or 'C')"
             raise SystemExit(msg)
-        if nstate != 2:
-            raise SystemExit("The models currently only work with 2 states")
+        if nstate != self.ctmqc_env['model'].nstate:
+            msg = "The wavefunction has %i states but model " % nstate
+            msg += "%s has %i" % (str(self.ctmqc_env['tullyModel']),
+                                  self.ctmqc_env['model'].nstate)
+            raise SystemExit(msg)
+        self.ctmqc_env['local_diab'] = bool(self.ctmqc_env.get('local_diab',
+                                                               False))
+        if self.ctmqc_env['local_diab'] and self.adiab_diab == "diab":
+            msg = "Local diabatization propagates the adiabatic coefficients"
+            msg += ", give the initial wavefunction as 'C'"
+            raise SystemExit(msg)
 
         # Check pos array
+        ndim = self.ctmqc_env['model'].ndim
         if 'pos' in self.ctmqc_env:
-            self.ctmqc_env['pos'] = np.array(self.ctmqc_env['pos'],
-                                             dtype=np.float64)
-            nrep1, = np.shape(self.ctmqc_env['pos'])
+            self.ctmqc_env['pos'] = self.__as_nucl_array('pos', ndim)
+            nrep1 = len(self.ctmqc_env['pos'])
             nrep = np.min([nrep1, nrep])
             if nrep != nrep1:
                 changes = True
@@ -324,12 +383,11 @@ class CTMQC(object):
             msg += "(specify this as 'pos')"
             raise SystemExit(msg)
 
-        # Check pos array
+        # Check vel array
         if 'vel' in self.ctmqc_env:
-            self.ctmqc_env['velInit'] = np.mean(self.ctmqc_env['vel'])
-            self.ctmqc_env['vel'] = np.array(self.ctmqc_env['vel'],
-                                             dtype=np.float64)
-            nrep1, = np.shape(self.ctmqc_env['vel'])
+            self.ctmqc_env['vel'] = self.__as_nucl_array('vel', ndim)
+            self.ctmqc_env['velInit'] = np.mean(self.ctmqc_env['vel'][:, 0])
+            nrep1 = len(self.ctmqc_env['vel'])
 
             nrep = np.min([nrep1, nrep])
             if nrep != nrep1:
@@ -353,16 +411,33 @@ class CTMQC(object):
 
         self.ctmqc_env['nrep'] = nrep
         self.ctmqc_env['nstate'] = nstate
+        self.ctmqc_env['ndim'] = ndim
 
 #        print("\n\nNumber Replicas = %i\n\n" % nrep)
         self.__check_pos_vel_QM()  # Just check that the QM will be non-zero
 
+    def __as_nucl_array(self, key, ndim):
+        """
+        Will convert the nuclear positions or velocities (key) to a float array
+        with shape (nrep, ndim). 1D models can be given a flat (nrep) array.
+        """
+        arr = np.array(self.ctmqc_env[key], dtype=np.float64)
+        if arr.ndim == 1 and ndim == 1:
+            arr = arr[:, np.newaxis]
+        if arr.ndim != 2 or np.shape(arr)[1] != ndim:
+            msg = "The '%s' array has shape %s but model " % (key,
+                                                               np.shape(arr))
+            msg += "%s needs (nrep, %i)" % (str(self.ctmqc_env['tullyModel']),
+                                            ndim)
+            raise SystemExit(msg)
+        return arr
+
     def __init_arrays(self):
         """
         Will fill the ctmqc_env dictionary with the correct sized arrays such
         as the force array
         """
-        nrep = self.ctmqc_env['nrep']
+        nrep, ndim = self.ctmqc_env['nrep'], self.ctmqc_env['ndim']
         nstate, nstep = self.ctmqc_env['nstate'], self.ctmqc_env['nsteps'] + 1
         if 'mass' in self.ctmqc_env:
             self.ctmqc_env['mass'] = np.array(self.ctmqc_env['mass'])
@@ -380,28 +455,38 @@ class CTMQC(object):
             if len(nums) > 1:
                 self.ctmqc_env['polynomial_order'] = int(''.join(nums))
 
-        # For saving the data
-        self.allR = np.zeros((nstep, nrep))
-        self.allF = np.zeros((nstep, nrep))
-        self.allNACV = np.zeros((nstep, nrep, nstate, nstate), dtype=complex)
-        self.allFeh = np.zeros((nstep, nrep))
-        self.allFqm = np.zeros((nstep, nrep))
+        # Real Hamiltonians have real eigenvectors and NACVs so these are
+        #  stored as floats (the coefficients are always complex).
+        self.ctmqc_env['real_H'] = self.__is_real_model()
+        NACVtype = np.float64 if self.ctmqc_env['real_H'] else complex
+
+        # For saving the data (the nuclear dimension axis is left out of the
+        #  saved arrays for 1D models)
+        dim = () if ndim == 1 else (ndim,)
+        self.allR = np.zeros((nstep, nrep) + dim)
+        self.allF = np.zeros((nstep, nrep) + dim)
+        self.allNACV = np.zeros((nstep, nrep) + dim + (nstate, nstate),
+                                dtype=NACVtype)
+        self.allFeh = np.zeros((nstep, nrep) + dim)
+        self.allFqm = np.zeros((nstep, nrep) + dim)
         self.allt = np.zeros((nstep))
-        self.allv = np.zeros((nstep, nrep))
+        self.allv = np.zeros((nstep, nrep) + dim)
         self.allE = np.zeros((nstep, nrep, nstate))
         self.allC = np.zeros((nstep, nrep, nstate), dtype=complex)
         self.allu = np.zeros((nstep, nrep, nstate), dtype=complex)
         self.allAdPop = np.zeros((nstep, nrep, nstate))
         self.allH = np.zeros((nstep, nrep, nstate, nstate))
-        self.allAdMom = np.zeros((nstep, nrep, nstate))
-        self.allAdFrc = np.zeros((nstep, nrep, nstate))
-        self.allQlk = np.zeros((nstep, nrep, nstate, nstate))
+        self.allAdMom = np.zeros((nstep, nrep) + dim + (nstate,))
+        self.allAdFrc = np.zeros((nstep, nrep) + dim + (nstate,))
+        self.allQlk = np.zeros((nstep, nrep) + dim + (nstate, nstate))
         self.allAlphal = np.zeros(nstep)
         self.allAlpha = np.zeros((nstep, nrep))
-        self.allRlk = np.zeros((nstep, nstate, nstate))
-        self.allEffR = np.zeros((nstep, nstate, nstate, nrep))
+        self.allRlk = np.zeros((nstep,) + dim + (nstate, nstate))
+        self.allEffR = np.zeros((nstep, nstate, nstate, nrep) + dim)
         self.allIsSpiking = np.zeros(nstep, dtype=bool)
         self.allClusters = []
+        if self.ctmqc_env['Qlk_type'] == 'sigmal' and ndim != 1:
+            raise SystemExit("The `sigmal` Qlk_type only works for 1D models")
         if self.ctmqc_env['Qlk_type'] == 'sigmal':
             self.allRl = np.zeros((nstep, nstate))
         elif self.ctmqc_env['Qlk_type'] == 'Min17':
@@ -412,56 +497,172 @@ class CTMQC(object):
         self.allSigmal = np.zeros((nstep, nstate))
 
         # For propagating dynamics
-        self.ctmqc_env['frc'] = np.zeros((nrep))
-        self.ctmqc_env['F_eh'] = np.zeros((nrep))
-        self.ctmqc_env['F_qm'] = np.zeros((nrep))
-        self.ctmqc_env['acc'] = np.zeros((nrep))
+        self.ctmqc_env['frc'] = np.zeros((nrep, ndim))
+        self.ctmqc_env['F_eh'] = np.zeros((nrep, ndim))
+        self.ctmqc_env['F_qm'] = np.zeros((nrep, ndim))
+        self.ctmqc_env['acc'] = np.zeros((nrep, ndim))
         self.ctmqc_env['H'] = np.zeros((nrep, nstate, nstate))
-        self.ctmqc_env['NACV'] = np.zeros((nrep, nstate, nstate),
-                                          dtype=complex)
+        self.ctmqc_env['NACV'] = np.zeros((nrep, ndim, nstate, nstate),
+                                          dtype=NACVtype)
         self.ctmqc_env['clusters'] = {}
-        self.ctmqc_env['NACV_tm'] = np.zeros((nrep, nstate, nstate),
-                                             dtype=complex)
+        self.ctmqc_env['NACV_tm'] = np.zeros((nrep, ndim, nstate, nstate),
+                                             dtype=NACVtype)
         self.ctmqc_env['U'] = np.zeros((nrep, nstate, nstate))
         self.ctmqc_env['E'] = np.zeros((nrep, nstate))
-        self.ctmqc_env['adFrc'] = np.zeros((nrep, nstate))
+        self.ctmqc_env['adFrc'] = np.zeros((nrep, ndim, nstate))
         self.ctmqc_env['adPops'] = np.zeros((nrep, nstate))
-        self.ctmqc_env['adMom'] = np.zeros((nrep, nstate))
-        self.ctmqc_env['adMom_tm'] = np.zeros((nrep, nstate))
+        self.ctmqc_env['adMom'] = np.zeros((nrep, ndim, nstate))
+        self.ctmqc_env['adMom_tm'] = np.zeros((nrep, ndim, nstate))
+        self.ctmqc_env['vel_tm'] = np.zeros((nrep, ndim))
         self.ctmqc_env['alpha'] = np.zeros((nrep))
         self.ctmqc_env['alphal'] = 0.0
         self.ctmqc_env['sigmal'] = np.zeros(nstate)
-        self.ctmqc_env['effR'] = np.zeros((nstate, nstate, nrep))
+        self.ctmqc_env['effR'] = np.zeros((nstate, nstate, nrep, ndim))
         if self.ctmqc_env['Qlk_type'] == 'sigmal':
             self.ctmqc_env['altR'] = np.zeros(nstate)
         elif self.ctmqc_env['Qlk_type'] == 'Min17':
             self.ctmqc_env['altR'] = np.zeros(nrep)
         else:
             raise SystemExit("Either use `sigmal` or `Min17` for the Qlk_type")
-        self.ctmqc_env['Qlk'] = np.zeros((nrep, nstate, nstate))
-        self.ctmqc_env['Qlk_tm'] = np.zeros((nrep, nstate, nstate))
-        self.ctmqc_env['Rlk'] = np.zeros((nstate, nstate))
-        self.ctmqc_env['Rlk_tm'] = np.zeros((nstate, nstate))
+        self.ctmqc_env['Qlk'] = np.zeros((nrep, ndim, nstate, nstate))
+        self.ctmqc_env['Qlk_tm'] = np.zeros((nrep, ndim, nstate, nstate))
+        self.ctmqc_env['Rlk'] = np.zeros((ndim, nstate, nstate))
+        self.ctmqc_env['Rlk_tm'] = np.zeros((ndim, nstate, nstate))
+        wSpace.init_workspace(self.ctmqc_env)  # The step's work arrays
+
+    def __is_real_model(self):
+        """
+        Will check whether the model's Hamiltonian (and its gradient) is real
+        by evaluating it at the initial positions. This isn't counted as an
+        electronic structure evaluation.
+        """
+        pos = self.ctmqc_env['pos']
+        return bool(np.isrealobj(self.ctmqc_env['Hfunc'](pos))
+                    and np.isrealobj(self.ctmqc_env['dHfunc'](pos)))
 
     def __init_tully_model(self):
         """
-        Will put the correct tully model in the ctmqc_env dict
-        """
-        if self.ctmqc_env['tullyModel'] == 1:
-            self.ctmqc_env['Hfunc'] = Ham.create_H1
-        elif self.ctmqc_env['tullyModel'] == 2:
-            self.ctmqc_env['Hfunc'] = Ham.create_H2
-        elif self.ctmqc_env['tullyModel'] == 3:
-            self.ctmqc_env['Hfunc'] = Ham.create_H3
-        elif self.ctmqc_env['tullyModel'] == 4:
-            self.ctmqc_env['Hfunc'] = Ham.create_H4
-        elif self.ctmqc_env['tullyModel'] == 'lin':
-            self.ctmqc_env['Hfunc'] = Ham.create_Hlin
-        else:
-            print("Tully Model = %s" % str(self.ctmqc_env['tullyModel']))
-            msg = "Incorrect tully model chosen. Only 1, 2, 3 and 4 available"
+        Will put the correct tully model in the ctmqc_env dict (from the
+        registry in models.py). Any symbolic models are compiled (and
+        registered) first.
+        """
+        if self.ctmqc_env.get('symbolic_models'):
+            import symbolic_models
+            symbolic_models.compile_models(
+                                self.ctmqc_env['symbolic_models'],
+                                self.ctmqc_env.get('model_cache_folder',
+                                                   './model_cache'))
+
+        model = models.get_model(self.ctmqc_env['tullyModel'],
+                                 **self.ctmqc_env.get('model_params', {}))
+        self.ctmqc_env['model'] = model
+        self.ctmqc_env['Hfunc'] = model.H
+        self.ctmqc_env['dHfunc'] = model.dH
+
+        # Load (or build) the tabulated surface
+        if self.ctmqc_env.get('pes_table', False):
+            if model.ndim != 1:
+                raise SystemExit("Tabulated surfaces only work for 1D models")
+            self.ctmqc_env['PEStable'] = pesT.get_pes_table(self.ctmqc_env)
+
+    def __init_backend(self):
+        """
+        Will check which kernels (numpy or numba) to use. If numba was asked
+        for but isn't installed the numpy ones are used.
+        """
+        backend = self.ctmqc_env.get('backend', 'numpy').lower()
+        if backend not in ('numpy', 'numba'):
+            msg = "Unknown backend '%s'. Use 'numpy' or 'numba'" % backend
             raise SystemExit(msg)
 
+        if backend == 'numba':
+            try:
+                import numba_kernels
+            except ImportError:
+                print("WARNING: Numba isn't installed, using the numpy backend")
+                backend = 'numpy'
+        self.ctmqc_env['backend'] = backend
+
+    def __init_integrator(self):
+        """
+        Will check the electronic and nuclear integrators are ones we know and
+        the settings for the adaptive number of electronic substeps, dormant
+        replicas, the multiple time step nuclear integration and the adaptive
+        nuclear dt.
+        """
+        integrator = self.ctmqc_env.get('elec_integrator', 'rk4').lower()
+        if integrator not in ('rk4', 'magnus', 'magnus4'):
+            msg = "Unknown elec_integrator '%s'. " % integrator
+            msg += "Use 'rk4', 'magnus' or 'magnus4'"
+            raise SystemExit(msg)
+        self.ctmqc_env['elec_integrator'] = integrator
+
+        tol = self.ctmqc_env.setdefault('elec_step_tol', False)
+        if tol is not False and not tol > 0:
+            raise SystemExit("The elec_step_tol should be False or > 0")
+        maxSteps = self.ctmqc_env.setdefault('max_elec_steps', 1000)
+        if int(maxSteps) < 1:
+            raise SystemExit("The max_elec_steps should be at least 1")
+        self.ctmqc_env['max_elec_steps'] = int(maxSteps)
+
+        tol = self.ctmqc_env.setdefault('dormant_tol', False)
+        if tol is not False and not tol > 0:
+            raise SystemExit("The dormant_tol should be False or > 0")
+
+        QMsteps = self.ctmqc_env.setdefault('qm_force_steps', 1)
+        if int(QMsteps) != QMsteps or QMsteps < 1:
+            raise SystemExit("The qm_force_steps should be an int >= 1")
+        self.ctmqc_env['qm_force_steps'] = int(QMsteps)
+
+        nuclInt = self.ctmqc_env.get('nucl_integrator', 'verlet').lower()
+        if nuclInt not in nucl_prop.NUCL_INTEGRATORS:
+            msg = "Unknown nucl_integrator '%s'. Use " % nuclInt
+            msg += ", ".join("'%s'" % i for i in nucl_prop.NUCL_INTEGRATORS)
+            raise SystemExit(msg)
+        self.ctmqc_env['nucl_integrator'] = nuclInt
+        if nuclInt != 'verlet' and QMsteps > 1:
+            msg = "The qm_force_steps > 1 only works with the 'verlet' "
+            msg += "nucl_integrator"
+            raise SystemExit(msg)
+
+        adapt = bool(self.ctmqc_env.setdefault('adaptive_dt', False))
+        self.ctmqc_env['adaptive_dt'] = adapt
+        if not adapt:
+            return
+        if QMsteps > 1 or nuclInt != 'verlet':
+            msg = "The adaptive_dt only works with the 'verlet' "
+            msg += "nucl_integrator and qm_force_steps = 1"
+            raise SystemExit(msg)
+        dtMin, dtMax = self.ctmqc_env.setdefault('dt_range', (0.1, 10))
+        if not 0 < dtMin <= 1 <= dtMax:
+            msg = "The dt_range should be the (min, max) multiples of dt with "
+            msg += "0 < min <= 1 <= max"
+            raise SystemExit(msg)
+        self.dtAsked = self.ctmqc_env['dt']
+        self.ctmqc_env['dt_min'] = dtMin * self.ctmqc_env['dt']
+        self.ctmqc_env['dt_max'] = dtMax * self.ctmqc_env['dt']
+        for key, default in (('dt_nacv_tol', 0.01), ('dt_rlk_tol', 0.25),
+                             ('dt_ener_tol', 2e-7)):
+            if not self.ctmqc_env.setdefault(key, default) > 0:
+                raise SystemExit("The %s should be > 0" % key)
+
+    def __init_stop_check(self):
+        """
+        Will check the settings for stopping the run once the ensemble has
+        left the interaction region (see __is_converged).
+        """
+        stop = bool(self.ctmqc_env.setdefault('stop_converged', False))
+        self.ctmqc_env['stop_converged'] = stop
+        self.ctmqc_env['ballistic_jump'] = bool(
+                            self.ctmqc_env.setdefault('ballistic_jump', False))
+        if not stop:
+            return
+        for key, default in (('converge_time', 100),
+                             ('converge_rate_tol', 1e-6),
+                             ('converge_pop_tol', 1e-5)):
+            if not self.ctmqc_env.setdefault(key, default) > 0:
+                raise SystemExit("The %s should be > 0" % key)
+
     def __init_step(self):
         """
         Will carry out the initialisation step (just 1 step without
@@ -481,14 +682,18 @@ class CTMQC(object):
             self.ctmqc_env['nSmoothStep'] = 0
         self.allTimes = {'step': [], 'force': [], 'wf_prop': [],
                          'transform': [], 'calcQM':[], 'prep': [],
-                         "get pops": [],}
+                         "get pops": [],
+                         'elec substeps': {'total (all reps)': [],
+                                           'max (1 rep)': [],
+                                           'dormant reps': []}}
+        self.allDt = []  # The dt of each step (with an adaptive dt)
+        self.dtRejected = 0
+        self.convergeRef = None  # The start of the converged window
+        self.ctmqc_env['stop_reason'] = 'max_time'
 
-        # Calculate the Hamiltonian
-        for irep in range(nrep):
-            pos = self.ctmqc_env['pos'][irep]
-            self.ctmqc_env['H'][irep] = self.ctmqc_env['Hfunc'](pos)
-            E, U = np.linalg.eigh(self.ctmqc_env['H'][irep])
-            self.ctmqc_env['E'][irep], self.ctmqc_env['U'][irep] = E, U
+        # Calculate the Hamiltonian and eigen properties (for all reps at once)
+        self.ctmqc_env['elec_evals'] = {'H': 0, 'dH': 0, 'eig': 0, 'table': 0}
+        Ham.calc_elec_struct(self.ctmqc_env)
 
 
         # Transform the coefficieints
@@ -504,57 +709,45 @@ class CTMQC(object):
         # Calculate the QM, adMom, adPop, adFrc.
         if self.ctmqc_env['do_sigma_calc'].lower() == 'no':
            self.ctmqc_env['alpha'][:] = 1 / (2 * (self.ctmqc_env['sigma']**2))
-        self.__calc_quantities()
+        self.__calc_quantities(do_elec_struct=False)
         # Calculate the forces
         self.__calc_F()
 
         self.__update_vars_step()
 
 
-    def __calc_quantities(self):
+    def __calc_quantities(self, do_elec_struct=True, do_QM=True):
         """
         Will calculate the various paramters to feed into the force and
         electronic propagators. These are then saved in the ctmqc_env dict.
+
+        If the electronic structure has already been calculated at the current
+        positions set do_elec_struct to False to avoid repeating it. If do_QM
+        is False the quantum momentum (Qlk) isn't updated (see __ctmqc_step).
         """
         # Get adiabatic populations
-        adPops = np.conjugate(self.ctmqc_env['C']) * self.ctmqc_env['C']
-        if np.any(np.abs(adPops.imag) > 0):
-            raise SystemExit("Something funny with adiabatic populations")
-        self.ctmqc_env['adPops'] = adPops.real
-
-        # Do for each rep
-        #doQM = False
-        for irep in range(self.ctmqc_env['nrep']):
-            # Get Hamiltonian
-            pos = self.ctmqc_env['pos'][irep]
-            self.ctmqc_env['H'][irep] = self.ctmqc_env['Hfunc'](pos)
-
+        self.__calc_ad_pops()
 
-            # Get Eigen properties
-            E, U = np.linalg.eigh(self.ctmqc_env['H'][irep])
-            self.ctmqc_env['E'][irep], self.ctmqc_env['U'][irep] = E, U
+        # Get H, E, U, dH/dx, adiabatic forces and NACV (for all reps at once)
+        if do_elec_struct:
+            Ham.calc_elec_struct(self.ctmqc_env)
 
-            # Get adiabatic forces
-            adFrc = qUt.calc_ad_frc(pos, self.ctmqc_env)
-            self.ctmqc_env['adFrc'][irep] = adFrc
-
-            # Get adiabatic NACV
-            self.ctmqc_env['NACV'][irep] = Ham.calcNACV(irep,
-                                                        self.ctmqc_env)
+        # Get the adiabatic momentum
+        if self.ctmqc_env['do_QM_F'] or self.ctmqc_env['do_QM_C']:
+            highPop = np.any(self.ctmqc_env['adPops']
+                             > self.ctmqc_env['threshold'], axis=1)
+            self.ctmqc_env['adMom'][highPop] = 0.0
 
-            # Get the QM quantities
-            if self.ctmqc_env['do_QM_F'] or self.ctmqc_env['do_QM_C']:
-                if any(Ck > self.ctmqc_env['threshold']
-                        for Ck in self.ctmqc_env['adPops'][irep]):
-                    adMom = 0.0 * self.ctmqc_env['adMom'][irep]
-                else:
-                    doQM = True
-                    adMom = qUt.calc_ad_mom(self.ctmqc_env, irep, adFrc)
-                self.ctmqc_env['adMom'][irep] = adMom
+            QMreps = np.arange(self.ctmqc_env['nrep'])[~highPop]
+            self.ctmqc_env['adMom'][QMreps] = qUt.calc_ad_mom(self.ctmqc_env,
+                                                              QMreps)
 
         # Do for all reps
         t1 = time.time()
-        if self.ctmqc_env['do_QM_F'] or self.ctmqc_env['do_QM_C']: # and doQM:
+        if (self.ctmqc_env['do_QM_F'] or self.ctmqc_env['do_QM_C']) and do_QM:
+            # The time since the last update (for the Rlk gradient)
+            self.ctmqc_env['QM_dt'] = self.ctmqc_env['dt'] \
+                                      * self.ctmqc_env.get('qm_outer_steps', 1)
             #if self.ctmqc_env['do_sigma_calc']:
             #    qUt.calc_sigma(self.ctmqc_env)
             if self.ctmqc_env['Qlk_type'] == 'Min17':
@@ -564,28 +757,53 @@ class CTMQC(object):
         self.allTimes['calcQM'].append(time.time() - t1)
 #        print("\n")
 
+    def __calc_ad_pops(self):
+        """
+        Will calculate the adiabatic populations from the coefficients.
+        """
+        adPops = np.conjugate(self.ctmqc_env['C']) * self.ctmqc_env['C']
+        if validation.do_checks(self.ctmqc_env):
+            maxImag = np.max(np.abs(adPops.imag))
+            validation.record_check(self.ctmqc_env, "real populations",
+                                    maxImag <= 1e-12,
+                                    "max |Im(|C|^2)| = %.2g" % maxImag)
+        self.ctmqc_env['adPops'] = adPops.real
+
     def __main_loop(self):
         """
         Will loop over all steps and propagate the dynamics
         """
         nstep = self.ctmqc_env['nsteps']
 
-        for istep in range(nstep):
+        istep = 0
+        while self.__steps_left(istep):
             try:
                 t1 = time.time()
                 if self.tenSteps and self.ctmqc_env['iter'] % 10 == 0:
                    self.__save_data()
                 elif self.tenSteps is False:
                    self.__save_data()
-                self.__ctmqc_step()
-                self.ctmqc_env['t'] += self.ctmqc_env['dt']
+                if self.ctmqc_env['adaptive_dt']:
+                    stepDt = self.__adaptive_step()
+                else:
+                    stepDt = self.ctmqc_env['dt']
+                    self.__ctmqc_step()
+                    self.__update_vars_step()  # Save old positions
+                self.ctmqc_env['t'] += stepDt
                 self.ctmqc_env['iter'] += 1
+                if self.ctmqc_env['stop_converged'] and self.__is_converged():
+                    self.__stop_converged()
+                    break
 
                 t2 = time.time()
 
                 # Print some useful info (if not doing parallel sims)
                 if not self.para or self.ctmqc_env['iter'] % 100 == 0:
                     self.allTimes['step'].append(t2 - t1)
+                    if self.ctmqc_env['adaptive_dt']:
+                        # Estimate the number of steps from the time done
+                        nstep = int((istep + 1) * self.ctmqc_env['max_time']
+                                    / self.ctmqc_env['t'])
                     avgTime = np.mean(self.allTimes['step'])
                     msg = "\rStep %i/%i  Time Taken = %.2gs" % (istep, nstep,
                                                                 avgTime)
@@ -597,6 +815,7 @@ class CTMQC(object):
         #            print(" "*200, end="\r")
                     print(msg,
                           end="\r")
+                istep += 1
 
             except (KeyboardInterrupt, SystemExit) as E:
                 print("\n\n\n\n\n\n\n\n\n------------\n\n\n\n\n\n\n\n\n\n\n\n")
@@ -606,35 +825,126 @@ class CTMQC(object):
                 return
         if self.tenSteps and self.ctmqc_env['iter'] % 10 == 0:
            self.__save_data()
-        elif self.tenSteps is False:
-           self.__save_data()
+        elif self.tenSteps is False \
+             or self.ctmqc_env['stop_reason'] != 'max_time':
+           self.__save_data()  # Always save where an early stop ended
 
-    def __calc_F(self):
-        """
-        Will calculate the force on the nuclei
-        """
-        for irep in range(self.ctmqc_env['nrep']):
-            # Get Ehrenfest Forces
-            Feh = nucl_prop.calc_ehren_adiab_force(
-                                         irep,
-                                         self.ctmqc_env['adFrc'][irep],
-                                         self.ctmqc_env['adPops'][irep],
-                                         self.ctmqc_env)
-
-            Fqm = 0.0
-            if self.ctmqc_env['do_QM_F']:
-                Qlk = self.ctmqc_env['Qlk'][irep, 0, 1]
-                Fqm = nucl_prop.calc_QM_force(
-                                         C=self.ctmqc_env['adPops'][irep],
-                                         QM=Qlk,
-                                         f=self.ctmqc_env['adMom'][irep],
-                                         ctmqc_env=self.ctmqc_env)
-
-            Ftot = float(Feh) + float(Fqm)
-            self.ctmqc_env['F_eh'][irep] = Feh
-            self.ctmqc_env['F_qm'][irep] = Fqm
-            self.ctmqc_env['frc'][irep] = Ftot
-            self.ctmqc_env['acc'][irep] = Ftot/self.ctmqc_env['mass']
+    def __is_converged(self):
+        """
+        Will check whether the ensemble has left the interaction region. This
+        is True once, for the last 'converge_time', every replica has had:
+            * negligible rates of change, |NACV.v| + |Xqm| (the Qlk term in
+              the coefficient equations) + |a| / |v| (the nuclei's relative
+              change in velocity) below 'converge_rate_tol'
+            * a |NACV.v| that isn't increasing (so it isn't heading into the
+              coupling region)
+            * populations and coherences (|C_l C_k|) that haven't changed by
+              more than 'converge_pop_tol'
+        """
+        NACV_v = np.einsum('rd,rdlk->rlk', self.ctmqc_env['vel'],
+                           self.ctmqc_env['NACV'])
+        NACV_v = np.max(np.abs(NACV_v), axis=(1, 2))
+        speed = np.linalg.norm(self.ctmqc_env['vel'], axis=1)
+        rate = NACV_v + np.linalg.norm(self.ctmqc_env['acc'], axis=1) \
+                        / np.maximum(speed, 1e-300)
+        if self.ctmqc_env['do_QM_C']:
+            Xqm = e_prop.calc_Xqm_diag(self.ctmqc_env['Qlk'],
+                                       self.ctmqc_env['adMom'],
+                                       self.ctmqc_env['adPops'])
+            rate = rate + np.max(np.abs(Xqm), axis=1)
+        absC = np.abs(self.ctmqc_env['C'])
+        rho = absC[:, :, np.newaxis] * absC[:, np.newaxis, :]
+
+        # Start a new window if anything has changed
+        ref = self.convergeRef
+        if ref is None or np.max(rate) > self.ctmqc_env['converge_rate_tol'] \
+           or np.any(NACV_v > ref['NACV.v']) \
+           or np.max(np.abs(rho - ref['rho'])) \
+              > self.ctmqc_env['converge_pop_tol']:
+            self.convergeRef = {'t': self.ctmqc_env['t'], 'NACV.v': NACV_v,
+                                'rho': rho}
+            return False
+        return self.ctmqc_env['t'] - ref['t'] >= self.ctmqc_env['converge_time']
+
+    def __stop_converged(self):
+        """
+        Will record why the run was stopped early and, if the 'ballistic_jump'
+        setting is True, move the nuclei on to the max_time with their current
+        velocities. Outside the interaction region the adiabatic energies are
+        constant, so the adiabatic coefficients just pick up a phase. The
+        electronic structure, diabatic coefficients and (Ehrenfest) forces
+        are then recalculated at the new positions.
+        """
+        t = self.ctmqc_env['t']
+        self.ctmqc_env['stop_reason'] = "converged at t = %.1f au" % t
+        jumpT = self.ctmqc_env['max_time'] - t
+        if not self.ctmqc_env['ballistic_jump'] or jumpT <= 0:
+            return
+
+        self.ctmqc_env['stop_reason'] += " (jumped to %.1f au)" % \
+                                         self.ctmqc_env['max_time']
+        E = np.array(self.ctmqc_env['E'])
+        self.ctmqc_env['pos'] += self.ctmqc_env['vel'] * jumpT
+        Ham.calc_elec_struct(self.ctmqc_env)
+        E = 0.5 * (E + self.ctmqc_env['E'])
+        self.ctmqc_env['C'] *= np.exp(-1j * jumpT * E)
+        e_prop.trans_adiab_to_diab(self.ctmqc_env)
+        self.__calc_ad_pops()
+        self.__calc_F(do_QM=False)
+        self.ctmqc_env['t'] = self.ctmqc_env['max_time']
+
+    def __steps_left(self, istep):
+        """
+        Will return True if there are more steps to take. With an adaptive dt
+        the number of steps isn't known so this runs to the max_time.
+        """
+        if self.ctmqc_env['adaptive_dt']:
+            return self.ctmqc_env['max_time'] - self.ctmqc_env['t'] > 1e-8
+        return istep < self.ctmqc_env['nsteps']
+
+    def __calc_F(self, do_QM=True):
+        """
+        Will calculate the force on the nuclei. If do_QM is False the quantum
+        momentum force isn't updated (see __ctmqc_step).
+        """
+        do_QM = do_QM and self.ctmqc_env['do_QM_F']
+        if self.ctmqc_env['backend'] == 'numba':
+            import numba_kernels as nbK
+            Feh, Fqm = nbK.calc_forces(self.ctmqc_env['adFrc'],
+                                       self.ctmqc_env['adPops'],
+                                       self.ctmqc_env['C'],
+                                       self.ctmqc_env['E'],
+                                       self.ctmqc_env['NACV'],
+                                       self.ctmqc_env['Qlk'],
+                                       self.ctmqc_env['adMom'],
+                                       bool(do_QM))
+            self.ctmqc_env['F_eh'][:] = Feh
+            if do_QM or not self.ctmqc_env['do_QM_F']:
+                self.ctmqc_env['F_qm'][:] = Fqm
+            self.ctmqc_env['frc'][:] = Feh + self.ctmqc_env['F_qm']
+            self.ctmqc_env['acc'][:] = self.ctmqc_env['frc'] / \
+                                       self.ctmqc_env['mass']
+            return
+
+        # Both forces are calculated for all replicas at once
+        nucl_prop.calc_ehren_adiab_force_all(self.ctmqc_env['adFrc'],
+                                             self.ctmqc_env['adPops'],
+                                             self.ctmqc_env['C'],
+                                             self.ctmqc_env['E'],
+                                             self.ctmqc_env['NACV'],
+                                             out=self.ctmqc_env['F_eh'])
+        if do_QM:
+            nucl_prop.calc_QM_force_all(self.ctmqc_env['adPops'],
+                                        self.ctmqc_env['Qlk'],
+                                        self.ctmqc_env['adMom'],
+                                        out=self.ctmqc_env['F_qm'])
+        elif not self.ctmqc_env['do_QM_F']:
+            self.ctmqc_env['F_qm'][:] = 0.0
+
+        np.add(self.ctmqc_env['F_eh'], self.ctmqc_env['F_qm'],
+               out=self.ctmqc_env['frc'])
+        np.divide(self.ctmqc_env['frc'], self.ctmqc_env['mass'],
+                  out=self.ctmqc_env['acc'])
 
     def __prop_wf(self):
         """
@@ -643,11 +953,18 @@ class CTMQC(object):
         """
         # Propagate WF
         t1 = time.time()
-        if self.adiab_diab == 'adiab':
+        if self.adiab_diab == 'adiab' and self.ctmqc_env['local_diab']:
+            e_prop.do_local_diab_prop(self.ctmqc_env)
+        elif self.adiab_diab == 'adiab':
             e_prop.do_adiab_prop(self.ctmqc_env)
         else:
             e_prop.do_diab_prop(self.ctmqc_env)
         t2 = time.time()
+        nsteps = self.ctmqc_env['elec_steps_used']
+        substeps = self.allTimes['elec substeps']
+        substeps['total (all reps)'].append(int(np.sum(nsteps)))
+        substeps['max (1 rep)'].append(int(np.max(nsteps)))
+        substeps['dormant reps'].append(int(np.sum(nsteps == 0)))
 
         # Check the norm
         norm = np.sum(self.ctmqc_env['adPops'], axis=1)
@@ -659,19 +976,18 @@ class CTMQC(object):
         # Transform WF
         if self.adiab_diab == 'adiab':
             if self.ctmqc_env['renorm']:
-               e_prop.renormalise_all_coeffs(self.ctmqc_env['C'])
+               e_prop.renormalise_all_coeffs(self.ctmqc_env['C'],
+                                            self.ctmqc_env)
             e_prop.trans_adiab_to_diab(self.ctmqc_env)
         else:
             if self.ctmqc_env['renorm']:
-               e_prop.renormalise_all_coeffs(self.ctmqc_env['u'])
+               e_prop.renormalise_all_coeffs(self.ctmqc_env['u'],
+                                            self.ctmqc_env)
             e_prop.trans_diab_to_adiab(self.ctmqc_env)
         t3 = time.time()
 
         # Get adiabatic populations
-        adPops = np.conjugate(self.ctmqc_env['C']) * self.ctmqc_env['C']
-        if np.any(np.abs(adPops.imag) > 0):
-            raise SystemExit("Something funny with adiabatic populations")
-        self.ctmqc_env['adPops'] = adPops.real
+        self.__calc_ad_pops()
         t4 = time.time()
 
         self.allTimes['wf_prop'].append(t2 - t1)
@@ -681,64 +997,211 @@ class CTMQC(object):
     def __ctmqc_step(self):
         """
         Will carry out a single step in the CTMQC.
+
+        The step is made of velocity Verlet substeps (see __verlet_step) that
+        each take a fraction of dt (set by the 'nucl_integrator', see
+        nucl_prop.NUCL_INTEGRATORS). Each substep does the whole step
+        pipeline: the electronic structure, quantum momentum and electronic
+        propagation are over that substep, interpolating from the end of the
+        last one (the *_tm variables are updated between substeps). The
+        caller updates them after the last one.
         """
         dt = self.ctmqc_env['dt']
+        weights = nucl_prop.NUCL_INTEGRATORS[self.ctmqc_env['nucl_integrator']]
+        for i, w in enumerate(weights):
+            if i > 0:
+                self.__update_vars_step()
+            self.ctmqc_env['dt'] = w * dt
+            self.__verlet_step()
+        self.ctmqc_env['dt'] = dt
+
+    def __verlet_step(self):
+        """
+        Will carry out a single velocity Verlet step (of ctmqc_env['dt']).
+
+        If the 'qm_force_steps' setting (n) is more than 1 a multiple time step
+        (RESPA) velocity Verlet is used. The quantum momentum (the force and
+        the Qlk in the coefficient equations) is only updated every n steps
+        (an outer step) and the slow quantum momentum force is applied as a
+        half kick at the start and end of each outer step. In between the
+        nuclei are propagated with the Ehrenfest force only and Qlk is held.
+        """
+        dt = self.ctmqc_env['dt']
+        QMsteps = self.ctmqc_env['qm_force_steps']
+        istep = self.ctmqc_env['iter']
+        mts = QMsteps > 1
+        if mts:
+            # Start of an outer step (the last one may be shorter)
+            if istep % QMsteps == 0:
+                self.ctmqc_env['qm_outer_steps'] = min(
+                                 QMsteps, self.ctmqc_env['nsteps'] - istep)
+                self.__QM_kick()
+            doQM = (istep + 1) % QMsteps == 0 \
+                   or istep + 1 == self.ctmqc_env['nsteps']
+            acc = self.ctmqc_env['F_eh'] / self.ctmqc_env['mass']
+        else:
+            doQM = True
+            acc = self.ctmqc_env['acc']
 
-        self.ctmqc_env['vel'] += 0.5 * self.ctmqc_env['acc'] * dt  # half dt
+        self.ctmqc_env['vel'] += 0.5 * acc * dt  # half dt
         self.ctmqc_env['pos'] += self.ctmqc_env['vel']*dt  # full dt
+        if self.ctmqc_env['nucl_integrator'] != 'verlet':
+            # The compositions need a time symmetric substep so the electronic
+            # propagation uses the (constant) velocity of the drift.
+            np.copyto(self.ctmqc_env['vel_tm'], self.ctmqc_env['vel'])
 
         t1 = time.time()
-        self.__calc_quantities()
+        self.__calc_quantities(do_QM=doQM)
         t2 = time.time()
         self.__prop_wf()
         t3 = time.time()
-        self.__calc_F()
-        self.ctmqc_env['vel'] += 0.5 * self.ctmqc_env['acc'] * dt  # full dt
+        self.__calc_F(do_QM=doQM)
+        if mts:
+            acc = self.ctmqc_env['F_eh'] / self.ctmqc_env['mass']
+        else:
+            acc = self.ctmqc_env['acc']
+        self.ctmqc_env['vel'] += 0.5 * acc * dt  # full dt
+        if mts and doQM:
+            self.__QM_kick()  # End of the outer step
         t4 = time.time()
 
         self.allTimes['prep'].append(t2 - t1)
         self.allTimes['force'].append(t4 - t3)
+
+    def __adaptive_step(self):
+        """
+        Will carry out a single step with an adaptive dt and return the dt that
+        was used.
+
+        The step is taken with ctmqc_env['dt'] and its error estimated (see
+        __step_error). If the error is too big the step is undone and retried
+        with a smaller dt. A step is undone by restoring the ctmqc_env saved
+        before it (see workspace.save_state), as the *_tm arrays are only
+        updated once a step is accepted they still hold the previous step for
+        the interpolation in the electronic propagation. After an accepted
+        step ctmqc_env['dt'] is set to the dt for the next one.
+        """
+        dtMin = self.ctmqc_env['dt_min']
+        while True:
+            # Don't step past the max_time
+            dt = min(self.ctmqc_env['dt'],
+                     self.ctmqc_env['max_time'] - self.ctmqc_env['t'])
+            self.ctmqc_env['dt'] = dt
+            state = wSpace.save_state(self.ctmqc_env, self.stepArrays)
+            enerStart = self.__replica_energies()
+
+            self.__ctmqc_step()
+
+            err, factor = self.__step_error(state[1], enerStart)
+            if err <= 1 or dt <= dtMin:
+                break
+            wSpace.restore_state(self.ctmqc_env, state)
+            self.ctmqc_env['dt'] = max(dtMin, dt * max(0.2, factor))
+            self.dtRejected += 1
+
         self.__update_vars_step()  # Save old positions
+        self.allDt.append(dt)
+        self.ctmqc_env['dt'] = min(self.ctmqc_env['dt_max'],
+                                   max(dtMin, dt * min(2.0, factor)))
+        return dt
+
+    def __step_error(self, stepStart, enerStart):
+        """
+        Will estimate the error of the step just taken relative to the
+        tolerances. The error is the largest of:
+            * The adiabatic state rotation |NACV.v| dt (at the start or end)
+            * The change in the Rlk (from the gradient in Rlk_is_spiking)
+            * The change in the total energy (averaged over replicas, with the
+              quantum momentum the replicas exchange energy)
+
+        Inputs:
+            * stepStart  =>  The arrays saved at the start of the step
+            * enerStart  =>  The replicas' total energy at the start
+        Outputs:
+            * The error (the step is accepted if this is <= 1)
+            * The factor to multiply dt by to get an error of ~0.9
+        """
+        dt = self.ctmqc_env['dt']
+        coup = max(np.max(np.abs(np.einsum('rd,rdlk->rlk', vel, NACV)))
+                   for vel, NACV in ((stepStart['vel'], stepStart['NACV']),
+                                     (self.ctmqc_env['vel'],
+                                      self.ctmqc_env['NACV'])))
+        dEner = abs(np.mean(self.__replica_energies() - enerStart))
+
+        # (error, order) pairs, the error goes as dt**order
+        errs = [(coup * dt / self.ctmqc_env['dt_nacv_tol'], 1),
+                (dEner / self.ctmqc_env['dt_ener_tol'], 2)]
+        # The Rlk_tm is only kept up to date with the QM in the coefficients
+        if self.ctmqc_env['do_QM_C']:
+            errs.append((self.ctmqc_env.get('gradRlk', 0.0) * dt
+                         / self.ctmqc_env['dt_rlk_tol'], 1))
+
+        err = max(i[0] for i in errs)
+        factor = min(0.9 * i[0]**(-1. / i[1]) if i[0] > 0 else np.inf
+                     for i in errs)
+        return err, factor
+
+    def __replica_energies(self):
+        """
+        Will return the total (Ehrenfest potential + kinetic) energy of each
+        replica.
+        """
+        potE = np.sum(self.ctmqc_env['adPops'] * self.ctmqc_env['E'], axis=1)
+        kinE = 0.5 * self.ctmqc_env['mass'] \
+               * np.sum(self.ctmqc_env['vel']**2, axis=1)
+        return potE + kinE
+
+    def __QM_kick(self):
+        """
+        Will apply half an outer step's worth of the quantum momentum force to
+        the velocities (see __ctmqc_step).
+        """
+        outerDt = self.ctmqc_env['dt'] * self.ctmqc_env['qm_outer_steps']
+        self.ctmqc_env['vel'] += 0.5 * outerDt * self.ctmqc_env['F_qm'] \
+                                 / self.ctmqc_env['mass']
 
     def __update_vars_step(self):
         """
-        Will update the time-dependant variables in the ctmqc environment
+        Will update the time-dependant variables in the ctmqc environment.
+
+        The arrays that are replaced (rather than changed in place) each step
+        are swapped by reference (see workspace.swap_tm), the rest are copied
+        into their preallocated *_tm arrays.
         """
 #        self.ctmqc_env['pos_tm'] = copy.deepcopy(self.ctmqc_env['pos'])
-        self.ctmqc_env['H_tm'] = copy.deepcopy(self.ctmqc_env['H'])
-        self.ctmqc_env['U_tm'] = copy.deepcopy(self.ctmqc_env['U'])
+        for key in ('H', 'U', 'E'):
+            wSpace.swap_tm(self.ctmqc_env, key)
         if self.adiab_diab == "adiab":
-            self.ctmqc_env['vel_tm'] = copy.deepcopy(self.ctmqc_env['vel'])
-            self.ctmqc_env['NACV_tm'] = copy.deepcopy(self.ctmqc_env['NACV'])
-            self.ctmqc_env['E_tm'] = copy.deepcopy(self.ctmqc_env['E'])
+            np.copyto(self.ctmqc_env['vel_tm'], self.ctmqc_env['vel'])
+            wSpace.swap_tm(self.ctmqc_env, 'NACV')
         if self.ctmqc_env['do_QM_C']:
-            self.ctmqc_env['Qlk_tm'] = copy.deepcopy(self.ctmqc_env['Qlk'])
-            self.ctmqc_env['Rlk_tm'] = copy.deepcopy(self.ctmqc_env['Rlk'])
-            self.ctmqc_env['adMom_tm'] = copy.deepcopy(self.ctmqc_env['adMom'])
-            self.ctmqc_env['sigma_tm'] = np.array(self.ctmqc_env['sigma'])
+            wSpace.swap_tm(self.ctmqc_env, 'Qlk')
+            wSpace.swap_tm(self.ctmqc_env, 'Rlk')
+            np.copyto(self.ctmqc_env['adMom_tm'], self.ctmqc_env['adMom'])
+            np.copyto(self.ctmqc_env['sigma_tm'], self.ctmqc_env['sigma'])
 
     def __save_data(self):
         """
         Will save data to RAM (arrays within this class)
         """
         istep = self.saveIter
-
-        self.allR[istep] = self.ctmqc_env['pos']
-        self.allNACV[istep] = self.ctmqc_env['NACV']
-        self.allF[istep] = self.ctmqc_env['frc']
-        self.allFeh[istep] = self.ctmqc_env['F_eh']
-        self.allFqm[istep] = self.ctmqc_env['F_qm']
+        if istep == len(self.allt):
+            self.__grow_arrays()  # The adaptive dt took more steps than planned
+
+        # Arrays with a nuclear dimension axis are reshaped to the saved shape
+        for allArr, key in ((self.allR, 'pos'), (self.allNACV, 'NACV'),
+                            (self.allF, 'frc'), (self.allFeh, 'F_eh'),
+                            (self.allFqm, 'F_qm'), (self.allAdMom, 'adMom'),
+                            (self.allAdFrc, 'adFrc'), (self.allv, 'vel'),
+                            (self.allQlk, 'Qlk'), (self.allRlk, 'Rlk'),
+                            (self.allEffR, 'effR')):
+            allArr[istep] = np.reshape(self.ctmqc_env[key],
+                                       np.shape(allArr)[1:])
         self.allE[istep] = self.ctmqc_env['E']
         self.allC[istep] = self.ctmqc_env['C']
         self.allu[istep] = self.ctmqc_env['u']
         self.allAdPop[istep] = self.ctmqc_env['adPops']
         self.allH[istep] = self.ctmqc_env['H']
-        self.allAdMom[istep] = self.ctmqc_env['adMom']
-        self.allAdFrc[istep] = self.ctmqc_env['adFrc']
-        self.allv[istep] = self.ctmqc_env['vel']
-        self.allQlk[istep] = self.ctmqc_env['Qlk']
-        self.allRlk[istep] = self.ctmqc_env['Rlk']
-        self.allEffR[istep] = self.ctmqc_env['effR']
         self.allSigma[istep] = self.ctmqc_env['sigma']
         self.allSigmal[istep] = self.ctmqc_env['sigmal']
         self.allRl[istep] = self.ctmqc_env['altR']
@@ -755,28 +1218,16 @@ class CTMQC(object):
         Will splice the arrays to the appropriate size (to num steps done)
         """
         self.ctmqc_env['iter'] -= 1
-        self.allR = self.allR[:self.saveIter]
-        self.allt = self.allt[:self.saveIter]
-        self.allNACV = self.allNACV[:self.saveIter]
-        self.allF = self.allF[:self.saveIter]
-        self.allFeh = self.allFeh[:self.saveIter]
-        self.allFqm = self.allFqm[:self.saveIter]
-        self.allE = self.allE[:self.saveIter]
-        self.allC = self.allC[:self.saveIter]
-        self.allu = self.allu[:self.saveIter]
-        self.allAdPop = self.allAdPop[:self.saveIter]
-        self.allH = self.allH[:self.saveIter]
-        self.allAdMom = self.allAdMom[:self.saveIter]
-        self.allAdFrc = self.allAdFrc[:self.saveIter]
-        self.allv = self.allv[:self.saveIter]
-        self.allQlk = self.allQlk[:self.saveIter]
-        self.allRlk = self.allRlk[:self.saveIter]
-        self.allEffR = self.allEffR[:self.saveIter]
-        self.allSigma = self.allSigma[:self.saveIter]
-        self.allSigmal = self.allSigmal[:self.saveIter]
-        self.allRl = self.allRl[:self.saveIter]
-        self.allAlphal = self.allAlphal[:self.saveIter]
-        self.allAlpha = self.allAlpha[:self.saveIter]
+        for name in self.savedArrays:
+            setattr(self, name, getattr(self, name)[:self.saveIter])
+
+    def __grow_arrays(self):
+        """
+        Will double the number of steps the save arrays can hold.
+        """
+        for name in self.savedArrays:
+            arr = getattr(self, name)
+            setattr(self, name, np.concatenate((arr, np.zeros_like(arr))))
 
     def __checkS26(self):
         """
@@ -830,7 +1281,11 @@ class CTMQC(object):
         correctly by comparing the velocities with the time-derivative
         positions.
         """
-        dx_dt = np.gradient(self.allR, self.ctmqc_env['dt'], axis=0)
+        spacing = self.ctmqc_env['dt']
+        if self.ctmqc_env['adaptive_dt'] \
+           or 'jumped' in self.ctmqc_env['stop_reason']:
+            spacing = self.allt  # The steps aren't evenly spaced
+        dx_dt = np.gradient(self.allR, spacing, axis=0)
         diff = np.abs(self.allv - dx_dt)
         worstCase = np.max(diff)
         avgCase = np.mean(diff)
@@ -852,13 +1307,19 @@ class CTMQC(object):
         self.allR = np.array(self.allR)
         self.allt = np.array(self.allt)
         self.__chop_arrays()
+        if self.ctmqc_env['adaptive_dt']:
+            # The drifts etc. are given per the dt that was asked for
+            self.ctmqc_env['dt'] = self.dtAsked
         # Small runs are probably tests
         if self.save_folder and not self.para:
             self.store_data()
 
         # Run tests on data (only after Ehrenfest, CTMQC normally fails!)
+        # (the compositions of substeps don't match the finite difference
+        # velocities as closely as plain velocity Verlet)
         if (self.ctmqc_env['do_QM_F'] or self.ctmqc_env['iter'] < 10) is False:
-            if self.tenSteps is False:
+            if self.tenSteps is False \
+               and self.ctmqc_env['nucl_integrator'] == 'verlet':
                self.__checkVV()
 
         # Print some useful info
@@ -874,12 +1335,37 @@ class CTMQC(object):
             msg += "  Avg. Time Per Step = %.2gs" % np.mean(self.allTimes['step'])
             msg += "  All Done!\n***\n"
 
+            nEvalSteps = float(nstep + 2)
+            evals = self.ctmqc_env['elec_evals']
+            msg += "\nElectronic structure evaluations per step "
+            msg += "(nrep = %i):" % self.ctmqc_env['nrep']
+            msg += "  H = %.3g" % (evals['H'] / nEvalSteps)
+            msg += "  dH/dx = %.3g" % (evals['dH'] / nEvalSteps)
+            msg += "  eig = %.3g" % (evals['eig'] / nEvalSteps)
+            msg += "  tabulated = %.3g\n" % (evals['table'] / nEvalSteps)
+
+            if self.ctmqc_env['stop_reason'] != 'max_time':
+                msg += "\nStopped early: %s\n" % self.ctmqc_env['stop_reason']
+
+            if self.ctmqc_env['adaptive_dt'] and self.allDt:
+                msg += "\nAdaptive dt: %i rejected steps" % self.dtRejected
+                msg += "  dt = %.3g - %.3g au" % (np.min(self.allDt),
+                                                  np.max(self.allDt))
+                msg += "  (mean %.3g au)\n" % np.mean(self.allDt)
+
+            if self.saveIter > 2:
+                ener, norm = get_drift_per_outer_step(self)
+                msg += "\nDrift per outer step "
+                msg += "(%i nuclear steps):" % self.ctmqc_env['qm_force_steps']
+                msg += "  Energy = %.2g Ha  Norm = %.2g\n" % (ener, norm)
+
             msg += "\n\nAverage Times:"
             print(msg)
         if self.save_folder is not False:
             print("Finished. Saving in %s" % self.save_folder)
         if not self.para:
             print_timings(self.allTimes, 1)
+        validation.print_violations(self.ctmqc_env)
 
     def plot_avg_vel(self):
         """
@@ -910,7 +1396,10 @@ def get_ener_drift(runData):
     Will get total energy drift.
     """
     potE = np.sum(runData.allAdPop * runData.allE, axis=2)
-    kinE = 0.5 * runData.ctmqc_env['mass'] * (runData.allv**2)
+    v2 = runData.allv**2
+    if np.ndim(v2) == 3:
+        v2 = np.sum(v2, axis=2)
+    kinE = 0.5 * runData.ctmqc_env['mass'] * v2
     totE = potE + kinE
     avgTotE = np.mean(totE, axis=1)
     Ndt = runData.ctmqc_env['dt']
@@ -918,6 +1407,27 @@ def get_ener_drift(runData):
     return fit[0] * Ndt * 41341.3745758
 
 
+def get_drift_per_outer_step(runData):
+    """
+    Will get the total energy and norm drifts per outer (quantum momentum
+    update) step, i.e. per qm_force_steps * dt, from a linear fit of the
+    replica averaged values against time.
+    """
+    outerDt = runData.ctmqc_env['dt'] \
+              * runData.ctmqc_env.get('qm_force_steps', 1)
+
+    potE = np.sum(runData.allAdPop * runData.allE, axis=2)
+    v2 = runData.allv**2
+    if np.ndim(v2) == 3:
+        v2 = np.sum(v2, axis=2)
+    totE = potE + (0.5 * runData.ctmqc_env['mass'] * v2)
+    enerFit = np.polyfit(runData.allt, np.mean(totE, axis=1), 1)
+
+    allNorms = np.sum(runData.allAdPop, axis=2)
+    normFit = np.polyfit(runData.allt, np.mean(allNorms, axis=1), 1)
+    return enerFit[0] * outerDt, normFit[0] * outerDt
+
+
 def save_vitals(runData):
     normEnerFile = "normEnerDrift.csv"
     firstLine = "Model,CTMQC,NRep,NuclDt,ElecDt,Norm,Ener,GitCommit\n"
@@ -944,7 +1454,7 @@ def save_vitals(runData):
         commit = subprocess.check_output(['git', 'rev-parse', 'HEAD']).decode("utf-8").strip("\n")
 
         line = (model, CTMQC, nrep, str(Ndt), str(Edt), norm, ener, commit)
-        f.write("%i,%s,%i,%s,%s,%.2g,%.2g,%s\n" % line)
+        f.write("%s,%s,%i,%s,%s,%.2g,%.2g,%s\n" % line)
 
 
 def doSim(iSim, para=False):
@@ -962,7 +1472,8 @@ def doSim(iSim, para=False):
     s_std = 0
 
     #if model == 1 or model == 2:
-    coeff = [[complex(1, 0), complex(0, 0)]
+    nstate = models.get_model(model).nstate
+    coeff = [[complex(1, 0)] + [complex(0, 0)] * (nstate - 1)
                 for iRep in range(nRep)]
     #else:
     #   coeff = [[complex(0, 0), complex(1, 0)]
@@ -985,6 +1496,14 @@ def doSim(iSim, para=False):
         corrP = p_mean / np.mean(pos)
     pos = np.array(pos) * corrP
 
+    # The other dimensions (of multi-dimensional models) start at rest around 0
+    ndim = models.get_model(model).ndim
+    if ndim > 1:
+        pos = np.column_stack([pos] + [[rd.gauss(0, pos_std)
+                                        for I in range(nRep)]
+                                       for idim in range(ndim - 1)])
+        vel = np.column_stack([vel] + [np.zeros(nRep)] * (ndim - 1))
+
 #    pos = np.array([-10.179425554537751, -8.742893542840743, -8.626051776044424,
 #                     -5.462026619970005, -11.022432382418035])
 #    vel = np.array([1.4884200000000000E-002, 1.4703400000000000E-002, 1.5176200000000001E-002,
@@ -0,0 +1,299 @@
+from __future__ import print_function
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+The registry of model Hamiltonians.
+
+Each model is a class that declares how many states (nstate) and nuclear
+dimensions (ndim) it has and provides vectorised functions for the diabatic
+Hamiltonian, H(x), and its gradient, dH(x). Both take an array of replica
+positions with shape (nrep, ndim). H returns an array with shape
+(nrep, nstate, nstate) and dH one with shape (nrep, ndim, nstate, nstate).
+
+Models are looked up by the 'tullyModel' setting, e.g.:
+    model = get_model(1)
+    model = get_model('superexchange')
+    model = get_model('ladder', nstate=5, Egap=0.01)
+
+New models can be added with register_model.
+
+@author: mellis
+"""
+import numpy as np
+
+import hamiltonian as Ham
+
+
+MODELS = {}
+
+
+def register_model(name, modelClass):
+    """
+    Will add a model class to the registry under the key name (this is what
+    the 'tullyModel' setting should be set to to use it).
+    """
+    MODELS[name] = modelClass
+    return modelClass
+
+
+def get_model(name, **params):
+    """
+    Will create the model registered under name. Any params are passed on to
+    the model (to override its default parameters).
+    """
+    if name not in MODELS:
+        print("Tully Model = %s" % str(name))
+        msg = "Incorrect tully model chosen. Available models are: %s" % (
+                           ", ".join(str(i) for i in sorted(MODELS, key=str)))
+        raise SystemExit(msg)
+    return MODELS[name](**params)
+
+
+class Model(object):
+    """
+    The base class for all models. Subclasses must set nstate (and ndim if
+    they aren't 1D) and define the H and dH methods.
+
+    Inputs:
+        * params => any parameters to override the model's defaults
+    """
+    nstate = 2
+    ndim = 1
+    defaults = {}
+
+    def __init__(self, **params):
+        for key in params:
+            if key not in self.defaults:
+                msg = "Unknown parameter '%s' for the %s model" % (
+                                                  key, type(self).__name__)
+                raise SystemExit(msg)
+        self.params = dict(self.defaults)
+        self.params.update(params)
+
+    def H(self, x):
+        """
+        Will create the diabatic Hamiltonian for all positions in x
+        """
+        raise NotImplementedError
+
+    def dH(self, x):
+        """
+        Will create the analytic gradient (dH/dx) for all positions in x
+        """
+        raise NotImplementedError
+
+    def get_key(self):
+        """
+        Will return a string that uniquely identifies the model and its
+        parameters (used to name the tabulated surfaces).
+        """
+        params = sorted(self.params.items())
+        return repr((type(self).__module__, type(self).__name__,
+                     self.nstate, self.ndim, params))
+
+
+class FunctionModel(Model):
+    """
+    Will wrap a pair of vectorised 1D H/dH functions (e.g. the Tully models
+    in hamiltonian.py) as a model. The parameters are the keyword arguments
+    of the functions.
+    """
+    Hfunc = None
+    dHfunc = None
+
+    def __init__(self, **params):
+        code = self.Hfunc.__code__
+        names = code.co_varnames[1:code.co_argcount]
+        self.defaults = dict(zip(names, self.Hfunc.__defaults__ or ()))
+        Model.__init__(self, **params)
+
+    def H(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        return type(self).Hfunc(x[..., 0], **self.params)
+
+    def dH(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        return type(self).dHfunc(x[..., 0], **self.params)[..., np.newaxis,
+                                                           :, :]
+
+
+def function_model(Hfunc, dHfunc):
+    """
+    Will create a model class from a pair of vectorised H/dH functions.
+    """
+    return type(Hfunc.__name__.replace("create_", "Model"), (FunctionModel,),
+                {'Hfunc': staticmethod(Hfunc),
+                 'dHfunc': staticmethod(dHfunc)})
+
+
+register_model(1, function_model(Ham.create_H1, Ham.create_dH1))
+register_model(2, function_model(Ham.create_H2, Ham.create_dH2))
+register_model(3, function_model(Ham.create_H3, Ham.create_dH3))
+register_model(4, function_model(Ham.create_H4, Ham.create_dH4))
+register_model('lin', function_model(Ham.create_Hlin, Ham.create_dHlin))
+
+
+class SuperExchange(Model):
+    """
+    Subotnik's 3 state super-exchange model. States 1 and 3 are only coupled
+    through the (energetically inaccessible) state 2:
+        V11 = 0, V22 = E2, V33 = E3
+        V12 = V23 = C exp(-D x^2), V13 = 0
+    """
+    nstate = 3
+    defaults = {'E2': 0.01, 'E3': 0.005, 'C': 0.001, 'D': 0.5}
+
+    def H(self, x):
+        x = np.asarray(x, dtype=np.float64)[..., 0]
+        p = self.params
+        V12 = p['C'] * np.exp(-p['D']*(x**2))
+
+        H = np.zeros(np.shape(x) + (3, 3))
+        H[..., 1, 1] = p['E2']
+        H[..., 2, 2] = p['E3']
+        H[..., 0, 1] = H[..., 1, 0] = V12
+        H[..., 1, 2] = H[..., 2, 1] = V12
+        return H
+
+    def dH(self, x):
+        x = np.asarray(x, dtype=np.float64)[..., 0]
+        p = self.params
+        dV12 = -2*p['D']*x * p['C'] * np.exp(-p['D']*(x**2))
+
+        dH = np.zeros(np.shape(x) + (1, 3, 3))
+        dH[..., 0, 0, 1] = dH[..., 0, 1, 0] = dV12
+        dH[..., 0, 1, 2] = dH[..., 0, 2, 1] = dV12
+        return dH
+
+
+register_model('superexchange', SuperExchange)
+
+
+class Ladder(Model):
+    """
+    A ladder of nstate diabatic states, evenly spaced by Egap, that all fall
+    (with the same tanh profile as Tully model 1) as x increases. Neighbouring
+    states are coupled by a gaussian centred on x = 0:
+        V_nn = n Egap - A tanh(B x)
+        V_n,n+1 = C exp(-D x^2)
+    """
+    nstate = 3
+    defaults = {'nstate': 3, 'Egap': 0.01, 'A': 0.01, 'B': 0.4, 'C': 0.005,
+                'D': 0.3}
+
+    def __init__(self, **params):
+        Model.__init__(self, **params)
+        self.nstate = int(self.params['nstate'])
+        if self.nstate < 2:
+            raise SystemExit("The ladder model needs at least 2 states")
+
+    def H(self, x):
+        x = np.asarray(x, dtype=np.float64)[..., 0]
+        p = self.params
+        diag = np.arange(self.nstate) * p['Egap']
+        diag = diag - (p['A'] * np.tanh(p['B']*x))[..., np.newaxis]
+        coup = p['C'] * np.exp(-p['D']*(x**2))
+
+        H = np.zeros(np.shape(x) + (self.nstate, self.nstate))
+        istate = np.arange(self.nstate)
+        H[..., istate, istate] = diag
+        H[..., istate[:-1], istate[1:]] = coup[..., np.newaxis]
+        H[..., istate[1:], istate[:-1]] = coup[..., np.newaxis]
+        return H
+
+    def dH(self, x):
+        x = np.asarray(x, dtype=np.float64)[..., 0]
+        p = self.params
+        dDiag = -p['A'] * p['B'] * (1 - np.tanh(p['B']*x)**2)
+        dCoup = -2*p['D']*x * p['C'] * np.exp(-p['D']*(x**2))
+
+        dH = np.zeros(np.shape(x) + (self.nstate, self.nstate))
+        istate = np.arange(self.nstate)
+        dH[..., istate, istate] = dDiag[..., np.newaxis]
+        dH[..., istate[:-1], istate[1:]] = dCoup[..., np.newaxis]
+        dH[..., istate[1:], istate[:-1]] = dCoup[..., np.newaxis]
+        return dH[..., np.newaxis, :, :]
+
+
+register_model('ladder', Ladder)
+
+
+class TullyModel1ND(Model):
+    """
+    Tully model 1 in ndim dimensions. The avoided crossing is along the first
+    coordinate and both states have the same harmonic confinement (with
+    force constant K) in the others. The coupling is a gaussian around the
+    origin:
+        V11 = A tanh(B x_0) + K/2 sum_{d>0} x_d^2
+        V22 = -A tanh(B x_0) + K/2 sum_{d>0} x_d^2
+        V12 = C exp(-D |x|^2)
+    """
+    defaults = {'ndim': 2, 'A': 0.03, 'B': 0.4, 'C': 0.005, 'D': 0.3,
+                'K': 1e-4}
+
+    def __init__(self, **params):
+        Model.__init__(self, **params)
+        self.ndim = int(self.params['ndim'])
+        if self.ndim < 1:
+            raise SystemExit("The model needs at least 1 dimension")
+
+    def H(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        p = self.params
+        V11 = p['A'] * np.tanh(p['B']*x[..., 0])
+        Vconf = 0.5 * p['K'] * np.sum(x[..., 1:]**2, axis=-1)
+        V12 = p['C'] * np.exp(-p['D'] * np.sum(x**2, axis=-1))
+        return Ham.make_2state_H(V11 + Vconf, V12, -V11 + Vconf)
+
+    def dH(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        p = self.params
+        V12 = p['C'] * np.exp(-p['D'] * np.sum(x**2, axis=-1))
+
+        dV11 = np.zeros(np.shape(x))
+        dV11[..., 0] = p['A'] * p['B'] * (1 - np.tanh(p['B']*x[..., 0])**2)
+        dVconf = p['K'] * x
+        dVconf[..., 0] = 0.0
+        dV12 = -2*p['D']*x * V12[..., np.newaxis]
+        return Ham.make_2state_H(dV11 + dVconf, dV12, -dV11 + dVconf)
+
+
+register_model('tully1_nd', TullyModel1ND)
+
+
+def test_model(name, nrep=2000, dx=1e-5, **params):
+    """
+    Will check the analytic gradient and NACV of a registered model against
+    central finite differences at random positions.
+    """
+    model = get_model(name, **params)
+    pos = (np.random.random((nrep, model.ndim)) * 30) - 15
+
+    FD_dH = np.zeros((nrep, model.ndim, model.nstate, model.nstate))
+    FD_NACV = np.zeros(np.shape(FD_dH))
+    env = {'Hfunc': model.H, 'dHfunc': model.dH}
+    props = Ham.get_elec_props(pos, env)
+    for idim in range(model.ndim):
+        step = np.zeros(model.ndim)
+        step[idim] = dx
+        FD_dH[:, idim] = (model.H(pos + step) - model.H(pos - step)) / (2*dx)
+
+        # The finite difference NACV: <phi_l | d phi_k / dx>
+        Up = Ham.get_elec_props(pos + step, env, U_ref=props['U'])['U']
+        Um = Ham.get_elec_props(pos - step, env, U_ref=props['U'])['U']
+        FD_NACV[:, idim] = np.einsum('...il,...ik->...lk', props['U'],
+                                     (Up - Um) / (2*dx))
+
+    for name, analytic, FD in (("dH/dx", model.dH(pos), FD_dH),
+                               ("NACV", props['NACV'], FD_NACV)):
+        scale = max(np.max(np.abs(FD)), 1e-300)
+        err = np.max(np.abs(analytic - FD)) / scale
+        print("%s: max relative difference = %.2g" % (name, err))
+        # Models 3 and 4 have kinks in d2H/dx2 so the FD error is O(dx) there
+        if err > 1e-4:
+            raise SystemExit("Analytic %s != Finite Difference" % name)
+
+
+#test_model('superexchange')
+#test_model('ladder', nstate=5)
+#test_model('tully1_nd', ndim=3)
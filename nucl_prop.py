@@ -9,16 +9,39 @@ Created on Thu May  9 14:41:21 2019
 import numpy as np
 
 
+# The nuclear integrators are symmetric compositions of velocity Verlet
+#  steps. These are the fractions of dt each of the substeps takes (see
+#  Yoshida, Phys. Lett. A 150, 262 (1990)). Above 2nd order some substeps
+#  have to go backwards in time.
+_w4 = 1. / (2 - 2**(1/3.))
+_s4 = 1. / (4 - 4**(1/3.))
+_w6 = (0.784513610477560, 0.235573213359357, -1.17767998417887)
+NUCL_INTEGRATORS = {
+    'verlet': (1.0,),
+    # The Forest-Ruth (Yoshida 4th order) triple jump
+    'yoshida4': (_w4, 1 - 2*_w4, _w4),
+    'forest_ruth': (_w4, 1 - 2*_w4, _w4),
+    # Suzuki's 5 stage 4th order (smaller error, 5 force evaluations)
+    'suzuki4': (_s4, _s4, 1 - 4*_s4, _s4, _s4),
+    # Yoshida's 6th order (solution A)
+    'yoshida6': _w6 + (1 - 2*sum(_w6),) + _w6[::-1],
+}
+
+
 def calc_ehren_adiab_force(irep, adFrc, adPops, ctmqc_env):
     """
-    Will calculate the ehrenfest force in the adiabatic basis
+    Will calculate the ehrenfest force in the adiabatic basis. adFrc has shape
+    (ndim, nstate) and the force returned has shape (ndim).
+
+    For a real NACV only the real part of conj(C_l) C_k is needed.
     """
     nstate = ctmqc_env['nstate']
     E = ctmqc_env['E'][irep]
     NACV = ctmqc_env['NACV'][irep]
+    realNACV = not np.iscomplexobj(NACV)
 
     # Population Weighted Sum
-    F = np.sum(adPops * adFrc)
+    F = np.sum(adPops * adFrc, axis=-1)
     
     # NACV bit
     for k in range(nstate):
@@ -28,23 +51,72 @@ def calc_ehren_adiab_force(irep, adFrc, adPops, ctmqc_env):
             Ck = ctmqc_env['C'][irep, k]
             Clk = Cl * Ck
             Ekl = E[k] - E[l]
-            F -= 2 * (Clk * Ekl * NACV[l, k]).real
+            if realNACV:
+                F -= 2 * (Clk.real * Ekl * NACV[..., l, k])
+            else:
+                F -= 2 * (Clk * Ekl * NACV[..., l, k]).real
     return F
 
 
 def calc_QM_force(C, QM, f, ctmqc_env):
     """
-    Will calculate the force due to the quantum momentum term for 1 replica and
-    1 atom.
+    Will calculate the force due to the quantum momentum term for 1 replica.
+    QM is the (ndim, nstate, nstate) Qlk array of the replica and f the
+    (ndim, nstate) adiabatic momentum. The force returned has shape (ndim).
 
     N.B. Doesn't work for multiple atoms at the moment!
     """
-    F = 0.0
+    F = np.zeros(np.shape(f)[0])
     for l in range(ctmqc_env['nstate']):
         for k in range(ctmqc_env['nstate']):
             if l == k: continue
-            F += f[l] * (f[k] - f[l]) * C[k] * C[l]
+            QMf = np.sum(QM[:, l, k] * f[:, l])
+            F += QMf * (f[:, k] - f[:, l]) * C[k] * C[l]
         
-    F *= -2 * QM
+    F *= -2
+
+    return F
+
+
+def calc_ehren_adiab_force_all(adFrc, adPops, C, E, NACV, out=None):
+    """
+    Will calculate the ehrenfest force in the adiabatic basis for all
+    replicas at once (see calc_ehren_adiab_force):
+        F = sum_l |C_l|^2 F_l - 2 sum_{l<k} Re(C_l^* C_k) (E_k - E_l) d_lk
+    adFrc has shape (nrep, ndim, nstate), adPops and E (nrep, nstate), C
+    (nrep, nstate) and NACV (nrep, ndim, nstate, nstate). The force has shape
+    (nrep, ndim) and is written into out if it is given.
+
+    For a real NACV only the real part of C_l^* C_k is needed.
+    """
+    F = np.einsum('rl,rdl->rd', adPops, adFrc, out=out)
+
+    # Only the l < k pairs are summed over
+    Clk = np.conjugate(C)[:, :, np.newaxis] * C[:, np.newaxis, :]
+    Ekl = E[:, np.newaxis, :] - E[:, :, np.newaxis]
+    if not np.iscomplexobj(NACV):
+        Clk = Clk.real
+    W = np.triu(Clk * Ekl, 1)
+    NACVterm = np.einsum('rlk,rdlk->rd', W, NACV)
+
+    F -= 2 * NACVterm.real
+    return F
+
+
+def calc_QM_force_all(adPops, Qlk, f, out=None):
+    """
+    Will calculate the force due to the quantum momentum term for all
+    replicas at once (see calc_QM_force):
+        F = -2 sum_{l != k} (sum_d Q_lk,d f_l,d) (f_k - f_l) |C_k|^2 |C_l|^2
+    adPops has shape (nrep, nstate), Qlk (nrep, ndim, nstate, nstate) and f
+    (nrep, ndim, nstate). The force has shape (nrep, ndim) and is written
+    into out if it is given.
+    """
+    # The l = k terms are 0 as f_k - f_l is
+    Qf = np.einsum('rdlk,rdl->rlk', Qlk, f)
+    Qf *= adPops[:, :, np.newaxis] * adPops[:, np.newaxis, :]
+    fdiff = f[:, :, np.newaxis, :] - f[:, :, :, np.newaxis]
+    F = np.einsum('rlk,rdlk->rd', Qf, fdiff, out=out)
 
+    F *= -2
     return F
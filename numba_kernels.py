@@ -0,0 +1,478 @@
+from __future__ import print_function
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compiled versions of the step kernels (electronic structure, electronic
+propagation, forces and the quantum momentum weights) using Numba.
+
+These are used instead of the NumPy code when the 'backend' setting is
+'numba'. The NumPy code in hamiltonian.py, elec_prop.py, nucl_prop.py and
+QM_utils.py is the reference implementation, each kernel here does exactly
+the same maths (test_parity compares the two).
+
+This module needs numba so it should only be imported once it's known to be
+installed (see main.CTMQC.__init_backend).
+
+@author: mellis
+"""
+import numpy as np
+import numba
+
+
+@numba.njit(cache=True)
+def elec_struct_2x2(H, dH):
+    """
+    Will calculate the energies, eigenvectors, adiabatic forces and NACV of a
+    stack of real 2 state Hamiltonians in one pass (see Ham.eigh_2x2 and
+    Ham.get_elec_props). dH has shape (nrep, ndim, 2, 2).
+    """
+    nrep, ndim = dH.shape[0], dH.shape[1]
+    E = np.empty((nrep, 2))
+    U = np.empty((nrep, 2, 2))
+    adFrc = np.empty((nrep, ndim, 2))
+    NACV = np.zeros((nrep, ndim, 2, 2))
+    for irep in range(nrep):
+        V11, V12, V22 = H[irep, 0, 0], H[irep, 0, 1], H[irep, 1, 1]
+        avgV = 0.5 * (V11 + V22)
+        radius = np.hypot(0.5 * (V11 - V22), V12)
+        E[irep, 0] = avgV - radius
+        E[irep, 1] = avgV + radius
+
+        theta = 0.5 * np.arctan2(2 * V12, V11 - V22)
+        cosT, sinT = np.cos(theta), np.sin(theta)
+        U[irep, 0, 0] = -sinT
+        U[irep, 1, 0] = cosT
+        U[irep, 0, 1] = cosT
+        U[irep, 1, 1] = sinT
+
+        # <phi_l | dH/dx | phi_k>
+        for d in range(ndim):
+            for l in range(2):
+                for k in range(2):
+                    gradH = 0.0
+                    for i in range(2):
+                        for j in range(2):
+                            gradH += (U[irep, i, l] * dH[irep, d, i, j]
+                                      * U[irep, j, k])
+                    if l == k:
+                        adFrc[irep, d, l] = -gradH
+                    else:
+                        dE = E[irep, k] - E[irep, l]
+                        if dE != 0:
+                            NACV[irep, d, l, k] = gradH / dE
+
+    return E, U, adFrc, NACV
+
+
+@numba.njit(cache=True)
+def _RK4(coeff, X1, X12, X2, dTe, K, tmp):
+    """
+    Will carry out the RK4 algorithm to propagate the coefficients of 1
+    replica in place (see elec_prop.__RK4). K and tmp are work arrays.
+    """
+    nstate = len(coeff)
+    for istep in range(4):
+        # The coefficients used for this stage
+        for i in range(nstate):
+            if istep == 0:
+                tmp[i] = coeff[i]
+            elif istep == 3:
+                tmp[i] = coeff[i] + K[2, i]
+            else:
+                tmp[i] = coeff[i] + K[istep-1, i]/2.
+
+        X = X12
+        if istep == 0:
+            X = X1
+        elif istep == 3:
+            X = X2
+        for i in range(nstate):
+            Xc = 0j
+            for j in range(nstate):
+                Xc += X[i, j] * tmp[j]
+            K[istep, i] = dTe * Xc
+
+    for i in range(nstate):
+        coeff[i] += (1./6.) * (K[0, i] + (2.*K[1, i]) + (2.*K[2, i]) + K[3, i])
+
+
+@numba.njit(cache=True)
+def _Xqm_diag(Qlk_tm, dQ, f_tm, df, s, adPops, Xqm):
+    """
+    Will make the diagonal of the quantum momentum part of X for 1 replica
+    (see elec_prop.makeX_adiab_Qlk) with Qlk and f interpolated to s. Qlk has
+    shape (ndim, nstate, nstate) and f (ndim, nstate).
+    """
+    nstate = len(adPops)
+    ndim = f_tm.shape[0]
+    for l in range(nstate):
+        Xqm[l] = 0.0
+        for k in range(nstate):
+            Qf = 0.0
+            for d in range(ndim):
+                fl = f_tm[d, l] + s*df[d, l]
+                fk = f_tm[d, k] + s*df[d, k]
+                Qf += (Qlk_tm[d, l, k] + s*dQ[d, l, k]) * (fk - fl)
+            Xqm[l] += Qf * adPops[k]
+
+
+@numba.njit(cache=True)
+def _makeX_adiab(E_tm, dE, NACV_tm, dNACV, v_tm, dv, Qlk_tm, dQ, f_tm, df,
+                 s, adPops, doQM, X, Xqm):
+    """
+    Will make the adiabatic X matrix for 1 replica (in X) with all the
+    quantities interpolated to s substeps after the previous step.
+    """
+    nstate = len(E_tm)
+    ndim = len(v_tm)
+    for l in range(nstate):
+        for k in range(nstate):
+            NACV_v = 0j
+            for d in range(ndim):
+                NACV_v += (NACV_tm[d, l, k] + s*dNACV[d, l, k]) \
+                          * (v_tm[d] + s*dv[d])
+            X[l, k] = -NACV_v
+        X[l, l] += -1j * (E_tm[l] + s*dE[l])
+    if doQM:
+        _Xqm_diag(Qlk_tm, dQ, f_tm, df, s, adPops, Xqm)
+        for l in range(nstate):
+            X[l, l] -= Xqm[l]
+
+
+@numba.njit(cache=True)
+def adiab_prop(C, E_tm, E, NACV_tm, NACV, v_tm, v, Qlk_tm, Qlk, f_tm, f,
+               dt, elec_steps, doQM):
+    """
+    Will propagate the adiabatic coefficients (C) of all replicas over a
+    nuclear step (see elec_prop.do_adiab_prop). All the quantities are
+    linearly interpolated between their values at the previous (*_tm) and
+    current step. elec_steps holds the number of substeps for each replica
+    (replicas with 0 are skipped).
+    """
+    nrep, nstate = C.shape
+
+    X1 = np.empty((nstate, nstate), dtype=np.complex128)
+    X12 = np.empty((nstate, nstate), dtype=np.complex128)
+    X2 = np.empty((nstate, nstate), dtype=np.complex128)
+    Xqm = np.empty(nstate)
+    K = np.empty((4, nstate), dtype=np.complex128)
+    tmp = np.empty(nstate, dtype=np.complex128)
+    adPops = np.empty(nstate)
+    for irep in range(nrep):
+        for l in range(nstate):
+            adPops[l] = C[irep, l].real**2 + C[irep, l].imag**2
+        nstep = elec_steps[irep]
+        if nstep == 0:
+            continue
+        dTe = dt / float(nstep)
+        dE = (E[irep] - E_tm[irep]) / nstep
+        dNACV = (NACV[irep] - NACV_tm[irep]) / nstep
+        dv = (v[irep] - v_tm[irep]) / nstep
+        dQ = (Qlk[irep] - Qlk_tm[irep]) / nstep
+        df = (f[irep] - f_tm[irep]) / nstep
+
+        _makeX_adiab(E_tm[irep], dE, NACV_tm[irep], dNACV, v_tm[irep], dv,
+                     Qlk_tm[irep], dQ, f_tm[irep], df, 0.0, adPops, doQM,
+                     X1, Xqm)
+        for Estep in range(nstep):
+            _makeX_adiab(E_tm[irep], dE, NACV_tm[irep], dNACV, v_tm[irep], dv,
+                         Qlk_tm[irep], dQ, f_tm[irep], df, Estep + 0.5,
+                         adPops, doQM, X12, Xqm)
+            _makeX_adiab(E_tm[irep], dE, NACV_tm[irep], dNACV, v_tm[irep], dv,
+                         Qlk_tm[irep], dQ, f_tm[irep], df, Estep + 1.0,
+                         adPops, doQM, X2, Xqm)
+
+            _RK4(C[irep], X1, X12, X2, dTe, K, tmp)
+            X1[:, :] = X2
+
+
+@numba.njit(cache=True)
+def _makeX_diab(H_tm, dH, U_tm, dU, Qlk_tm, dQ, f_tm, df, s, adPops, doQM,
+                X, Xqm):
+    """
+    Will make the diabatic X matrix for 1 replica (see
+    elec_prop.makeX_diab_QM) with all the quantities interpolated to s
+    substeps after the previous step.
+    """
+    nstate = len(adPops)
+    for i in range(nstate):
+        for j in range(nstate):
+            X[i, j] = -1j * (H_tm[i, j] + s*dH[i, j])
+    if doQM:
+        _Xqm_diag(Qlk_tm, dQ, f_tm, df, s, adPops, Xqm)
+        for i in range(nstate):
+            for j in range(nstate):
+                for l in range(nstate):
+                    X[i, j] -= ((U_tm[i, l] + s*dU[i, l]) * Xqm[l]
+                                * (U_tm[j, l] + s*dU[j, l]))
+
+
+@numba.njit(cache=True)
+def diab_prop(u, C, H_tm, H, U_tm, U, Qlk_tm, Qlk, f_tm, f, dt, elec_steps,
+              doQM):
+    """
+    Will propagate the diabatic coefficients (u) of all replicas over a
+    nuclear step (see elec_prop.do_diab_prop). elec_steps holds the number of
+    substeps for each replica (replicas with 0 are skipped).
+    """
+    nrep, nstate = u.shape
+
+    X1 = np.empty((nstate, nstate), dtype=np.complex128)
+    X12 = np.empty((nstate, nstate), dtype=np.complex128)
+    Xqm = np.empty(nstate)
+    K = np.empty((4, nstate), dtype=np.complex128)
+    tmp = np.empty(nstate, dtype=np.complex128)
+    adPops = np.empty(nstate)
+    for irep in range(nrep):
+        for l in range(nstate):
+            adPops[l] = C[irep, l].real**2 + C[irep, l].imag**2
+        nstep = elec_steps[irep]
+        if nstep == 0:
+            continue
+        dTe = dt / float(nstep)
+        dH = (H[irep] - H_tm[irep]) / nstep
+        dU = (U[irep] - U_tm[irep]) / nstep
+        dQ = (Qlk[irep] - Qlk_tm[irep]) / nstep
+        df = (f[irep] - f_tm[irep]) / nstep
+
+        _makeX_diab(H_tm[irep], dH, U_tm[irep], dU, Qlk_tm[irep], dQ,
+                    f_tm[irep], df, 0.0, adPops, doQM, X1, Xqm)
+        for Estep in range(nstep):
+            # The reference uses the mid-point X for the end of the substep
+            _makeX_diab(H_tm[irep], dH, U_tm[irep], dU, Qlk_tm[irep], dQ,
+                        f_tm[irep], df, Estep + 0.5, adPops, doQM, X12, Xqm)
+            _RK4(u[irep], X1, X12, X12, dTe, K, tmp)
+
+            # Adiabatic populations at the end of the substep
+            s = Estep + 1.0
+            for l in range(nstate):
+                Cl = 0j
+                for i in range(nstate):
+                    Cl += (U_tm[irep, i, l] + s*dU[i, l]) * u[irep, i]
+                adPops[l] = Cl.real**2 + Cl.imag**2
+            X1[:, :] = X12
+
+
+@numba.njit(cache=True)
+def trans_coeffs(U, coeff, out, toAdiab):
+    """
+    Will transform the coefficients of all replicas between the diabatic and
+    adiabatic basis (see elec_prop.trans_diab_to_adiab and
+    elec_prop.trans_adiab_to_diab). If toAdiab out = U^T coeff, otherwise
+    out = U coeff.
+    """
+    nrep, nstate = coeff.shape
+    for irep in range(nrep):
+        for i in range(nstate):
+            val = 0j
+            for j in range(nstate):
+                if toAdiab:
+                    val += U[irep, j, i] * coeff[irep, j]
+                else:
+                    val += U[irep, i, j] * coeff[irep, j]
+            out[irep, i] = val
+
+
+@numba.njit(cache=True)
+def renormalise(coeff):
+    """
+    Will renormalise the coefficients of all replicas in place.
+    """
+    nrep, nstate = coeff.shape
+    for irep in range(nrep):
+        norm = 0.0
+        for i in range(nstate):
+            norm += coeff[irep, i].real**2 + coeff[irep, i].imag**2
+        norm = np.sqrt(norm)
+        for i in range(nstate):
+            coeff[irep, i] = coeff[irep, i] / norm
+
+
+@numba.njit(cache=True)
+def calc_forces(adFrc, adPops, C, E, NACV, Qlk, adMom, doQM):
+    """
+    Will calculate the Ehrenfest and quantum momentum forces on all replicas
+    (see nucl_prop.calc_ehren_adiab_force and nucl_prop.calc_QM_force). Both
+    have shape (nrep, ndim).
+    """
+    nrep, ndim, nstate = adFrc.shape
+    Feh = np.zeros((nrep, ndim))
+    Fqm = np.zeros((nrep, ndim))
+    for irep in range(nrep):
+        for d in range(ndim):
+            F = 0.0
+            for l in range(nstate):
+                F += adPops[irep, l] * adFrc[irep, d, l]
+            for k in range(nstate):
+                for l in range(k):
+                    Clk = np.conj(C[irep, l]) * C[irep, k]
+                    Ekl = E[irep, k] - E[irep, l]
+                    F -= 2 * (Clk * Ekl * NACV[irep, d, l, k]).real
+            Feh[irep, d] = F
+
+        if doQM:
+            f = adMom[irep]
+            for l in range(nstate):
+                for k in range(nstate):
+                    if l == k: continue
+                    Qf = 0.0
+                    for d in range(ndim):
+                        Qf += Qlk[irep, d, l, k] * f[d, l]
+                    for d in range(ndim):
+                        Fqm[irep, d] += (Qf * (f[d, k] - f[d, l])
+                                         * adPops[irep, k] * adPops[irep, l])
+            for d in range(ndim):
+                Fqm[irep, d] *= -2
+    return Feh, Fqm
+
+
+@numba.njit(cache=True)
+def calc_WIJ(pos, sigma, reps_to_complete):
+    """
+    Will calculate the WIJ weights used in the quantum momentum (see
+    QM_utils.calc_WIJ) without storing the full matrix of gaussians. pos has
+    shape (nrep, ndim).
+    """
+    nrep, ndim = pos.shape
+    WIJ = np.zeros((nrep, nrep))
+    gauss = np.empty(nrep)
+    for I in reps_to_complete:
+        sumGauss = 0.0
+        for J in range(nrep):
+            dist2 = 0.0
+            for d in range(ndim):
+                dist2 += (pos[I, d] - pos[J, d])**2
+            gauss[J] = np.exp(-0.5 * dist2 / sigma[J]**2) / sigma[J]**ndim
+            sumGauss += gauss[J]
+        for J in range(nrep):
+            WIJ[I, J] = gauss[J] / (2 * sigma[J]**2 * sumGauss)
+    return WIJ
+
+
+def test_parity(nrep=50, nstate=2, ndim=1, seed=1, tol=1e-10):
+    """
+    Will compare each compiled kernel with the NumPy reference code on random
+    inputs (for a 2 state model if ndim > 1).
+    """
+    import hamiltonian as Ham
+    import elec_prop as e_prop
+    import nucl_prop
+    import QM_utils as qUt
+    import models
+
+    np.random.seed(seed)
+    if ndim > 1:
+        model = models.get_model('tully1_nd', ndim=ndim)
+    elif nstate == 2:
+        model = models.get_model(1)
+    else:
+        model = models.get_model('ladder', nstate=nstate)
+    nstate = model.nstate
+    pos = np.random.normal(0, 3, (nrep, ndim))
+    pos_tm = pos - np.random.random((nrep, ndim)) * 0.05
+
+    def rand_C():
+        C = np.random.random((nrep, nstate)) \
+            + 1j * np.random.random((nrep, nstate))
+        return C / np.linalg.norm(C, axis=1)[:, None]
+
+    def rand_sym(scale):
+        Q = np.random.random((nrep, ndim, nstate, nstate)) * scale
+        return Q + np.swapaxes(Q, -1, -2)
+
+    env = {'Hfunc': model.H, 'dHfunc': model.dH, 'nstate': nstate,
+           'nrep': nrep, 'dt': 0.41341373336565040, 'elec_steps': 5,
+           'do_QM_C': True, 'mass': 2000., 'sigma': np.random.random(nrep)+.3}
+    env_tm = dict(env)
+    env.update(Ham.get_elec_props(pos, env))
+    env_tm.update(Ham.get_elec_props(pos_tm, env_tm, U_ref=env['U']))
+    env['NACV'] = env['NACV'].astype(complex)
+    env['pos'], env['vel'] = pos, np.random.random((nrep, ndim)) * 0.02
+    for key in ('H', 'U', 'E', 'NACV'):
+        env[key + '_tm'] = env_tm[key].astype(env[key].dtype)
+    env['vel_tm'] = env['vel'] - np.random.random((nrep, ndim)) * 1e-4
+    env['Qlk'], env['Qlk_tm'] = rand_sym(0.1), rand_sym(0.1)
+    env['adMom'] = np.random.random((nrep, ndim, nstate)) * 0.1
+    env['adMom_tm'] = env['adMom'] \
+                      - np.random.random((nrep, ndim, nstate)) * 1e-3
+    env['C'] = rand_C()
+    env['adPops'] = (np.conjugate(env['C']) * env['C']).real
+    env['u'] = np.einsum('...ij,...j->...i', env['U'], env['C'])
+    env['adFrc'] = -np.random.random((nrep, ndim, nstate)) * 0.01
+
+    def check(name, ref, new):
+        err = np.max(np.abs(np.asarray(ref) - np.asarray(new)))
+        print("%s: max abs difference = %.2g" % (name, err))
+        if err > tol:
+            raise SystemExit("Numba %s kernel doesn't match NumPy" % name)
+
+    # Electronic structure
+    if nstate == 2:
+        ref = Ham.get_elec_props(pos, {'Hfunc': model.H,
+                                       'dHfunc': model.dH})
+        new = elec_struct_2x2(ref['H'], ref['dH'])
+        for key, val in zip(('E', 'U', 'adFrc', 'NACV'), new):
+            check("elec. struct. (%s)" % key, ref[key], val)
+
+    # Electronic propagation with a fixed and an adaptive number of substeps
+    for stepTol in (False, 1e-10):
+        for prop, coeff in (('adiab', 'C'), ('diab', 'u')):
+            refEnv = {key: np.copy(env[key])
+                      if isinstance(env[key], np.ndarray) else env[key]
+                      for key in env}
+            refEnv['elec_step_tol'] = stepTol
+            if prop == 'adiab':
+                e_prop.do_adiab_prop(refEnv)
+                new = np.copy(env['C'])
+                adiab_prop(new, env['E_tm'], env['E'], env['NACV_tm'],
+                           env['NACV'], env['vel_tm'], env['vel'],
+                           env['Qlk_tm'], env['Qlk'], env['adMom_tm'],
+                           env['adMom'], env['dt'], refEnv['elec_steps_used'],
+                           True)
+            else:
+                e_prop.do_diab_prop(refEnv)
+                new = np.copy(env['u'])
+                diab_prop(new, env['C'], env['H_tm'], env['H'], env['U_tm'],
+                          env['U'], env['Qlk_tm'], env['Qlk'], env['adMom_tm'],
+                          env['adMom'], env['dt'], refEnv['elec_steps_used'],
+                          True)
+            nsteps = refEnv['elec_steps_used']
+            check("%s. propagation (%i-%i substeps)" % (prop, np.min(nsteps),
+                                                        np.max(nsteps)),
+                  refEnv[coeff], new)
+
+    # Basis transformations
+    refEnv = dict(env, C=np.zeros_like(env['C']))
+    e_prop.trans_diab_to_adiab(refEnv)
+    new = np.zeros_like(env['C'])
+    trans_coeffs(env['U'], env['u'], new, True)
+    check("diab. to adiab. transform", refEnv['C'], new)
+    refEnv = dict(env, u=np.zeros_like(env['u']))
+    e_prop.trans_adiab_to_diab(refEnv)
+    trans_coeffs(env['U'], env['C'], new, False)
+    check("adiab. to diab. transform", refEnv['u'], new)
+    new = env['u'] * 1.1
+    renormalise(new)
+    check("renormalisation", e_prop.renormalise_all_coeffs(env['u'] * 1.1),
+          new)
+
+    # Forces
+    Feh, Fqm = calc_forces(env['adFrc'], env['adPops'], env['C'], env['E'],
+                           env['NACV'], env['Qlk'], env['adMom'], True)
+    refFeh = [nucl_prop.calc_ehren_adiab_force(irep, env['adFrc'][irep],
+                                               env['adPops'][irep], env)
+              for irep in range(nrep)]
+    refFqm = [nucl_prop.calc_QM_force(env['adPops'][irep], env['Qlk'][irep],
+                                      env['adMom'][irep], env)
+              for irep in range(nrep)]
+    check("Ehrenfest force", refFeh, Feh)
+    check("QM force", refFqm, Fqm)
+
+    # Quantum momentum weights
+    reps = np.arange(nrep)
+    check("WIJ", qUt.calc_WIJ(env, reps), calc_WIJ(pos, env['sigma'], reps))
+
+
+#test_parity()
+#test_parity(nstate=4)
+#test_parity(ndim=3)
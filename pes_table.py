@@ -0,0 +1,262 @@
+from __future__ import print_function
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tabulated potential energy surfaces for the 1D models.
+
+For a fixed model the energies, eigenvectors, adiabatic forces and NACV only
+depend on the position so they can be calculated once on a grid and
+interpolated with a cubic spline from then on. Grid intervals are bisected
+until the spline reproduces the exact values at their midpoints to within a
+given tolerance.
+
+Tables are saved to disk (keyed on the model, its parameters, the range and
+the tolerance) so they can be reused by later runs and by other
+worker processes.
+
+@author: mellis
+"""
+import hashlib
+import os
+
+import numpy as np
+
+import hamiltonian as Ham
+
+
+TABLE_VERSION = 3
+
+
+class PESTable(object):
+    """
+    Will store the tabulated electronic structure properties of a model and
+    interpolate them with a cubic spline.
+
+    Inputs:
+        * x     => the grid positions <np.array (ngrid)>
+        * props => dict of the properties on the grid, each with shape
+                   (ngrid, ...) (see Ham.get_elec_props)
+    """
+    def __init__(self, x, props):
+        from scipy.interpolate import CubicSpline
+
+        self.x = np.asarray(x, dtype=np.float64)
+        self.xmin, self.xmax = self.x[0], self.x[-1]
+        self.props = props
+
+        # Pack all the properties into a single array so 1 spline evaluation
+        #  gets everything.
+        self.keys = sorted(props)
+        self.shapes = {key: np.shape(props[key])[1:] for key in self.keys}
+        self.dtypes = {key: props[key].dtype for key in self.keys}
+        data = [_as_real_columns(props[key]) for key in self.keys]
+        self.ncols = [np.shape(i)[1] for i in data]
+        self.spline = CubicSpline(self.x, np.concatenate(data, axis=1),
+                                  axis=0)
+
+    def in_range(self, pos):
+        """
+        Will return a mask of which positions are within the table.
+        """
+        return (pos >= self.xmin) & (pos <= self.xmax)
+
+    def lookup(self, pos):
+        """
+        Will interpolate all the properties at the positions pos.
+        """
+        data = self.spline(np.clip(pos, self.xmin, self.xmax))
+
+        props = {}
+        icol = 0
+        for key, ncol in zip(self.keys, self.ncols):
+            vals = _from_real_columns(data[:, icol:icol+ncol],
+                                      self.dtypes[key])
+            props[key] = vals.reshape((len(pos),) + self.shapes[key])
+            icol += ncol
+        return props
+
+    def save(self, filepath):
+        """
+        Will save the table as a numpy .npz file. The file is written to a
+        temporary name and then moved so other processes never see a
+        partially written table.
+        """
+        folder = os.path.dirname(filepath)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+
+        tmpPath = "%s.%i.tmp.npz" % (filepath, os.getpid())
+        np.savez(tmpPath, x=self.x, **self.props)
+        os.rename(tmpPath, filepath)
+
+
+def _as_real_columns(arr):
+    """
+    Will flatten an array of shape (ngrid, ...) into real columns (complex
+    arrays are split into real and imaginary parts).
+    """
+    arr = np.reshape(arr, (len(arr), -1))
+    if np.iscomplexobj(arr):
+        return np.concatenate((arr.real, arr.imag), axis=1)
+    return arr
+
+
+def _from_real_columns(cols, dtype):
+    """
+    Will undo _as_real_columns.
+    """
+    if np.issubdtype(dtype, np.complexfloating):
+        ncol = np.shape(cols)[1] // 2
+        return cols[:, :ncol] + 1j * cols[:, ncol:]
+    return cols
+
+
+def _spline_errors(x, props, xmid, exactMid):
+    """
+    Will find the relative error of the spline through the props on grid x
+    compared to the exact values at the midpoints xmid (the maximum over all
+    properties for each interval).
+    """
+    table = PESTable(x, props)
+    splineMid = table.lookup(xmid)
+
+    errs = np.zeros(len(xmid))
+    for key in props:
+        scale = np.max(np.abs(props[key]))
+        if scale == 0: continue
+        err = np.abs(splineMid[key] - exactMid[key]) / scale
+        err = np.max(np.reshape(err, (len(xmid), -1)), axis=1)
+        errs = np.maximum(errs, err)
+    return errs
+
+
+def _align_along_grid(props):
+    """
+    Will make the adiabatic states vary smoothly along the grid by aligning
+    each grid point's eigenvectors with the previous point's.
+    """
+    for i in range(1, len(props['U'])):
+        perm, signs = Ham.get_state_alignment(props['U'][i:i+1],
+                                              props['U'][i-1:i])
+        point = {key: props[key][i:i+1] for key in props}
+        point = Ham.apply_state_alignment(point, perm, signs)
+        for key in props:
+            props[key][i] = point[key][0]
+    return props
+
+
+def build_pes_table(ctmqc_env, xmin, xmax, tol=1e-8, ngrid=257,
+                    maxGrid=2**20):
+    """
+    Will build a tabulated surface between xmin and xmax for the (1D) model in
+    ctmqc_env (needs the 'Hfunc' and 'dHfunc').
+
+    Each interval of the grid is bisected until the relative error of the
+    spline at its midpoint is below tol for all properties. This refines the
+    grid locally, so kinks in the surfaces (e.g. at x = 0 in model 3) don't
+    force a fine grid everywhere.
+    """
+    # Use a separate env so the counts of evaluations in the main one aren't
+    #  affected by building the table.
+    env = {'Hfunc': ctmqc_env['Hfunc'], 'dHfunc': ctmqc_env['dHfunc']}
+
+    x = np.linspace(xmin, xmax, ngrid)
+    props = _align_along_grid(Ham.get_elec_props(x[:, np.newaxis], env))
+    while True:
+        xmid = 0.5 * (x[1:] + x[:-1])
+        exactMid = Ham.get_elec_props(xmid[:, np.newaxis], env,
+                                      U_ref=props['U'][:-1])
+        errs = _spline_errors(x, props, xmid, exactMid)
+        badInts = errs >= tol
+        if not np.any(badInts):
+            break
+        if len(x) > maxGrid:
+            print("WARNING: PES table didn't reach a tolerance of %.2g " % tol
+                  + "(error = %.2g with %i points)" % (np.max(errs), len(x)))
+            break
+
+        # Add the midpoints of the bad intervals to the grid
+        x = np.concatenate((x, xmid[badInts]))
+        order = np.argsort(x, kind='mergesort')
+        x = x[order]
+        for key in props:
+            newProp = np.concatenate((props[key], exactMid[key][badInts]))
+            props[key] = newProp[order]
+
+    return PESTable(x, props)
+
+
+def get_table_filepath(ctmqc_env, xmin, xmax, tol):
+    """
+    Will get the filepath the table for the model in ctmqc_env is (or would
+    be) saved in. The name is a hash of the model (and its parameters), the
+    range and tolerance.
+    """
+    key = ctmqc_env['model'].get_key()
+    name = "Model_%s" % str(ctmqc_env['tullyModel'])
+    key = repr((key, float(xmin), float(xmax), float(tol), TABLE_VERSION))
+    hashStr = hashlib.md5(key.encode("utf-8")).hexdigest()
+
+    folder = ctmqc_env.get('pes_table_folder', './pes_tables')
+    return "%s/%s_%s.npz" % (folder, name, hashStr)
+
+
+def load_pes_table(filepath):
+    """
+    Will load a table saved with PESTable.save.
+    """
+    with np.load(filepath) as data:
+        x = data['x']
+        props = {key: data[key] for key in data.files if key != 'x'}
+    return PESTable(x, props)
+
+
+def get_pes_table(ctmqc_env):
+    """
+    Will get the tabulated surface for the model in ctmqc_env. This will be
+    read from disk if it has already been built, otherwise it'll be built and
+    saved.
+
+    Settings (in ctmqc_env):
+        * pes_table_range  => (xmin, xmax) of the table
+        * pes_table_tol    => the relative error tolerance of the spline
+        * pes_table_folder => where to save the tables
+    """
+    xmin, xmax = ctmqc_env.get('pes_table_range', (-40, 80))
+    tol = ctmqc_env.get('pes_table_tol', 1e-8)
+
+    filepath = get_table_filepath(ctmqc_env, xmin, xmax, tol)
+    if os.path.isfile(filepath):
+        return load_pes_table(filepath)
+
+    table = build_pes_table(ctmqc_env, xmin, xmax, tol)
+    table.save(filepath)
+    return table
+
+
+def test_pes_table(name, xmin=-20, xmax=20, tol=1e-8, nrep=4000):
+    """
+    Will compare the tabulated properties with the exact ones at random
+    positions for the registered (1D) model name.
+    """
+    import models
+    model = models.get_model(name)
+    env = {'Hfunc': model.H, 'dHfunc': model.dH}
+    table = build_pes_table(env, xmin, xmax, tol)
+
+    pos = (np.random.random(nrep) * (xmax - xmin)) + xmin
+    exact = Ham.get_elec_props(pos[:, np.newaxis], env)
+    interp = table.lookup(pos)
+    print("Grid points: %i" % len(table.x))
+    for key in sorted(exact):
+        scale = max(np.max(np.abs(exact[key])), 1e-300)
+        err = np.max(np.abs(exact[key] - interp[key])) / scale
+        print("%s: max relative error = %.2g" % (key, err))
+        if err > 10 * tol:
+            raise SystemExit("Tabulated %s is not accurate enough" % key)
+
+
+#test_pes_table(1)
+#test_pes_table(2)
+#test_pes_table(3)
+#test_pes_table(4)
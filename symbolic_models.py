@@ -0,0 +1,271 @@
+from __future__ import print_function
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Models defined by symbolic expressions for the diabatic matrix elements.
+
+A model is defined by a dict (e.g. in the 'symbolic_models' setting):
+    {'H': [["A*tanh(B*x)", "C*exp(-D*x**2)"],
+           [None,          "-A*tanh(B*x)"]],
+     'coords': ['x'],
+     'params': {'A': 0.01, 'B': 1.6, 'C': 0.005, 'D': 1.0}}
+
+Only the upper triangle of H is needed (the lower one can be None and is
+filled in as the transpose). Each coordinate is a nuclear dimension and each
+parameter can be overridden with the 'model_params' setting as for the built
+in models.
+
+The expressions are differentiated with sympy and turned into vectorised
+NumPy code for H and dH/dx (with the common sub-expressions pulled out). The
+generated code is saved as a python module (keyed on a hash of the
+definition) so sympy is only needed the first time a model is compiled.
+
+@author: mellis
+"""
+import hashlib
+import importlib.util
+import os
+import sys
+
+import numpy as np
+
+import models
+
+
+CODEGEN_VERSION = 1
+
+
+class SymbolicModel(models.Model):
+    """
+    A model whose H and dH are in a generated module (see compile_model).
+    """
+    module = None
+    source_hash = ""
+
+    def H(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        return self.module.H(x, **self.params)
+
+    def dH(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        return self.module.dH(x, **self.params)
+
+    def get_key(self):
+        return repr((models.Model.get_key(self), self.source_hash))
+
+
+def _check_definition(definition):
+    """
+    Will check the model definition has everything needed and return the
+    matrix elements (as strings), coordinates and default parameters.
+    """
+    if 'H' not in definition:
+        raise SystemExit("The symbolic model definition needs an 'H' entry")
+    coords = [str(i) for i in definition.get('coords', ['x'])]
+    params = dict(definition.get('params', {}))
+
+    H = definition['H']
+    nstate = len(H)
+    if nstate < 1 or any(len(row) != nstate for row in H):
+        raise SystemExit("The symbolic H must be a square (nstate x nstate) "
+                         + "list of lists")
+    elements = [[None] * nstate for i in range(nstate)]
+    for i in range(nstate):
+        for j in range(i, nstate):
+            if H[i][j] is None:
+                raise SystemExit("H[%i][%i] needs an expression" % (i, j))
+            elements[i][j] = str(H[i][j])
+            if j != i and H[j][i] is not None and str(H[j][i]) != str(H[i][j]):
+                raise SystemExit("H[%i][%i] != H[%i][%i], the symbolic " % (
+                                                             j, i, i, j)
+                                 + "H must be symmetric")
+
+    for name in params:
+        if name in coords:
+            raise SystemExit("'%s' is both a coordinate and a parameter" % name)
+    # Names starting with _ are used by the generated code
+    for name in coords + list(params):
+        if not name.isidentifier() or name.startswith("_") or name == "numpy":
+            raise SystemExit("'%s' can't be used as a symbol name" % name)
+    return elements, coords, params
+
+
+def _get_source_hash(elements, coords, params):
+    """
+    Will hash everything that changes the generated code.
+    """
+    key = repr((elements, coords, sorted(params), CODEGEN_VERSION))
+    return hashlib.md5(key.encode("utf-8")).hexdigest()
+
+
+def generate_source(elements, coords, params):
+    """
+    Will generate the source of a module with the vectorised H(x, **params)
+    and dH(x, **params) functions of the model. x has shape (nrep, ndim), H
+    returns (nrep, nstate, nstate) and dH (nrep, ndim, nstate, nstate).
+    """
+    try:
+        import sympy
+        from sympy.printing.numpy import NumPyPrinter
+    except ImportError:
+        raise SystemExit("Compiling a symbolic model needs sympy")
+
+    symbols = {name: sympy.Symbol(name, real=True)
+               for name in list(coords) + list(params)}
+    nstate, ndim = len(elements), len(coords)
+    H = {}
+    for i in range(nstate):
+        for j in range(i, nstate):
+            try:
+                H[i, j] = sympy.sympify(elements[i][j], locals=symbols)
+            except (sympy.SympifyError, SyntaxError) as E:
+                raise SystemExit("Can't parse H[%i][%i] = '%s': %s" % (
+                                               i, j, elements[i][j], E))
+            unknown = H[i, j].free_symbols - set(symbols.values())
+            if unknown:
+                msg = "Unknown symbols in H[%i][%i]: %s" % (
+                              i, j, ", ".join(sorted(str(s) for s in unknown)))
+                raise SystemExit(msg)
+
+    dH = {}
+    for d, name in enumerate(coords):
+        for (i, j), expr in H.items():
+            dH[d, i, j] = sympy.diff(expr, symbols[name])
+
+    printer = NumPyPrinter({'fully_qualified_modules': True,
+                            'allow_unknown_functions': False})
+    args = ", ".join(["_pos"] + sorted(params))
+
+    def func_source(funcName, exprs, shape, doc):
+        """
+        Will write a function that fills an array with the exprs (keyed on
+        their index in the array).
+        """
+        keys = sorted(k for k in exprs if exprs[k] != 0)
+        subExprs, reduced = sympy.cse([exprs[k] for k in keys],
+                                      symbols=sympy.numbered_symbols("_s"))
+        lines = ["def %s(%s):" % (funcName, args),
+                 '    """',
+                 "    %s" % doc,
+                 '    """']
+        for d, name in enumerate(coords):
+            lines.append("    %s = _pos[..., %i]" % (name, d))
+        lines.append("    _out = numpy.zeros(numpy.shape(_pos)[:-1] + %s)" % (
+                                                                     shape,))
+        for sym, expr in subExprs:
+            lines.append("    %s = %s" % (sym, printer.doprint(expr)))
+        for key, expr in zip(keys, reduced):
+            ind = ", ".join(str(i) for i in key)
+            lines.append("    _out[..., %s] = %s" % (ind,
+                                                    printer.doprint(expr)))
+            if key[-2] != key[-1]:
+                ind = ", ".join(str(i) for i in key[:-2] + (key[-1], key[-2]))
+                lines.append("    _out[..., %s] = _out[..., %s]" % (
+                                ind, ", ".join(str(i) for i in key)))
+        lines.append("    return _out")
+        return "\n".join(lines)
+
+    source = ['"""',
+              "Generated by symbolic_models.py (version %i) from:" % (
+                                                             CODEGEN_VERSION),
+              "    coords = %r" % (coords,),
+              "    params = %r" % (sorted(params),)]
+    for i in range(nstate):
+        source.append("    H[%i] = %r" % (i, elements[i]))
+    source += ['"""',
+               "import numpy",
+               "",
+               "NSTATE = %i" % nstate,
+               "NDIM = %i" % ndim,
+               "",
+               "",
+               func_source("H", H, (nstate, nstate),
+                           "Will create the diabatic Hamiltonian"),
+               "",
+               "",
+               func_source("dH", dH, (ndim, nstate, nstate),
+                           "Will create the gradient of the Hamiltonian"),
+               ""]
+    return "\n".join(source)
+
+
+def _load_module(filepath, moduleName):
+    """
+    Will import the generated module at filepath.
+    """
+    spec = importlib.util.spec_from_file_location(moduleName, filepath)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    sys.modules[moduleName] = module
+    return module
+
+
+def compile_model(name, definition, folder='./model_cache'):
+    """
+    Will compile the symbolic model definition (see the module docstring) and
+    register it under name (so it can be used as the 'tullyModel').
+
+    The generated code is saved in folder and reused if the same definition
+    is compiled again.
+    """
+    elements, coords, params = _check_definition(definition)
+    hashStr = _get_source_hash(elements, coords, params)
+    moduleName = "symbolic_model_%s" % hashStr
+    filepath = "%s/%s.py" % (folder, moduleName)
+
+    if not os.path.isfile(filepath):
+        source = generate_source(elements, coords, params)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+        # Write to a temporary file first so other processes never import a
+        #  partially written module.
+        tmpPath = "%s.%i.tmp" % (filepath, os.getpid())
+        with open(tmpPath, 'w') as f:
+            f.write(source)
+        os.rename(tmpPath, filepath)
+
+    module = _load_module(filepath, moduleName)
+    modelClass = type("SymbolicModel_%s" % str(name), (SymbolicModel,),
+                      {'module': module, 'source_hash': hashStr,
+                       'nstate': module.NSTATE, 'ndim': module.NDIM,
+                       'defaults': params})
+    return models.register_model(name, modelClass)
+
+
+def compile_models(definitions, folder='./model_cache'):
+    """
+    Will compile and register all the model definitions in a dict of
+    {name: definition}.
+    """
+    for name in definitions:
+        compile_model(name, definitions[name], folder)
+
+
+def test_symbolic_model(folder='./model_cache'):
+    """
+    Will compile the multi-dimensional Tully model 1 from its expressions and
+    compare it with the hand written one in models.py.
+    """
+    definition = {'H': [["A*tanh(B*x) + K/2*(y**2 + z**2)",
+                         "C*exp(-D*(x**2 + y**2 + z**2))"],
+                        [None, "-A*tanh(B*x) + K/2*(y**2 + z**2)"]],
+                  'coords': ['x', 'y', 'z'],
+                  'params': {'A': 0.03, 'B': 0.4, 'C': 0.005, 'D': 0.3,
+                             'K': 1e-4}}
+    compile_model('test_symbolic', definition, folder)
+    symModel = models.get_model('test_symbolic', C=0.01)
+    refModel = models.get_model('tully1_nd', ndim=3, C=0.01)
+
+    pos = (np.random.random((1000, 3)) * 30) - 15
+    for funcName in ("H", "dH"):
+        sym = getattr(symModel, funcName)(pos)
+        ref = getattr(refModel, funcName)(pos)
+        err = np.max(np.abs(sym - ref))
+        print("%s: max abs difference = %.2g" % (funcName, err))
+        if err > 1e-14:
+            raise SystemExit("Compiled %s doesn't match models.py" % funcName)
+    models.test_model('test_symbolic')
+
+
+#test_symbolic_model()
@@ -0,0 +1,90 @@
+from __future__ import print_function
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Runtime consistency checks (linear interpolation of the propagated
+quantities, norm conservation of the quantum momentum term, symmetry of Qlk
+and the NACV, real populations...).
+
+All the checks in the main loop go through do_checks so how often they are
+run is set by the 'validation' setting:
+    * 'off'     => never
+    * 'sampled' => every 'validation_every' steps
+    * 'full'    => every step
+
+Violations are counted (with details of the first one) in
+ctmqc_env['check_violations'] and reported at the end of the run by
+print_violations. If 'validation_strict' is True the first violation stops
+the run instead.
+
+@author: mellis
+"""
+LEVELS = ('off', 'sampled', 'full')
+
+
+def init_validation(ctmqc_env):
+    """
+    Will check the validation settings and reset the violation counts.
+    """
+    level = str(ctmqc_env.setdefault('validation', 'sampled')).lower()
+    if level not in LEVELS:
+        msg = "Unknown validation level '%s'. Use %s" % (
+                               level, ", ".join("'%s'" % i for i in LEVELS))
+        raise SystemExit(msg)
+    ctmqc_env['validation'] = level
+
+    every = int(ctmqc_env.setdefault('validation_every', 100))
+    if every < 1:
+        raise SystemExit("The validation_every should be at least 1")
+    ctmqc_env['validation_every'] = every
+    ctmqc_env['check_violations'] = {}
+
+
+def do_checks(ctmqc_env):
+    """
+    Will return whether the checks should be run this step. If the validation
+    level hasn't been set (e.g. in the test functions) everything is checked.
+    """
+    level = ctmqc_env.get('validation', 'full')
+    if level == 'full':
+        return True
+    elif level == 'off':
+        return False
+    return ctmqc_env.get('iter', 0) % ctmqc_env['validation_every'] == 0
+
+
+def record_check(ctmqc_env, name, ok, detail=""):
+    """
+    Will record the result of the check called name. If it failed the
+    violation is counted (and the run stopped if 'validation_strict').
+    Returns ok.
+    """
+    if ok:
+        return True
+
+    detail = "step %i: %s" % (ctmqc_env.get('iter', 0), detail)
+    if ctmqc_env.get('validation_strict', False):
+        raise SystemExit("Check failed: %s (%s)" % (name, detail))
+
+    violations = ctmqc_env.setdefault('check_violations', {})
+    if name in violations:
+        violations[name][0] += 1
+    else:
+        violations[name] = [1, detail]
+    return False
+
+
+def print_violations(ctmqc_env):
+    """
+    Will print a summary of all the failed checks.
+    """
+    violations = ctmqc_env.get('check_violations', {})
+    if not violations:
+        return
+
+    msg = "\nWARNING: Some runtime checks failed "
+    msg += "(validation = '%s'):" % ctmqc_env.get('validation', 'full')
+    for name in sorted(violations):
+        count, detail = violations[name]
+        msg += "\n\t* %s: %i times (first at %s)" % (name, count, detail)
+    print(msg)
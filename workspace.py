@@ -0,0 +1,127 @@
+from __future__ import print_function
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Persistent work arrays for the step pipeline.
+
+Each stage of a step (the quantum momentum weights, the electronic
+propagation, the previous step (*_tm) state...) used to allocate fresh arrays
+every step. Instead the arrays are kept in ctmqc_env['workspace'] and written
+into in place:
+    * get_buffer   => a named scratch array (reallocated only if the shape
+                      or dtype it's asked for changes)
+    * swap_tm      => makes key_tm the current key by reference (no copy) and
+                      keeps the old key_tm array as a spare
+    * next_buffer  => the array the next value of key should be written into
+                      (the spare from swap_tm if there is one)
+    * save_state   => saves the state of the ctmqc_env so a step can be undone
+                      with restore_state (for the adaptive dt)
+
+If the workspace hasn't been set up (e.g. in the test functions) get_buffer
+just allocates a new array.
+
+@author: mellis
+"""
+import numpy as np
+
+
+def init_workspace(ctmqc_env):
+    """
+    Will create the (empty) workspace in the ctmqc_env dict.
+    """
+    ctmqc_env['workspace'] = {}
+
+
+def get_buffer(ctmqc_env, name, shape, dtype=np.float64):
+    """
+    Will return the scratch array called name with the given shape and dtype.
+    The contents are whatever was last written to it.
+    """
+    shape = tuple(shape)
+    work = ctmqc_env.get('workspace') if ctmqc_env is not False else None
+    if work is None:
+        return np.empty(shape, dtype=dtype)
+
+    buff = work.get(name)
+    if buff is None or buff.shape != shape or buff.dtype != dtype:
+        buff = np.empty(shape, dtype=dtype)
+        work[name] = buff
+    return buff
+
+
+def swap_tm(ctmqc_env, key):
+    """
+    Will make ctmqc_env[key + '_tm'] the current ctmqc_env[key] by reference.
+    The 2 are the same array until a new value of key is written with
+    next_buffer, so key mustn't be changed in place in between.
+
+    The array that was in key_tm is kept as the spare that next_buffer hands
+    out (unless it is already the current key, i.e. key hasn't changed since
+    the last swap).
+    """
+    old = ctmqc_env.get(key + '_tm')
+    ctmqc_env[key + '_tm'] = ctmqc_env[key]
+    work = ctmqc_env.get('workspace')
+    if work is not None and old is not None and old is not ctmqc_env[key]:
+        work['spare ' + key] = old
+
+
+def next_buffer(ctmqc_env, key):
+    """
+    Will return the array the next value of ctmqc_env[key] should be written
+    into. This is the spare left by swap_tm if it has the right shape and
+    dtype, otherwise the current array (which isn't shared with key_tm).
+    """
+    cur = ctmqc_env[key]
+    work = ctmqc_env.get('workspace')
+    if work is None:
+        return cur
+
+    spare = work.pop('spare ' + key, None)
+    if spare is not None and spare.shape == cur.shape \
+       and spare.dtype == cur.dtype:
+        return spare
+    if cur is ctmqc_env.get(key + '_tm'):
+        return np.empty_like(cur)
+    return cur
+
+
+def save_state(ctmqc_env, inplace_keys):
+    """
+    Will save the state of the ctmqc_env so a step can be undone (see
+    restore_state). The entries are kept by reference (arrays that are
+    replaced during a step are left untouched), the arrays in inplace_keys are
+    changed in place during a step so their values are copied into scratch
+    arrays.
+    """
+    values = {}
+    for key in inplace_keys:
+        arr = ctmqc_env[key]
+        values[key] = get_buffer(ctmqc_env, 'state ' + key, np.shape(arr),
+                                 arr.dtype)
+        np.copyto(values[key], arr)
+    return dict(ctmqc_env), values
+
+
+def restore_state(ctmqc_env, state):
+    """
+    Will put the ctmqc_env back to the state saved by save_state. The arrays
+    the undone step wrote the new values of key (with a key_tm) into are kept
+    as the spares for next_buffer.
+    """
+    refs, values = state
+    trial = dict(ctmqc_env)
+    ctmqc_env.clear()
+    ctmqc_env.update(refs)
+    for key in values:
+        np.copyto(ctmqc_env[key], values[key])
+
+    work = ctmqc_env.get('workspace')
+    if work is None:
+        return
+    for key in refs:
+        if key + '_tm' not in refs or not isinstance(trial.get(key),
+                                                      np.ndarray):
+            continue
+        if trial[key] is not refs[key] and trial[key] is not refs[key + '_tm']:
+            work['spare ' + key] = trial[key]